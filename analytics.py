@@ -0,0 +1,396 @@
+"""
+对话数据分析报表
+
+从在线存储和归档中流式读取对话 ID（可限定日期范围），每 ANALYTICS_SHARD_SIZE 个为一片交给进程池。
+子进程各自以只读方式打开存储（不会截断在线进程正在追加的日志），加载并解析对话，再以 NumPy 数组返回每个对话的指标。
+主进程同时只保留有限个未完成的分片，每收到一片就写出明细并用 NumPy 累加汇总，内存占用与对话总数无关。
+汇总包括：
+- 每日对话数
+- 每个对话的轮数分布
+- 客服回复长度（字符数）分布
+- 按模型估算的 token 用量：每轮请求都会重新发送之前的全部消息（未计上下文裁剪）
+- 最常见的首个问题：使用可合并的 Misra-Gries 摘要，只保留有限个候选，候选过多被裁剪时计数是下界
+
+明细每个对话一行，写成 CSV 或 Parquet（需要 pyarrow），汇总写成 JSON。
+
+    python analytics.py report.csv
+    python analytics.py report.parquet --since 2024-05-01 --until 2024-06-01 --workers 8
+"""
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+from context_window import CJK_RANGES, MESSAGE_OVERHEAD_TOKENS
+from storage import ConversationStore, open_store
+
+# 明细的列及类型（analyze_shard 返回同名数组，另加 response_lengths）；前 6 列是对话级别的元数据
+COLUMNS = {
+    "conversation_id": object, "date": object, "timestamp": np.float64, "provider": object, "model": object,
+    "first_question": object, "messages": np.int32, "turns": np.int32, "user_chars": np.int64,
+    "assistant_chars": np.int64, "prompt_tokens": np.int64, "completion_tokens": np.int64,
+}
+_METADATA_COLUMNS = list(COLUMNS)[:6]
+# 回复长度超过该字符数的计入最后一格（在此以内的分位数是精确的）
+MAX_RESPONSE_CHARS = 20000
+FIRST_QUESTION_LENGTH = 50
+# 首个问题摘要保留的候选数
+QUESTION_CAPACITY = 10000
+# Parquet 每个行组的行数
+PARQUET_ROW_GROUP = 65536
+
+_store: Optional[ConversationStore] = None
+
+
+def _init_worker(backend: str):
+    global _store
+    _store = open_store(backend, read_only=True)
+
+
+def estimate_tokens_batch(contents: List[str]) -> np.ndarray:
+    """向量化的 estimate_tokens：把一批文本拼接后按码位统计中文字符，结果与逐条调用相同"""
+    lengths = np.fromiter(map(len, contents), dtype=np.int64, count=len(contents))
+    ends = np.cumsum(lengths)
+    # 每个码位 4 字节，数组下标与字符串下标一一对应
+    codepoints = np.frombuffer("".join(contents).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    cjk = np.zeros(len(codepoints), dtype=bool)
+    for low, high in CJK_RANGES:
+        cjk |= (codepoints >= low) & (codepoints <= high)
+    cjk_before = np.concatenate(([0], np.cumsum(cjk)))
+    cjk_counts = cjk_before[ends] - cjk_before[ends - lengths]
+    return cjk_counts + (lengths - cjk_counts + 3) // 4
+
+
+def analyze_shard(shard: List[Tuple[str, float]]) -> Dict[str, np.ndarray]:
+    """在子进程中加载一片对话并计算每个对话的指标；所有回复的长度另外汇成 response_lengths"""
+    search = getattr(_store, "search", None)
+    metadata = search.metadata([conversation_id for conversation_id, _ in shard]) if search is not None else {}
+    rows, message_counts, contents, roles = [], [], [], []
+    for conversation_id, timestamp in shard:
+        try:
+            history = _store.load(conversation_id)
+        except FileNotFoundError:
+            # 列出之后被删除
+            continue
+        provider, model = metadata.get(conversation_id, ("", ""))
+        first_question = next((m["content"] for m in history if m["role"] == "user"), "")
+        rows.append((conversation_id, date.fromtimestamp(timestamp).isoformat(), timestamp, provider, model,
+                     " ".join(first_question.split())[:FIRST_QUESTION_LENGTH]))
+        message_counts.append(len(history))
+        contents.extend(m["content"] for m in history)
+        roles.extend(m["role"] for m in history)
+
+    result = {name: np.array(values, dtype=COLUMNS[name])
+              for name, values in zip(_METADATA_COLUMNS, zip(*rows) if rows else [()] * len(_METADATA_COLUMNS))}
+    # 以下按消息向量化计算，再用 bincount 按对话求和
+    count = len(message_counts)
+    message_counts = np.array(message_counts, dtype=np.int64)
+    owners = np.repeat(np.arange(count), message_counts)
+    lengths = np.fromiter(map(len, contents), dtype=np.int64, count=len(contents))
+    tokens = estimate_tokens_batch(contents)
+    roles = np.array(roles, dtype=object)
+    user, assistant = roles == "user", roles == "assistant"
+    # 生成每条回复的请求发送了对话中之前的全部消息：消息之前的累计 token 减去所在对话开头之前的累计 token
+    sent = tokens + MESSAGE_OVERHEAD_TOKENS
+    before = np.cumsum(sent) - sent
+    context = before - before[np.repeat(np.cumsum(message_counts) - message_counts, message_counts)]
+
+    def per_conversation(weights: np.ndarray) -> np.ndarray:
+        return np.bincount(owners, weights=weights, minlength=count).astype(np.int64)
+
+    result["messages"] = message_counts.astype(np.int32)
+    result["turns"] = per_conversation(user).astype(np.int32)
+    result["user_chars"] = per_conversation(lengths * user)
+    result["assistant_chars"] = per_conversation(lengths * assistant)
+    result["prompt_tokens"] = per_conversation(context * assistant)
+    result["completion_tokens"] = per_conversation(tokens * assistant)
+    result["response_lengths"] = lengths[assistant]
+    return result
+
+
+def iter_shards(store: ConversationStore, start: Optional[float] = None, end: Optional[float] = None,
+                shard_size: int = Config.ANALYTICS_SHARD_SIZE) -> Iterator[List[Tuple[str, float]]]:
+    """把存储中时间范围内的对话 ID 按 shard_size 个一组流式切片"""
+    shard = []
+    for item in store.iter_ids(start, end):
+        shard.append(item)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def _histogram_percentile(histogram: np.ndarray, p: float) -> Optional[int]:
+    """按直方图（下标为取值）用最近秩法计算分位数，没有样本时返回 None"""
+    total = int(histogram.sum())
+    if not total:
+        return None
+    rank = max(1, math.ceil(p / 100 * total))
+    return int(np.searchsorted(np.cumsum(histogram), rank))
+
+
+class AnalyticsReport:
+    def __init__(self, top_questions: int = Config.ANALYTICS_TOP_QUESTIONS,
+                 question_capacity: int = QUESTION_CAPACITY):
+        """
+        可逐片累加的汇总，占用的内存只与天数、模型数和候选问题数有关
+
+        Args:
+            top_questions: 汇总中列出的最常见首个问题数
+            question_capacity: 首个问题摘要保留的候选数
+        """
+        self.top_questions = top_questions
+        self.question_capacity = question_capacity
+        self.conversations = 0
+        self.messages = 0
+        self.per_day: Counter = Counter()
+        # 下标为轮数 / 回复字符数的直方图
+        self.turns = np.zeros(1, dtype=np.int64)
+        self.responses = np.zeros(MAX_RESPONSE_CHARS + 1, dtype=np.int64)
+        self.response_total = 0
+        self.response_max = 0
+        # 模型 -> [对话数, 输入 token, 输出 token]
+        self.models: Dict[str, np.ndarray] = {}
+        self.questions: Counter = Counter()
+        self.questions_pruned = False
+        self.elapsed = 0.0
+
+    def add(self, shard: Dict[str, np.ndarray]):
+        count = len(shard["conversation_id"])
+        if not count:
+            return
+        self.conversations += count
+        self.messages += int(shard["messages"].sum())
+
+        days, per_day = np.unique(shard["date"], return_counts=True)
+        self.per_day.update(dict(zip(days.tolist(), per_day.tolist())))
+
+        turns = np.bincount(shard["turns"])
+        if len(turns) > len(self.turns):
+            self.turns = np.pad(self.turns, (0, len(turns) - len(self.turns)))
+        self.turns[:len(turns)] += turns
+
+        lengths = shard["response_lengths"]
+        self.responses += np.bincount(np.minimum(lengths, MAX_RESPONSE_CHARS), minlength=MAX_RESPONSE_CHARS + 1)
+        self.response_total += int(lengths.sum())
+        self.response_max = max(self.response_max, int(lengths.max(initial=0)))
+
+        models, inverse = np.unique(shard["model"], return_inverse=True)
+        sums = np.stack([
+            np.bincount(inverse, minlength=len(models)),
+            np.bincount(inverse, weights=shard["prompt_tokens"], minlength=len(models)),
+            np.bincount(inverse, weights=shard["completion_tokens"], minlength=len(models)),
+        ], axis=1).astype(np.int64)
+        for model, row in zip(models.tolist(), sums):
+            if model in self.models:
+                self.models[model] += row
+            else:
+                self.models[model] = row
+
+        questions = shard["first_question"]
+        questions, counts = np.unique(questions[questions != ""], return_counts=True)
+        self.questions.update(dict(zip(questions.tolist(), counts.tolist())))
+        if len(self.questions) > self.question_capacity:
+            # Misra-Gries：所有计数减去第 capacity + 1 大的计数，只保留仍为正的候选
+            cut = sorted(self.questions.values(), reverse=True)[self.question_capacity]
+            self.questions = Counter({q: c - cut for q, c in self.questions.items() if c > cut})
+            self.questions_pruned = True
+
+    def summary(self) -> Dict:
+        turn_count = int(self.turns.sum())
+        response_count = int(self.responses.sum())
+        return {
+            "conversations": self.conversations,
+            "messages": self.messages,
+            "elapsed": self.elapsed,
+            "per_day": [{"date": day, "conversations": n} for day, n in sorted(self.per_day.items())],
+            "turns": {
+                "mean": float(np.dot(np.arange(len(self.turns)), self.turns)) / turn_count if turn_count else None,
+                "p50": _histogram_percentile(self.turns, 50),
+                "p90": _histogram_percentile(self.turns, 90),
+                "p99": _histogram_percentile(self.turns, 99),
+                "max": len(self.turns) - 1 if turn_count else None,
+            },
+            "response_chars": {
+                "count": response_count,
+                "mean": self.response_total / response_count if response_count else None,
+                "p50": _histogram_percentile(self.responses, 50),
+                "p90": _histogram_percentile(self.responses, 90),
+                "p99": _histogram_percentile(self.responses, 99),
+                "max": self.response_max if response_count else None,
+            },
+            "tokens_by_model": sorted((
+                {"model": model or "未知", "conversations": int(row[0]),
+                 "prompt_tokens": int(row[1]), "completion_tokens": int(row[2])}
+                for model, row in self.models.items()
+            ), key=lambda item: item["prompt_tokens"] + item["completion_tokens"], reverse=True),
+            "top_first_questions": [{"question": q, "count": c}
+                                    for q, c in self.questions.most_common(self.top_questions)],
+            "first_question_counts_approximate": self.questions_pruned,
+        }
+
+
+class CsvWriter:
+    def __init__(self, path: str):
+        # 带 BOM，Excel 打开中文不乱码
+        self._file = open(path, "w", encoding="utf-8-sig", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(COLUMNS)
+
+    def write(self, shard: Dict[str, np.ndarray]):
+        self._writer.writerows(zip(*(shard[name].tolist() for name in COLUMNS)))
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("导出 Parquet 需要先安装 pyarrow：pip install pyarrow")
+        self._pa = pa
+        types = {object: pa.string(), np.float64: pa.float64(), np.int32: pa.int32(), np.int64: pa.int64()}
+        self._schema = pa.schema([(name, types[dtype]) for name, dtype in COLUMNS.items()])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        # 分片很小，攒够一个行组再写
+        self._pending: List[Dict[str, np.ndarray]] = []
+        self._pending_rows = 0
+
+    def write(self, shard: Dict[str, np.ndarray]):
+        self._pending.append(shard)
+        self._pending_rows += len(shard["conversation_id"])
+        if self._pending_rows >= PARQUET_ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending_rows:
+            return
+        arrays = [self._pa.array(np.concatenate([shard[name] for shard in self._pending]), type=field.type)
+                  for name, field in zip(COLUMNS, self._schema)]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self._schema))
+        self._pending, self._pending_rows = [], 0
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def open_writer(path: str, fmt: Optional[str] = None):
+    """按格式（"csv" 或 "parquet"，默认由扩展名决定）创建明细写出器"""
+    fmt = fmt or ("parquet" if path.endswith(".parquet") else "csv")
+    if fmt == "parquet":
+        return ParquetWriter(path)
+    if fmt == "csv":
+        return CsvWriter(path)
+    raise ValueError(f"Unsupported format: {fmt}. Use 'csv' or 'parquet'.")
+
+
+def run(backend: str = Config.CONVERSATION_STORAGE, out: Optional[str] = None, fmt: Optional[str] = None,
+        start: Optional[float] = None, end: Optional[float] = None,
+        workers: Optional[int] = Config.ANALYTICS_WORKERS,
+        shard_size: int = Config.ANALYTICS_SHARD_SIZE) -> AnalyticsReport:
+    """
+    统计存储中时间范围内的全部对话（含归档）
+
+    Args:
+        backend: 在线存储后端
+        out: 明细输出路径（None 表示只汇总）
+        fmt: 明细格式，"csv" 或 "parquet"，默认由扩展名决定
+        start, end: 对话时间范围（时间戳，左闭右开）
+        workers: 子进程数（None 表示使用全部 CPU 核）
+        shard_size: 每片的对话数
+    Returns:
+        累加完成的汇总
+    """
+    report = AnalyticsReport()
+    writer = open_writer(out, fmt) if out else None
+    workers = workers or os.cpu_count() or 1
+
+    def consume(futures):
+        for future in futures:
+            shard = future.result()
+            report.add(shard)
+            if writer is not None:
+                writer.write(shard)
+
+    started = time.perf_counter()
+    # spawn：子进程不继承父进程已打开的 SQLite 连接和后台线程
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(backend,)) as pool:
+            pending = set()
+            for shard in iter_shards(open_store(backend, read_only=True), start, end, shard_size):
+                # 未完成的分片数有上限：读取 ID 的速度远快于解析，不限制时 ID 会全部堆在内存里
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    consume(done)
+                pending.add(pool.submit(analyze_shard, shard))
+            consume(wait(pending).done)
+    finally:
+        if writer is not None:
+            writer.close()
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def print_report(summary: Dict):
+    print("=" * 40)
+    print(f"对话数: {summary['conversations']}，消息数: {summary['messages']}，耗时 {summary['elapsed']:.2f}s")
+    if summary["per_day"]:
+        days = summary["per_day"]
+        print(f"日期: {days[0]['date']} ~ {days[-1]['date']}，"
+              f"日均 {summary['conversations'] / len(days):.1f} 个对话，最多 {max(d['conversations'] for d in days)} 个")
+    turns, responses = summary["turns"], summary["response_chars"]
+    if turns["mean"] is not None:
+        print(f"每个对话轮数: 平均 {turns['mean']:.1f}  p50 {turns['p50']}  p90 {turns['p90']}  最多 {turns['max']}")
+    if responses["mean"] is not None:
+        print(f"回复长度（字符）: 平均 {responses['mean']:.0f}  p50 {responses['p50']}  "
+              f"p90 {responses['p90']}  p99 {responses['p99']}")
+    for row in summary["tokens_by_model"]:
+        print(f"  {row['model']}: {row['conversations']} 个对话，"
+              f"输入约 {row['prompt_tokens']} tokens，输出约 {row['completion_tokens']} tokens")
+    if summary["top_first_questions"]:
+        print("最常见的首个问题" + ("（计数为下界）" if summary["first_question_counts_approximate"] else "") + ":")
+        for row in summary["top_first_questions"]:
+            print(f"  {row['count']:>6}  {row['question']}")
+    print("=" * 40)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对话数据分析报表")
+    parser.add_argument("out", nargs="?", help="明细输出路径（.csv 或 .parquet），不提供时只输出汇总")
+    parser.add_argument("--format", choices=["csv", "parquet"], help="明细格式（默认由扩展名决定）")
+    parser.add_argument("--summary", help="汇总 JSON 的输出路径（默认与明细同名，后缀 .summary.json）")
+    parser.add_argument("--backend", default=Config.CONVERSATION_STORAGE, help="在线存储后端")
+    parser.add_argument("--since", help="起始日期 YYYY-MM-DD")
+    parser.add_argument("--until", help="截止日期 YYYY-MM-DD（不含）")
+    parser.add_argument("--workers", type=int, default=Config.ANALYTICS_WORKERS, help="子进程数（默认为 CPU 核数）")
+    parser.add_argument("--shard-size", type=int, default=Config.ANALYTICS_SHARD_SIZE, help="每片的对话数")
+    args = parser.parse_args()
+
+    def parse_date(value):
+        return time.mktime(time.strptime(value, "%Y-%m-%d")) if value else None
+
+    summary = run(args.backend, args.out, args.format, parse_date(args.since), parse_date(args.until),
+                  args.workers, args.shard_size).summary()
+    print_report(summary)
+    summary_path = args.summary or (os.path.splitext(args.out)[0] + ".summary.json" if args.out else None)
+    if summary_path:
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"汇总已写入 {summary_path}")
@@ -0,0 +1,290 @@
+"""
+无界面的 HTTP 对话服务（ASGI）
+
+与 Streamlit 页面共用 CustomerServiceChatbot 的全部逻辑（缓存、路由、容错、限流、指标），
+但每个请求只做：读取会话历史 -> 调用模型 -> 写回历史，不需要重跑整个脚本。
+会话历史保存在会话存储（session_store）中，进程内不保留状态，
+因此可以用多个 worker 进程（甚至多台机器共用 Redis）同时服务：
+
+    python api_server.py --workers 4
+    uvicorn api_server:app --workers 4 --port 8000
+
+接口：
+    POST /sessions                          创建会话，可选 {"system_prompt": "..."}
+    POST /sessions/{id}/messages            发送消息 {"message": "...", "stream": false}
+    GET  /sessions/{id}/messages            获取对话历史
+    POST /sessions/{id}/reset               重置对话（保留系统提示词）
+    PUT  /sessions/{id}/system_prompt       设置系统提示词 {"system_prompt": "..."}
+    GET  /healthz, GET /metrics
+
+两个 worker 同时修改同一会话时，后提交的请求返回 409，客户端重新发送即可。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from async_chatbot import AsyncCustomerServiceChatbot
+from config import Config
+from messages import to_wire
+from metrics import default_metrics
+from router import build_router_from_env
+from session_store import Session, SessionStore, VersionConflict, new_session_id, open_session_store
+
+
+# 会话 ID 会直接用作文件名，只允许安全字符
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ChatService:
+    def __init__(self, sessions: Optional[SessionStore] = None):
+        """
+        会话与机器人的管理
+
+        每个请求按会话历史新建一个轻量的机器人实例，HTTP 连接池、路由器和存储在进程内共享。
+        同一进程内对同一会话的请求串行执行；跨进程的并发写入由会话存储的版本号检查拦截。
+        """
+        self.sessions = sessions or open_session_store()
+        self.http: Optional[aiohttp.ClientSession] = None
+        self.router = build_router_from_env()
+        self._locks = weakref.WeakValueDictionary()
+
+    async def start(self):
+        self.http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(connect=Config.HTTP_CONNECT_TIMEOUT, sock_read=Config.HTTP_READ_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=Config.API_HTTP_POOL_SIZE),
+            trace_configs=[default_metrics.aiohttp_trace_config()] if Config.METRICS_ENABLED else None
+        )
+
+    async def stop(self):
+        if self.http is not None:
+            await self.http.close()
+
+    @property
+    def configured(self) -> bool:
+        return self.router is not None or bool(os.getenv("OPENAI_API_KEY") or os.getenv("DEEPSEEK_API_KEY"))
+
+    def make_bot(self, history: Optional[List[Dict[str, str]]] = None) -> AsyncCustomerServiceChatbot:
+        """按环境变量选择提供商，优先级与 Streamlit 页面一致（对话由会话存储持久化，不另开自动保存）"""
+        openai_key = os.getenv("OPENAI_API_KEY")
+        deepseek_key = os.getenv("DEEPSEEK_API_KEY")
+        if self.router is not None:
+            bot = AsyncCustomerServiceChatbot(router=self.router, model="auto", session=self.http,
+                                              autosave=False)
+        elif openai_key:
+            bot = AsyncCustomerServiceChatbot(api_key=openai_key, provider="openai", model="gpt-3.5-turbo",
+                                              session=self.http, autosave=False)
+        else:
+            bot = AsyncCustomerServiceChatbot(api_key=deepseek_key, provider="deepseek", model="deepseek-chat",
+                                              session=self.http, autosave=False)
+        if history:
+            bot.conversation_history = history
+        return bot
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[session_id] = lock
+        return lock
+
+    async def create(self, session_id: str, bot: AsyncCustomerServiceChatbot):
+        await asyncio.to_thread(self.sessions.create, session_id, bot.conversation_history)
+
+    async def load(self, session_id: str) -> Tuple[Session, AsyncCustomerServiceChatbot]:
+        session = self.sessions.open(session_id)
+        history = await asyncio.to_thread(session.refresh)
+        return session, self.make_bot(history)
+
+    async def save(self, session: Session, bot: AsyncCustomerServiceChatbot):
+        """只写入本次请求新增的消息；会话已被其他 worker 修改时抛出 VersionConflict"""
+        await asyncio.to_thread(session.save, bot.conversation_history)
+
+
+service: Optional[ChatService] = None
+
+
+def error(status_code: int, message: str) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+async def read_json(request: Request) -> Dict:
+    body = await request.body()
+    if not body:
+        return {}
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("请求体必须是 JSON 对象")
+    return data
+
+
+def session_view(session_id: str, bot: AsyncCustomerServiceChatbot) -> Dict:
+    return {
+        "session_id": session_id,
+        "system_prompt": bot.system_prompt,
+        "messages": to_wire(bot.get_conversation_history())
+    }
+
+
+def with_session(handler):
+    """校验会话 ID、解析请求体，并把会话不存在、请求体错误转换为 4xx 响应"""
+    async def endpoint(request: Request) -> Response:
+        session_id = request.path_params["session_id"]
+        if not SESSION_ID_PATTERN.match(session_id):
+            return error(400, "无效的会话 ID")
+        if not service.configured:
+            return error(503, "未配置 OPENAI_API_KEY 或 DEEPSEEK_API_KEY")
+        try:
+            body = await read_json(request)
+            return await handler(request, session_id, body)
+        except FileNotFoundError:
+            return error(404, f"会话不存在：{session_id}")
+        except VersionConflict as e:
+            return error(409, str(e))
+        except ValueError as e:
+            return error(400, str(e))
+    return endpoint
+
+
+async def create_session(request: Request) -> Response:
+    if not service.configured:
+        return error(503, "未配置 OPENAI_API_KEY 或 DEEPSEEK_API_KEY")
+    try:
+        body = await read_json(request)
+    except ValueError as e:
+        return error(400, str(e))
+    session_id = new_session_id()
+    bot = service.make_bot()
+    if body.get("system_prompt"):
+        bot.set_system_prompt(str(body["system_prompt"]))
+    await service.create(session_id, bot)
+    return JSONResponse(session_view(session_id, bot), status_code=201)
+
+
+@with_session
+async def get_messages(request: Request, session_id: str, body: Dict) -> Response:
+    _, bot = await service.load(session_id)
+    return JSONResponse(session_view(session_id, bot))
+
+
+@with_session
+async def reset_session(request: Request, session_id: str, body: Dict) -> Response:
+    async with service.lock(session_id):
+        session, bot = await service.load(session_id)
+        bot.reset_conversation()
+        await service.save(session, bot)
+    return JSONResponse(session_view(session_id, bot))
+
+
+@with_session
+async def set_system_prompt(request: Request, session_id: str, body: Dict) -> Response:
+    prompt = body.get("system_prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        return error(400, "system_prompt 不能为空")
+    async with service.lock(session_id):
+        session, bot = await service.load(session_id)
+        bot.set_system_prompt(prompt)
+        await service.save(session, bot)
+    return JSONResponse(session_view(session_id, bot))
+
+
+@with_session
+async def send_message(request: Request, session_id: str, body: Dict) -> Response:
+    message = body.get("message")
+    if not isinstance(message, str) or not message.strip():
+        return error(400, "message 不能为空")
+    use_cache = bool(body.get("use_cache", True))
+
+    if body.get("stream"):
+        # 先确认会话存在，流开始后就无法再返回 404
+        await service.load(session_id)
+        return StreamingResponse(stream_reply(session_id, message, use_cache), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async with service.lock(session_id):
+        session, bot = await service.load(session_id)
+        reply = await bot.achat(message, use_cache=use_cache)
+        if bot.last_error is not None:
+            return error(502, reply)
+        await service.save(session, bot)
+    return JSONResponse({"session_id": session_id, "reply": reply, "call": bot.last_call})
+
+
+def sse(data: Dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_reply(session_id: str, message: str, use_cache: bool):
+    """以 SSE 产出增量：data: {"delta": ...}，结束时 event: done，出错时 event: error"""
+    async with service.lock(session_id):
+        try:
+            session, bot = await service.load(session_id)
+        except FileNotFoundError:
+            yield sse({"error": f"会话不存在：{session_id}"}, event="error")
+            return
+        chunks = []
+        async for delta in bot.achat_stream(message, use_cache=use_cache):
+            chunks.append(delta)
+            if bot.last_error is None:
+                yield sse({"delta": delta})
+        if bot.last_error is not None:
+            yield sse({"error": chunks[-1]}, event="error")
+            return
+        try:
+            await service.save(session, bot)
+        except VersionConflict as e:
+            yield sse({"error": str(e)}, event="error")
+            return
+    yield sse({"reply": "".join(chunks), "call": bot.last_call}, event="done")
+
+
+async def healthz(request: Request) -> Response:
+    return JSONResponse({"status": "ok", "configured": service.configured})
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return PlainTextResponse(default_metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global service
+    service = ChatService()
+    await service.start()
+    try:
+        yield
+    finally:
+        await service.stop()
+
+
+app = Starlette(routes=[
+    Route("/sessions", create_session, methods=["POST"]),
+    Route("/sessions/{session_id}/messages", send_message, methods=["POST"]),
+    Route("/sessions/{session_id}/messages", get_messages, methods=["GET"]),
+    Route("/sessions/{session_id}/reset", reset_session, methods=["POST"]),
+    Route("/sessions/{session_id}/system_prompt", set_system_prompt, methods=["PUT"]),
+    Route("/healthz", healthz, methods=["GET"]),
+    Route("/metrics", metrics_endpoint, methods=["GET"]),
+], lifespan=lifespan)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="智能客服 HTTP 对话服务")
+    parser.add_argument("--host", default=Config.API_HOST)
+    parser.add_argument("--port", type=int, default=Config.API_PORT)
+    parser.add_argument("--workers", type=int, default=Config.API_WORKERS, help="worker 进程数")
+    args = parser.parse_args()
+    uvicorn.run("api_server:app", host=args.host, port=args.port, workers=args.workers, access_log=False)
@@ -1,16 +1,21 @@
 import streamlit as st
 from chatbot import CustomerServiceChatbot
+from config import Config
+from metrics import default_metrics, start_metrics_server
+from router import build_router_from_env
+from session_store import VersionConflict, new_session_id, open_session_store
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import glob
-import json
-import html
-import markdown
+from render_cache import build_message_html, render_message
 
 load_dotenv()
 
 CONVERSATIONS_DIR = "conversations"
+HISTORY_PAGE_SIZE = 10
+SEARCH_RESULT_LIMIT = 20
+SEARCH_ROLES = {"全部": None, "用户": "user", "客服": "assistant"}
 if not os.path.exists(CONVERSATIONS_DIR):
     os.makedirs(CONVERSATIONS_DIR)
 
@@ -174,19 +179,81 @@ html, body, [class*="css"] {
 st.markdown(custom_style, unsafe_allow_html=True)
 
 
+@st.cache_resource
+def get_router():
+    """同时配置了多个 API Key 时创建路由器，所有会话共享延迟和错误统计"""
+    return build_router_from_env()
+
+
+@st.cache_resource
+def get_metrics_server():
+    """配置了 METRICS_PORT 时在后台提供 /metrics 端点，整个进程只启动一次"""
+    if Config.METRICS_PORT:
+        return start_metrics_server(default_metrics, Config.METRICS_PORT)
+    return None
+
+
+def attach_live_session():
+    """
+    把当前对话绑定到会话存储中的一个会话，会话 ID 记在 URL 的 sid 参数中
+
+    刷新页面、重启进程或被负载均衡分配到其他进程时，按 sid 恢复对话历史。
+    """
+    chatbot = st.session_state.chatbot
+    store = open_session_store()
+    session_id = st.query_params.get("sid")
+    if session_id:
+        session = store.open(session_id)
+        try:
+            history = session.history
+        except FileNotFoundError:
+            session_id = None
+        else:
+            if history:
+                chatbot.conversation_history = history
+    if not session_id:
+        session_id = new_session_id()
+        store.create(session_id, chatbot.conversation_history)
+        session = store.open(session_id)
+        st.query_params["sid"] = session_id
+    st.session_state.live_session = session
+
+
+def persist_live_session():
+    """把本轮新增的消息写回会话存储；会话已在其他页面被修改时重新载入"""
+    session = st.session_state.get("live_session")
+    if session is None:
+        return
+    chatbot = st.session_state.chatbot
+    try:
+        session.save(chatbot.conversation_history)
+    except VersionConflict:
+        chatbot.conversation_history = session.refresh()
+        st.warning("该对话已在其他窗口中更新，已载入最新内容")
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.0f} ms"
+
+
 def init_session_state():
     if 'chatbot' not in st.session_state:
         openai_key = os.getenv("OPENAI_API_KEY")
         deepseek_key = os.getenv("DEEPSEEK_API_KEY")
         
-        if openai_key:
+        router = get_router()
+        
+        if router is not None:
+            st.session_state.chatbot = CustomerServiceChatbot(router=router, model="auto")
+            st.session_state.api_key_valid = True
+            st.session_state.provider = "router"
+        elif openai_key:
             try:
                 st.session_state.chatbot = CustomerServiceChatbot(
                     api_key=openai_key, 
                     provider="openai",
                     model="gpt-3.5-turbo"
                 )
-                st.session_state.messages = []
                 st.session_state.api_key_valid = True
                 st.session_state.provider = "openai"
             except Exception as e:
@@ -199,7 +266,6 @@ def init_session_state():
                     provider="deepseek",
                     model="deepseek-chat"
                 )
-                st.session_state.messages = []
                 st.session_state.api_key_valid = True
                 st.session_state.provider = "deepseek"
             except Exception as e:
@@ -208,15 +274,18 @@ def init_session_state():
         else:
             st.session_state.api_key_valid = False
     
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []
-    
     if 'provider' not in st.session_state:
         st.session_state.provider = None
+    
+    if 'history_page' not in st.session_state:
+        st.session_state.history_page = 0
 
 
 def main():
+    get_metrics_server()
     init_session_state()
+    if st.session_state.get('api_key_valid', False) and 'live_session' not in st.session_state:
+        attach_live_session()
     
     st.title("智能客服机器人")
     st.markdown("基于 ChatGPT/DeepSeek 的多轮对话客服系统")
@@ -249,7 +318,6 @@ def main():
                             provider=provider,
                             model=model
                         )
-                        st.session_state.messages = []
                         st.session_state.api_key_valid = True
                         st.session_state.provider = provider
                         st.success("API Key 已保存")
@@ -264,7 +332,12 @@ def main():
         
         st.divider()
         
-        if st.session_state.get('api_key_valid', False):
+        if st.session_state.get('api_key_valid', False) and st.session_state.get('provider') == "router":
+            st.markdown("**自动路由后端**")
+            for backend in st.session_state.chatbot.router.stats():
+                latency = f"{backend['latency_ewma'] * 1000:.0f}ms" if backend['latency_ewma'] is not None else "-"
+                st.caption(f"{backend['name']}：延迟 {latency}，错误率 {backend['error_ewma']:.0%}，{backend['state']}")
+        elif st.session_state.get('api_key_valid', False):
             current_provider = st.session_state.get('provider', 'openai')
             
             if current_provider == "openai":
@@ -284,7 +357,7 @@ def main():
                 help=f"选择要使用的 {current_provider.upper()} 模型"
             )
         
-        if st.session_state.get('api_key_valid', False):
+        if st.session_state.get('api_key_valid', False) and st.session_state.get('provider') != "router":
             st.session_state.chatbot.model = model_choice
         
         st.divider()
@@ -294,61 +367,108 @@ def main():
             if st.button("重置对话", use_container_width=True):
                 if st.session_state.get('api_key_valid', False):
                     st.session_state.chatbot.reset_conversation()
-                    st.session_state.messages = []
+                    persist_live_session()
                     st.success("对话已重置")
                     st.rerun()
         
         with col2:
             if st.button("保存对话", use_container_width=True):
-                if st.session_state.get('api_key_valid', False) and st.session_state.messages:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = os.path.join(CONVERSATIONS_DIR, f"conversation_{timestamp}.json")
-                    st.session_state.chatbot.save_conversation(filename)
+                if st.session_state.get('api_key_valid', False) and st.session_state.chatbot.get_conversation_history():
+                    st.session_state.chatbot.save_conversation()
+                    st.session_state.history_page = 0
                     st.success(f"对话已保存")
         
         st.divider()
         
         with st.expander("历史对话"):
             if st.session_state.get('api_key_valid', False):
-                conversation_files = sorted(glob.glob(os.path.join(CONVERSATIONS_DIR, "conversation_*.json")), reverse=True)
+                store = st.session_state.chatbot.storage
+                total = store.count()
                 
-                if conversation_files:
-                    st.markdown(f"共 {len(conversation_files)} 条历史记录")
+                if total:
+                    page_count = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+                    page = min(st.session_state.history_page, page_count - 1)
+                    st.markdown(f"共 {total} 条历史记录")
                     
-                    for conv_file in conversation_files[:10]:
-                        filename = os.path.basename(conv_file)
-                        timestamp_str = filename.replace("conversation_", "").replace(".json", "")
-                        try:
-                            dt = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-                            display_name = dt.strftime("%Y-%m-%d %H:%M:%S")
-                        except:
-                            display_name = timestamp_str
+                    for item in store.list_conversations(page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE):
+                        conversation_id = item["id"]
+                        display_name = datetime.fromtimestamp(item["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+                        if item["preview"]:
+                            display_name = f"{display_name} · {item['preview'][:20]}"
                         
                         col1, col2 = st.columns([3, 1])
                         with col1:
-                            if st.button(display_name, key=f"load_{filename}", use_container_width=True):
+                            if st.button(display_name, key=f"load_{conversation_id}", use_container_width=True,
+                                         help=f"{item['turn_count']} 轮对话"):
                                 try:
-                                    st.session_state.chatbot.load_conversation(conv_file)
-                                    with open(conv_file, 'r', encoding='utf-8') as f:
-                                        history = json.load(f)
-                                    st.session_state.messages = [msg for msg in history if msg["role"] != "system"]
+                                    st.session_state.chatbot.load_conversation(conversation_id)
+                                    persist_live_session()
                                     st.success(f"已加载对话")
                                     st.rerun()
                                 except Exception as e:
                                     st.error(f"加载失败: {str(e)}")
                         with col2:
-                            if st.button("删除", key=f"del_{filename}"):
+                            if st.button("删除", key=f"del_{conversation_id}"):
                                 try:
-                                    os.remove(conv_file)
+                                    store.delete(conversation_id)
                                     st.success("已删除")
                                     st.rerun()
                                 except Exception as e:
                                     st.error(f"删除失败: {str(e)}")
+                    
+                    if page_count > 1:
+                        col1, col2, col3 = st.columns([1, 2, 1])
+                        with col1:
+                            if st.button("‹", key="history_prev", disabled=page == 0):
+                                st.session_state.history_page = page - 1
+                                st.rerun()
+                        with col2:
+                            st.caption(f"第 {page + 1} / {page_count} 页")
+                        with col3:
+                            if st.button("›", key="history_next", disabled=page >= page_count - 1):
+                                st.session_state.history_page = page + 1
+                                st.rerun()
                 else:
                     st.info("暂无历史对话")
             else:
                 st.info("请先配置 API Key")
         
+        with st.expander("搜索对话"):
+            search = getattr(st.session_state.chatbot.storage, "search", None) \
+                if st.session_state.get('api_key_valid', False) else None
+            if not st.session_state.get('api_key_valid', False):
+                st.info("请先配置 API Key")
+            elif search is None:
+                st.info("未开启全文检索")
+            else:
+                query = st.text_input("关键词", key="search_query", placeholder="如：退款、订单号",
+                                      help="空格分隔的词需同时出现，双引号括起的部分按短语匹配")
+                col1, col2 = st.columns(2)
+                with col1:
+                    role_label = st.selectbox("角色", list(SEARCH_ROLES), key="search_role")
+                with col2:
+                    dates = st.date_input("日期", value=[], key="search_dates")
+                
+                if query.strip():
+                    start = end = None
+                    if len(dates) >= 1:
+                        start = datetime.combine(dates[0], datetime.min.time()).timestamp()
+                    if len(dates) == 2:
+                        end = datetime.combine(dates[1] + timedelta(days=1), datetime.min.time()).timestamp()
+                    hits = search.search(query, limit=SEARCH_RESULT_LIMIT, start=start, end=end,
+                                         role=SEARCH_ROLES[role_label], per_conversation=True)
+                    st.caption(f"找到 {len(hits)} 个对话" if hits else "没有匹配的对话")
+                    for hit in hits:
+                        label = f"{datetime.fromtimestamp(hit['timestamp']).strftime('%Y-%m-%d %H:%M')} · {hit['snippet']}"
+                        if st.button(label, key=f"search_{hit['conversation_id']}", use_container_width=True):
+                            try:
+                                st.session_state.chatbot.load_conversation(hit["conversation_id"])
+                                persist_live_session()
+                                st.success(f"已加载对话")
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"加载失败: {str(e)}")
+        
         with st.expander("自定义系统提示词"):
             custom_prompt = st.text_area(
                 "系统提示词",
@@ -360,14 +480,28 @@ def main():
             if st.button("应用提示词"):
                 if st.session_state.get('api_key_valid', False):
                     st.session_state.chatbot.set_system_prompt(custom_prompt)
+                    persist_live_session()
                     st.success("提示词已更新")
         
         st.divider()
         
         st.markdown("### 对话统计")
         if st.session_state.get('api_key_valid', False):
-            msg_count = len(st.session_state.messages)
+            msg_count = len(st.session_state.chatbot.get_conversation_history())
             st.metric("消息数量", msg_count)
+            
+            summary = default_metrics.summary()
+            col1, col2 = st.columns(2)
+            col1.metric("延迟 p50", format_seconds(summary["latency_p50"]))
+            col2.metric("延迟 p95", format_seconds(summary["latency_p95"]))
+            col1.metric("首字 p50", format_seconds(summary["first_token_p50"]))
+            col2.metric("首字 p95", format_seconds(summary["first_token_p95"]))
+            col1.metric("输入 token", f"{summary['prompt_tokens']:.0f}")
+            col2.metric("输出 token", f"{summary['completion_tokens']:.0f}")
+            hit_ratio = summary["prompt_cache_hit_ratio"]
+            col1.metric("前缀缓存命中率", "-" if hit_ratio is None else f"{hit_ratio:.0%}")
+            col2.metric("命中缓存 token", f"{summary['prompt_cache_hit_tokens']:.0f}")
+            st.caption(f"调用 {summary['calls']:.0f} 次，失败 {summary['errors']:.0f} 次，缓存命中 {summary['cache_hits']:.0f} 次")
     
     if not st.session_state.get('api_key_valid', False):
         st.info("请在侧边栏配置 API Key 以开始使用")
@@ -396,62 +530,30 @@ def main():
         """)
         return
     
-    # 显示对话历史
-    for message in st.session_state.messages:
-        role = message["role"]
-        content = message["content"]
-        
-        if role == "user":
-            label = "您"
-            avatar = """
-            <svg viewBox="0 0 24 24" width="24" height="24" stroke="currentColor" stroke-width="2" fill="none" stroke-linecap="round" stroke-linejoin="round" class="css-i6hzaj">
-                <path d="M20 21v-2a4 4 0 0 0-4-4H8a4 4 0 0 0-4 4v2"></path>
-                <circle cx="12" cy="7" r="4"></circle>
-            </svg>
-            """
-            # 用户消息：转义HTML
-            escaped_content = html.escape(content).replace('\n', '<br>')
-            
-            st.markdown(f'''
-            <div class="message-row user">
-                <div class="avatar user">{avatar}</div>
-                <div class="message-content">
-                    <div class="message-label">{label}</div>
-                    <div class="message-bubble user">{escaped_content}</div>
-                </div>
-            </div>
-            ''', unsafe_allow_html=True)
-        else:
-            label = "AI助手"
-            avatar = """
-            <svg viewBox="0 0 24 24" width="24" height="24" stroke="currentColor" stroke-width="2" fill="none" stroke-linecap="round" stroke-linejoin="round" class="css-i6hzaj">
-                <path d="M12 2a2 2 0 0 1 2 2v2a2 2 0 0 1-2 2 2 2 0 0 1-2-2V4a2 2 0 0 1 2-2z"></path>
-                <path d="M12 16a2 2 0 0 1 2 2v2a2 2 0 0 1-2 2 2 2 0 0 1-2-2v-2a2 2 0 0 1 2-2z"></path>
-                <line x1="12" y1="8" x2="12" y2="16"></line>
-                <path d="M20 12a8 8 0 1 1-16 0"></path>
-            </svg>
-            """
-            # AI消息：渲染Markdown
-            md_content = markdown.markdown(content, extensions=['tables', 'fenced_code', 'codehilite'])
-            
-            st.markdown(f'''
-            <div class="message-row assistant">
-                <div class="avatar assistant">{avatar}</div>
-                <div class="message-content">
-                    <div class="message-label">{label}</div>
-                    <div class="message-bubble assistant">{md_content}</div>
-                </div>
-            </div>
-            ''', unsafe_allow_html=True)
+    # 显示对话历史：直接读取机器人的对话历史，不另存副本
+    for message in st.session_state.chatbot.get_conversation_history():
+        st.markdown(render_message(message["role"], message["content"]), unsafe_allow_html=True)
     
     if prompt := st.chat_input("请输入您的问题..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        st.markdown(render_message("user", prompt), unsafe_allow_html=True)
         
-        with st.spinner("思考中..."):
-            response = st.session_state.chatbot.chat(prompt)
+        # 流式输出：按固定间隔刷新助手气泡，刷新次数与回复长度无关
+        placeholder = st.empty()
+        placeholder.markdown(build_message_html("assistant", "思考中..."), unsafe_allow_html=True)
+        chunks = []
+        rendered_at = 0.0
+        for delta in st.session_state.chatbot.chat_stream(prompt):
+            chunks.append(delta)
+            now = time.monotonic()
+            if now - rendered_at >= Config.STREAM_RENDER_INTERVAL:
+                placeholder.markdown(build_message_html("assistant", "".join(chunks) + " ▌"), unsafe_allow_html=True)
+                rendered_at = now
+        placeholder.markdown(build_message_html("assistant", "".join(chunks)), unsafe_allow_html=True)
         
-        st.session_state.messages.append({"role": "assistant", "content": response})
-        st.rerun()
+        persist_live_session()
+        # 出错时机器人不记录助手消息，保留本次输出的错误提示，直到下一次交互
+        if st.session_state.chatbot.last_error is None:
+            st.rerun()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,494 @@
+"""
+追加式对话存储（自动保存）
+
+目录结构：
+    journal.<g>                 第 g 段共享日志：所有对话的记录按提交顺序追加，每行一条
+                                {"id": 对话 ID, "keep": k, "messages": [...]}，表示保留前 k 条消息后追加 messages；
+                                {"id": 对话 ID, "deleted": true} 表示对话已删除
+    snapshots/<id>.<g>.json     对话快照：已包含该对话在第 g 段之前的全部记录
+    index.db                    对话列表的元数据索引
+
+每轮对话只追加新增的消息，写入量与历史长度无关。所有会话的记录由同一个写线程成批写入当前日志段，
+一批只 fsync 一次，之后才唤醒这一批的所有调用方（组提交）。日志段超过大小上限后写线程切换到新的一段，
+后台压缩线程把已封存日志段中的记录折叠进各对话的快照，再删除这些日志段。
+load() 读取快照并重放其后的记录（内存中记录了它们在日志段中的位置）。
+进程启动时扫描尚未折叠的日志段重建位置表，崩溃时写了一半的最后一行会被截掉。
+
+同一存储目录只应由一个进程写入；其他进程（如分析报表）可以只读打开，只读打开不会截断日志或删除文件。
+
+    python append_log.py compact        # 把所有日志段折叠成快照
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+from messages import to_wire
+from storage import ConversationIndex, ConversationStore, conversation_id_from, summarize_history
+from session_store import new_session_id
+
+
+class _Batch:
+    """一次组提交：同一批写入的调用方共享完成事件和错误"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class _LogState:
+    """单个对话在本进程内的列表元数据，随记录增量更新"""
+
+    __slots__ = ("length", "turn_count", "preview", "created_at")
+
+    def __init__(self, history: List[Dict[str, str]], created_at: float):
+        self.length = len(history)
+        self.turn_count, self.preview = summarize_history(history)
+        self.created_at = created_at
+
+    def apply(self, keep: int, messages: List[Dict[str, str]]) -> bool:
+        """按记录更新元数据；记录截断了已有消息（需要重新统计）时返回 False"""
+        if keep == 0:
+            self.length, self.turn_count, self.preview = 0, 0, ""
+        elif keep < self.length:
+            return False
+        self.length = keep + len(messages)
+        turn_count, preview = summarize_history(messages)
+        self.turn_count += turn_count
+        self.preview = self.preview or preview
+        return True
+
+
+def _parse_generation(name: str, prefix: str, suffix: str = "") -> Optional[int]:
+    if not name.startswith(prefix) or not name.endswith(suffix):
+        return None
+    number = name[len(prefix):len(name) - len(suffix)]
+    return int(number) if number.isdigit() else None
+
+
+def _fsync_directory(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AppendLogStore(ConversationStore):
+    def __init__(self, directory: str = Config.AUTOSAVE_DIR,
+                 commit_delay: float = Config.AUTOSAVE_COMMIT_DELAY,
+                 compact_bytes: int = Config.AUTOSAVE_COMPACT_BYTES,
+                 compact_interval: float = Config.AUTOSAVE_COMPACT_INTERVAL,
+                 read_only: bool = False):
+        """
+        追加式对话存储，每轮持久化的开销为 O(1)
+
+        Args:
+            directory: 存储目录
+            commit_delay: 写线程开始一批提交前等待更多写入的时间（秒），0 表示只合并 fsync 期间到达的写入
+            compact_bytes: 日志段超过该字节数时切换到新的一段，旧段由后台线程折叠成快照
+            compact_interval: 后台压缩检查的间隔（秒）
+            read_only: 只读打开：末尾不完整的记录可能是写入进程正在追加的内容，只跳过不截断；
+                       能读到打开时已落盘的对话，写入方法抛出 RuntimeError
+        """
+        self.directory = directory
+        self.read_only = read_only
+        self.snapshot_dir = os.path.join(directory, "snapshots")
+        self.commit_delay = commit_delay
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self.index = ConversationIndex(os.path.join(directory, "index.db"))
+
+        # _lock 保护位置表和当前日志段；_compact_lock 保证读取期间日志段和快照不被删除
+        # 两把锁都需要时先取 _compact_lock
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._snapshots: Dict[str, int] = {}
+        self._records: Dict[str, List[Tuple[int, int, int]]] = {}
+        self._states: Dict[str, _LogState] = {}
+        self._segment = 0
+        self._segment_bytes = 0
+        self._fd: Optional[int] = None
+
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[str, Optional[int], Optional[List[Dict[str, str]]]]] = []
+        self._batch = _Batch()
+        self._sealed = threading.Event()
+        self._closed = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.commits = 0
+        self.fsyncs = 0
+        if read_only:
+            self._rescan()
+        else:
+            self._recover()
+
+    def _segment_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"journal.{generation}")
+
+    def _snapshot_path(self, conversation_id: str, generation: int) -> str:
+        return os.path.join(self.snapshot_dir, f"{conversation_id}.{generation}.json")
+
+    def _segments(self) -> List[int]:
+        return sorted(g for g in (_parse_generation(n, "journal.") for n in os.listdir(self.directory))
+                      if g is not None)
+
+    def _remove_snapshots(self, conversation_id: str):
+        for name in os.listdir(self.snapshot_dir):
+            if name.startswith(conversation_id + "."):
+                os.remove(os.path.join(self.snapshot_dir, name))
+
+    def _recover(self):
+        """扫描快照和尚未折叠的日志段，重建位置表，并截掉最后一段中写了一半的记录"""
+        for name in os.listdir(self.snapshot_dir):
+            conversation_id, _, rest = name.partition(".")
+            generation = _parse_generation(rest, "", ".json")
+            if generation is None:
+                continue  # 压缩时残留的临时文件
+            if generation > self._snapshots.get(conversation_id, -1):
+                self._snapshots[conversation_id] = generation
+
+        segments = self._segments()
+        for generation in segments:
+            path = self._segment_path(generation)
+            offset = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 崩溃时写了一半的记录
+                    record = json.loads(line)
+                    conversation_id = record["id"]
+                    if record.get("deleted"):
+                        # 删除标记落盘后、快照删除前崩溃时，在这里补删
+                        self._records.pop(conversation_id, None)
+                        if self._snapshots.pop(conversation_id, None) is not None and not self.read_only:
+                            self._remove_snapshots(conversation_id)
+                    elif generation >= self._snapshots.get(conversation_id, -1):
+                        self._records.setdefault(conversation_id, []).append((generation, offset, len(line)))
+                    offset += len(line)
+            if offset != os.path.getsize(path) and not self.read_only:
+                os.truncate(path, offset)
+            self._segment, self._segment_bytes = generation, offset
+        if self.read_only:
+            return
+
+        self._fd = os.open(self._segment_path(self._segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if not segments:
+            _fsync_directory(self.directory)
+        if len(segments) > 1:
+            self._sealed.set()  # 之前的日志段已封存，交给压缩线程折叠
+
+    def _rescan(self, attempts: int = 3):
+        """只读打开时重新扫描；写入进程的压缩线程可能在扫描途中删除日志段，此时从头再来"""
+        for attempt in range(attempts):
+            with self._lock:
+                self._snapshots, self._records = {}, {}
+            try:
+                self._recover()
+                return
+            except FileNotFoundError:
+                if attempt == attempts - 1:
+                    raise
+
+    def _exists(self, conversation_id: str) -> bool:
+        return conversation_id in self._records or conversation_id in self._snapshots
+
+    def _replay(self, conversation_id: str, before: Optional[int] = None) -> List[Dict[str, str]]:
+        """读取快照并重放其后的记录（只重放第 before 段之前的部分）；调用方持有 _compact_lock"""
+        with self._lock:
+            snapshot = self._snapshots.get(conversation_id)
+            records = list(self._records.get(conversation_id, ()))
+        history: List[Dict[str, str]] = []
+        if snapshot is not None:
+            with open(self._snapshot_path(conversation_id, snapshot), "r", encoding="utf-8") as f:
+                history = json.load(f)["messages"]
+        files = {}
+        try:
+            for generation, offset, length in records:
+                if before is not None and generation >= before:
+                    break
+                f = files.get(generation)
+                if f is None:
+                    f = files[generation] = open(self._segment_path(generation), "rb")
+                f.seek(offset)
+                record = json.loads(f.read(length))
+                del history[record["keep"]:]
+                history.extend(record["messages"])
+        finally:
+            for f in files.values():
+                f.close()
+        return history
+
+    def append(self, conversation_id: str, keep: int, messages: List[Dict[str, str]], wait: bool = True):
+        """
+        追加一条记录：保留前 keep 条消息后追加 messages
+
+        Args:
+            wait: 是否等到记录已 fsync 落盘再返回
+        Raises:
+            OSError: 写入或 fsync 失败（wait 为 True 时）
+        """
+        if not conversation_id or os.sep in conversation_id or "." in conversation_id:
+            raise ValueError(f"无效的对话 ID：{conversation_id}")
+        self._enqueue(conversation_id, keep, to_wire(messages), wait)
+
+    def _enqueue(self, conversation_id: str, keep: Optional[int], messages: Optional[List[Dict[str, str]]],
+                 wait: bool):
+        if self.read_only:
+            raise RuntimeError("存储以只读方式打开")
+        with self._cond:
+            if self._closed.is_set():
+                raise RuntimeError("存储已关闭")
+            if not self._threads:
+                self._start()
+            self._queue.append((conversation_id, keep, messages))
+            batch = self._batch
+            self._cond.notify()
+        if wait:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+
+    def _start(self):
+        for target, name in ((self._write_loop, "autosave-writer"), (self._compact_loop, "autosave-compactor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed.is_set():
+                    self._cond.wait()
+                if not self._queue:
+                    return
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self._cond:
+                records, self._queue = self._queue, []
+                batch, self._batch = self._batch, _Batch()
+            try:
+                self._commit(records)
+            except BaseException as e:
+                batch.error = e
+            batch.done.set()
+
+    def _commit(self, records: List[Tuple[str, Optional[int], Optional[List[Dict[str, str]]]]]):
+        """写入一批记录：一次 write、一次 fsync，索引在一个事务内更新"""
+        # 本进程第一次写入已有对话时先从磁盘恢复它的元数据（_states 只由写线程修改）
+        for conversation_id in {r[0] for r in records if r[2] is not None} - self._states.keys():
+            with self._compact_lock:
+                history = self._replay(conversation_id) if self._exists(conversation_id) else []
+            self._states[conversation_id] = _LogState(history, time.time())
+
+        lines = []
+        for conversation_id, keep, messages in records:
+            if messages is None:
+                record = {"id": conversation_id, "deleted": True}
+            else:
+                record = {"id": conversation_id, "keep": keep, "messages": messages}
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        data = b"".join(lines)
+
+        with self._lock:
+            generation, offset = self._segment, self._segment_bytes
+            try:
+                written = os.write(self._fd, data)
+                if written != len(data):
+                    raise OSError(f"日志写入不完整：{written}/{len(data)} 字节")
+                os.fsync(self._fd)
+            except OSError:
+                # 整批失败：截回批次开始处，保证位置表与文件一致
+                os.ftruncate(self._fd, offset)
+                raise
+            self.fsyncs += 1
+            self._segment_bytes += len(data)
+            for (conversation_id, _, messages), line in zip(records, lines):
+                if messages is None:
+                    self._records.pop(conversation_id, None)
+                    self._snapshots.pop(conversation_id, None)
+                else:
+                    self._records.setdefault(conversation_id, []).append((generation, offset, len(line)))
+                offset += len(line)
+            if self._segment_bytes >= self.compact_bytes:
+                self._rotate()
+        self.commits += 1
+
+        rows = {}
+        for conversation_id, keep, messages in records:
+            if messages is None:
+                self._states.pop(conversation_id, None)
+                rows.pop(conversation_id, None)
+                continue
+            state = self._states[conversation_id]
+            if not state.apply(keep, messages):
+                # 记录截断了已有消息（很少见）：重新统计
+                with self._compact_lock:
+                    history = self._replay(conversation_id)
+                state.length = len(history)
+                state.turn_count, state.preview = summarize_history(history)
+            rows[conversation_id] = (conversation_id, state.created_at, state.turn_count, state.preview)
+        if rows:
+            self.index.upsert_many(list(rows.values()))
+
+    def _rotate(self):
+        """切换到新的日志段，旧段从此不再变化（调用方持有 _lock）"""
+        fd = os.open(self._segment_path(self._segment + 1), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        _fsync_directory(self.directory)
+        os.close(self._fd)
+        self._fd = fd
+        self._segment += 1
+        self._segment_bytes = 0
+        self._sealed.set()
+
+    def _compact_loop(self):
+        while True:
+            self._sealed.wait(self.compact_interval)
+            if self._closed.is_set():
+                return
+            if self._sealed.is_set():
+                self._sealed.clear()
+                try:
+                    self._fold()
+                except OSError:
+                    self._sealed.set()  # 下一轮重试
+
+    def _fold(self) -> int:
+        """把已封存日志段中的记录折叠进快照并删除这些日志段，返回更新的快照数"""
+        with self._lock:
+            before = self._segment
+            touched = [cid for cid, records in self._records.items() if records[0][0] < before]
+        count = 0
+        for conversation_id in touched:
+            with self._compact_lock:
+                with self._lock:
+                    if conversation_id not in self._records:
+                        continue  # 期间被删除
+                    old = self._snapshots.get(conversation_id)
+                history = self._replay(conversation_id, before=before)
+                fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump({"messages": history}, f, ensure_ascii=False, separators=(",", ":"))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self._snapshot_path(conversation_id, before))
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                with self._lock:
+                    self._snapshots[conversation_id] = before
+                    remaining = [r for r in self._records.get(conversation_id, ()) if r[0] >= before]
+                    if remaining:
+                        self._records[conversation_id] = remaining
+                    else:
+                        self._records.pop(conversation_id, None)
+                if old is not None and old != before:
+                    os.remove(self._snapshot_path(conversation_id, old))
+                count += 1
+        # 快照落盘之后才能删除旧日志段
+        _fsync_directory(self.snapshot_dir)
+        with self._compact_lock:
+            for generation in self._segments():
+                if generation < before:
+                    os.remove(self._segment_path(generation))
+        _fsync_directory(self.directory)
+        return count
+
+    def compact(self) -> int:
+        """封存当前日志段并把全部记录折叠成快照，返回更新的快照数"""
+        if self.read_only:
+            raise RuntimeError("存储以只读方式打开")
+        self.flush()
+        with self._lock:
+            if self._segment_bytes:
+                self._rotate()
+        return self._fold()
+
+    def flush(self):
+        """等待已排队的记录全部落盘"""
+        with self._cond:
+            if not self._queue:
+                return
+            batch = self._batch
+        batch.done.wait()
+
+    def close(self):
+        """落盘剩余记录并停止后台线程"""
+        with self._cond:
+            self._closed.set()
+            self._cond.notify_all()
+        self._sealed.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def save(self, conversation_id: Optional[str], history: List[Dict[str, str]],
+             provider: str = "", model: str = "") -> str:
+        """整段保存：写入一条 keep=0 的记录，之后由压缩线程折叠"""
+        # 与其他后端一致，传入文件名或路径时取不带扩展名的文件名作为对话 ID
+        conversation_id = new_session_id() if conversation_id is None else conversation_id_from(conversation_id)
+        self.append(conversation_id, 0, history)
+        return conversation_id
+
+    def load(self, conversation_id: str) -> List[Dict[str, str]]:
+        conversation_id = conversation_id_from(conversation_id)
+        with self._compact_lock:
+            if not self._exists(conversation_id):
+                raise FileNotFoundError(f"Conversation not found: {conversation_id}")
+            try:
+                return self._replay(conversation_id)
+            except FileNotFoundError:
+                if not self.read_only:
+                    raise
+            # 只读打开时写入进程可能已把日志段折叠进新的快照并删除旧文件，重新扫描后再读
+            self._rescan()
+            if not self._exists(conversation_id):
+                raise FileNotFoundError(f"Conversation not found: {conversation_id}")
+            return self._replay(conversation_id)
+
+    def delete(self, conversation_id: str):
+        conversation_id = conversation_id_from(conversation_id)
+        if not self._exists(conversation_id):
+            raise FileNotFoundError(f"Conversation not found: {conversation_id}")
+        # 删除标记先落盘，重启扫描日志时才不会把对话恢复出来
+        self._enqueue(conversation_id, None, None, wait=True)
+        with self._compact_lock:
+            with self._lock:
+                # 压缩线程可能在删除标记提交前刚写完快照
+                self._snapshots.pop(conversation_id, None)
+                self._records.pop(conversation_id, None)
+            self._remove_snapshots(conversation_id)
+        self.index.remove(conversation_id)
+
+    def list_conversations(self, offset: int = 0, limit: int = 10) -> List[Dict]:
+        return self.index.page(offset, limit)
+
+    def count(self) -> int:
+        return self.index.count()
+
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        return self.index.iter_ids(start, end)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="追加式对话存储工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact = subparsers.add_parser("compact", help="把所有日志段折叠成快照")
+    compact.add_argument("--dir", default=Config.AUTOSAVE_DIR, help="存储目录")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        store = AppendLogStore(args.dir)
+        print(f"已折叠 {store.compact()} 个对话的快照")
+        store.close()
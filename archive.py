@@ -0,0 +1,501 @@
+"""
+对话归档层
+
+较早的对话从在线存储打包进只追加的压缩段文件，目录结构：
+    dictionary.<n>.bin      第 n 版共享字典：用系统提示词和对话中反复出现的措辞训练，作为 zlib 的预置字典
+    segment.<n>.zca         段文件：头部记录所用字典的版本，之后是逐个对话独立压缩的块（4 字节长度 + raw deflate）
+    index.db                偏移索引：对话 ID -> (段, 偏移, 长度)，以及列表所需的元数据
+
+每个对话单独压缩，读取时通过 mmap 定位到对应的块只解压这一块；共享字典让小块也能引用
+公共的提示词和措辞，弥补单独压缩损失的压缩率。段文件写完后不再修改，删除只移除索引行。
+
+open_store() 返回的存储会在在线存储找不到对话时回退到归档，列表同时包含两层的对话。
+
+    python archive.py pack --days 30     # 把 30 天前的对话打包进归档
+    python archive.py stats
+"""
+import argparse
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import Config
+from storage import ConversationStore, open_store, summarize_history, time_range, timestamp_from_id
+
+if TYPE_CHECKING:
+    from search_index import SearchIndex
+
+SEGMENT_MAGIC = b"PCA1"
+_HEADER = struct.Struct(">4sI")
+_LENGTH = struct.Struct(">I")
+_SENTENCE = re.compile(r"[^。！？!?\n]+[。！？!?\n]?")
+
+# JSON 骨架：每个块都会出现，放在字典末尾（离被压缩数据最近，引用代价最小）
+_SKELETON = ('{"id":"conversation_', '","timestamp":', ',"messages":[', '{"role":"system","content":"',
+             '"},{"role":"user","content":"', '"},{"role":"assistant","content":"', '"}]}')
+
+
+def _escape(text: str) -> str:
+    """与块中 JSON 编码一致的文本片段"""
+    return json.dumps(text, ensure_ascii=False)[1:-1]
+
+
+def train_dictionary(histories: Iterable[List[Dict[str, str]]], size: int = Config.ARCHIVE_DICT_SIZE,
+                     prompts: Iterable[str] = (Config.DEFAULT_SYSTEM_PROMPT,)) -> bytes:
+    """
+    从样本对话中训练共享字典
+
+    候选片段是整条消息（系统提示词、固定话术）和按句切分的片段，按 (出现次数 - 1) × 长度 打分，
+    只出现一次的片段对其他对话没有帮助。得分高的放在字典末尾。
+
+    Args:
+        histories: 样本对话
+        size: 字典字节数上限（zlib 只能引用最近 32KB）
+        prompts: 无论样本中是否出现都要收录的提示词
+    """
+    counts: Counter = Counter()
+    for history in histories:
+        for message in history:
+            content = message["content"]
+            counts[_escape(content)] += 1
+            for sentence in _SENTENCE.findall(content):
+                if len(sentence) >= 4 and sentence != content:
+                    counts[_escape(sentence)] += 1
+    scored = {fragment: (count - 1) * len(fragment.encode("utf-8"))
+              for fragment, count in counts.items() if count > 1}
+    for prompt in prompts:
+        fragment = _escape(prompt)
+        scored[fragment] = max(scored.get(fragment, 0), len(fragment.encode("utf-8")) * len(counts) + 1)
+
+    budget = size - sum(len(s.encode("utf-8")) for s in _SKELETON)
+    chosen: List[str] = []
+    text = ""
+    for fragment in sorted(scored, key=scored.get, reverse=True)[:4096]:
+        length = len(fragment.encode("utf-8"))
+        if length > budget or fragment in text:
+            continue
+        chosen.append(fragment)
+        text += fragment
+        budget -= length
+    return "".join(reversed(chosen)).encode("utf-8") + "".join(_SKELETON).encode("utf-8")
+
+
+class ConversationArchive:
+    def __init__(self, directory: str = Config.ARCHIVE_DIR,
+                 level: int = Config.ARCHIVE_COMPRESSION_LEVEL,
+                 segment_bytes: int = Config.ARCHIVE_SEGMENT_BYTES):
+        """
+        压缩段文件组成的只读归档
+
+        目录在第一次打包时才创建，尚未归档时所有查询都直接返回空结果。
+
+        Args:
+            directory: 归档目录
+            level: zlib 压缩级别
+            segment_bytes: 单个段文件的目标大小，超过后开始新的一段
+        """
+        self.directory = directory
+        self.level = level
+        self.segment_bytes = segment_bytes
+        self.index_path = os.path.join(directory, "index.db")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._dictionaries: Dict[int, bytes] = {}
+
+    def _connect(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if not create and not os.path.exists(self.index_path):
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS archived (
+                        id TEXT PRIMARY KEY,
+                        segment INTEGER NOT NULL,
+                        offset INTEGER NOT NULL,
+                        length INTEGER NOT NULL,
+                        raw_length INTEGER NOT NULL,
+                        timestamp REAL NOT NULL,
+                        turn_count INTEGER NOT NULL,
+                        preview TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_archived_timestamp ON archived(timestamp);
+                    CREATE TABLE IF NOT EXISTS deleted (id TEXT PRIMARY KEY);
+                """)
+            self._local.conn = conn
+        return conn
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment.{segment}.zca")
+
+    def _dictionary_path(self, dictionary_id: int) -> str:
+        return os.path.join(self.directory, f"dictionary.{dictionary_id}.bin")
+
+    def _numbered(self, prefix: str, suffix: str) -> List[int]:
+        if not os.path.isdir(self.directory):
+            return []
+        numbers = []
+        for name in os.listdir(self.directory):
+            number = name[len(prefix):-len(suffix)] if name.startswith(prefix) and name.endswith(suffix) else ""
+            if number.isdigit():
+                numbers.append(int(number))
+        return sorted(numbers)
+
+    def _map(self, segment: int) -> mmap.mmap:
+        """段文件只读映射，打开后一直复用（段文件写完后不再变化）"""
+        mapped = self._maps.get(segment)
+        if mapped is None:
+            with self._lock:
+                mapped = self._maps.get(segment)
+                if mapped is None:
+                    with open(self._segment_path(segment), "rb") as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[segment] = mapped
+        return mapped
+
+    def dictionary(self, dictionary_id: int) -> bytes:
+        if dictionary_id == 0:
+            return b""
+        data = self._dictionaries.get(dictionary_id)
+        if data is None:
+            with open(self._dictionary_path(dictionary_id), "rb") as f:
+                data = f.read()
+            self._dictionaries[dictionary_id] = data
+        return data
+
+    def latest_dictionary(self) -> int:
+        """最新一版字典的编号，没有字典时为 0"""
+        return (self._numbered("dictionary.", ".bin") or [0])[-1]
+
+    def add_dictionary(self, data: bytes) -> int:
+        """保存一版新字典并返回编号；已有的段文件继续使用各自的字典"""
+        os.makedirs(self.directory, exist_ok=True)
+        dictionary_id = self.latest_dictionary() + 1
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._dictionary_path(dictionary_id))
+        self._dictionaries[dictionary_id] = data
+        return dictionary_id
+
+    def _decompress(self, segment: int, offset: int, length: int) -> Dict:
+        mapped = self._map(segment)
+        _, dictionary_id = _HEADER.unpack_from(mapped, 0)
+        zdict = self.dictionary(dictionary_id)
+        decompressor = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+        return json.loads(decompressor.decompress(mapped[offset:offset + length]))
+
+    def pack(self, conversations: Iterable[Tuple[str, float, List[Dict[str, str]]]],
+             dictionary_id: Optional[int] = None) -> int:
+        """
+        把 (对话 ID, 时间戳, 历史) 依次写入新的段文件，返回归档的对话数
+
+        段文件 fsync 并改名到位之后才写入索引，中途失败不会留下指向不完整数据的索引行。
+        已归档的对话再次打包时以新的块为准。
+        """
+        if dictionary_id is None:
+            dictionary_id = self.latest_dictionary()
+        zdict = self.dictionary(dictionary_id)
+        conn = self._connect(create=True)
+        segment = (self._numbered("segment.", ".zca") or [0])[-1] + 1
+        total = 0
+        f = None
+        tmp_path = None
+        rows = []
+        try:
+            for conversation_id, timestamp, history in conversations:
+                if f is None:
+                    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                    f = os.fdopen(fd, "wb")
+                    f.write(_HEADER.pack(SEGMENT_MAGIC, dictionary_id))
+                raw = json.dumps({"id": conversation_id, "timestamp": timestamp, "messages": history},
+                                 ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=zdict) if zdict \
+                    else zlib.compressobj(self.level, zlib.DEFLATED, -15)
+                block = compressor.compress(raw) + compressor.flush()
+                f.write(_LENGTH.pack(len(block)))
+                turn_count, preview = summarize_history(history)
+                rows.append((conversation_id, segment, f.tell(), len(block), len(raw), timestamp, turn_count, preview))
+                f.write(block)
+                if f.tell() >= self.segment_bytes:
+                    total += self._seal(f, tmp_path, segment, rows, conn)
+                    f, tmp_path, rows = None, None, []
+                    segment += 1
+            if f is not None:
+                total += self._seal(f, tmp_path, segment, rows, conn)
+                f, tmp_path = None, None
+        finally:
+            if f is not None:
+                f.close()
+                os.remove(tmp_path)
+        return total
+
+    def _seal(self, f, tmp_path: str, segment: int, rows: List[tuple], conn: sqlite3.Connection) -> int:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(tmp_path, self._segment_path(segment))
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO archived (id, segment, offset, length, raw_length, timestamp, turn_count, preview) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.executemany("DELETE FROM deleted WHERE id = ?", [(row[0],) for row in rows])
+        return len(rows)
+
+    def load(self, conversation_id: str) -> List[Dict[str, str]]:
+        conn = self._connect()
+        row = conn and conn.execute(
+            "SELECT segment, offset, length FROM archived WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if not row:
+            raise FileNotFoundError(f"Conversation not found: {conversation_id}")
+        return self._decompress(*row)["messages"]
+
+    def contains(self, conversation_id: str) -> bool:
+        conn = self._connect()
+        return bool(conn and conn.execute("SELECT 1 FROM archived WHERE id = ?", (conversation_id,)).fetchone())
+
+    def delete(self, conversation_id: str) -> bool:
+        """从索引中移除对话（段文件中的数据不再可达，重建索引时也会跳过），对话不存在时返回 False"""
+        conn = self._connect()
+        if conn is None:
+            return False
+        with conn:
+            if conn.execute("DELETE FROM archived WHERE id = ?", (conversation_id,)).rowcount == 0:
+                return False
+            conn.execute("INSERT OR IGNORE INTO deleted (id) VALUES (?)", (conversation_id,))
+        return True
+
+    def list_conversations(self, offset: int = 0, limit: int = 10) -> List[Dict]:
+        conn = self._connect()
+        if conn is None:
+            return []
+        rows = conn.execute(
+            "SELECT id, timestamp, turn_count, preview FROM archived "
+            "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+        return [{"id": r[0], "timestamp": r[1], "turn_count": r[2], "preview": r[3]} for r in rows]
+
+    def count(self) -> int:
+        conn = self._connect()
+        return conn.execute("SELECT COUNT(*) FROM archived").fetchone()[0] if conn else 0
+
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        conn = self._connect()
+        if conn is None:
+            return
+        where, params = time_range("timestamp", start, end)
+        yield from conn.execute(f"SELECT id, timestamp FROM archived{where}", params)
+
+    def iter_conversations(self) -> Iterator[Tuple[str, float, List[Dict[str, str]]]]:
+        """按段内顺序遍历所有已归档的对话 (对话 ID, 时间戳, 历史)"""
+        conn = self._connect()
+        if conn is None:
+            return
+        rows = conn.execute("SELECT segment, offset, length FROM archived ORDER BY segment, offset").fetchall()
+        for row in rows:
+            record = self._decompress(*row)
+            yield record["id"], record["timestamp"], record["messages"]
+
+    def rebuild_index(self) -> int:
+        """扫描全部段文件重建偏移索引（后写入的段覆盖先前的块，已删除的对话跳过），返回索引的对话数"""
+        conn = self._connect(create=True)
+        with conn:
+            conn.execute("DELETE FROM archived")
+        deleted = {row[0] for row in conn.execute("SELECT id FROM deleted")}
+        for segment in self._numbered("segment.", ".zca"):
+            mapped = self._map(segment)
+            magic, _ = _HEADER.unpack_from(mapped, 0)
+            if magic != SEGMENT_MAGIC:
+                continue
+            rows = []
+            position = _HEADER.size
+            while position + _LENGTH.size <= len(mapped):
+                (length,) = _LENGTH.unpack_from(mapped, position)
+                position += _LENGTH.size
+                record = self._decompress(segment, position, length)
+                if record["id"] in deleted:
+                    position += length
+                    continue
+                turn_count, preview = summarize_history(record["messages"])
+                raw_length = len(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                rows.append((record["id"], segment, position, length, raw_length, record["timestamp"],
+                             turn_count, preview))
+                position += length
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO archived (id, segment, offset, length, raw_length, timestamp, "
+                    "turn_count, preview) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        return self.count()
+
+    def stats(self) -> Dict:
+        conn = self._connect()
+        conversations, stored, raw = (conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0), COALESCE(SUM(raw_length), 0) FROM archived"
+        ).fetchone() if conn else (0, 0, 0))
+        segments = self._numbered("segment.", ".zca")
+        return {
+            "conversations": conversations,
+            "segments": len(segments),
+            "segment_bytes": sum(os.path.getsize(self._segment_path(s)) for s in segments),
+            "raw_bytes": raw,
+            "compressed_bytes": stored,
+            "ratio": raw / stored if stored else 0.0,
+            "dictionary": self.latest_dictionary()
+        }
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+
+class TieredStore(ConversationStore):
+    def __init__(self, live: ConversationStore, archive: ConversationArchive,
+                 search: Optional["SearchIndex"] = None):
+        """
+        在线存储 + 归档的组合：写入只进在线存储，读取在线存储找不到时回退到归档，列表合并两层
+
+        提供 search 时，保存、追加和删除同步更新全文检索索引（归档不改变对话 ID，索引无需变化）。
+        其他属性直接转发给在线存储。
+        """
+        self.live = live
+        self.archive = archive
+        self.search = search
+        if hasattr(live, "append"):
+            # 只有在线存储支持追加时才提供 append（自动保存据此判断）
+            self.append = self._append
+
+    def __getattr__(self, name):
+        return getattr(self.live, name)
+
+    def save(self, conversation_id: Optional[str], history: List[Dict[str, str]],
+             provider: str = "", model: str = "") -> str:
+        saved = self.live.save(conversation_id, history, provider, model)
+        # JSON 文件存储返回文件路径，列表和加载使用的 ID 是文件名；存储目录外的文件不在列表中，也不进入检索
+        key = self.live.listed_id(saved)
+        if self.search is not None and key is not None:
+            self.search.index_conversation(key, history, timestamp_from_id(key), provider, model)
+        return saved
+
+    def _append(self, conversation_id: str, keep: int, messages: List[Dict[str, str]], wait: bool = True):
+        self.live.append(conversation_id, keep, messages, wait)
+        if self.search is not None:
+            self.search.update(conversation_id, keep, messages)
+
+    def load(self, conversation_id: str) -> List[Dict[str, str]]:
+        try:
+            return self.live.load(conversation_id)
+        except FileNotFoundError:
+            return self.archive.load(conversation_id)
+
+    def delete(self, conversation_id: str):
+        try:
+            self.live.delete(conversation_id)
+        except FileNotFoundError:
+            if not self.archive.delete(conversation_id):
+                raise
+        else:
+            self.archive.delete(conversation_id)
+        if self.search is not None:
+            self.search.remove(conversation_id)
+
+    def list_conversations(self, offset: int = 0, limit: int = 10) -> List[Dict]:
+        # 两层各取前 offset + limit 条再归并；打包中途崩溃时可能两层都有，以在线存储为准
+        live = self.live.list_conversations(0, offset + limit)
+        seen = {item["id"] for item in live}
+        archived = [item for item in self.archive.list_conversations(0, offset + limit) if item["id"] not in seen]
+        merged = sorted(live + archived, key=lambda item: (item["timestamp"], item["id"]), reverse=True)
+        return merged[offset:offset + limit]
+
+    def count(self) -> int:
+        return self.live.count() + self.archive.count()
+
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        # 与 count() 一致直接串联两层（只有打包中途崩溃时同一对话才会两层都有）
+        yield from self.live.iter_ids(start, end)
+        yield from self.archive.iter_ids(start, end)
+
+
+def archive_conversations(store: ConversationStore, archive: ConversationArchive, before: float,
+                          retrain: bool = False, sample_size: int = 2000) -> int:
+    """
+    把在线存储中早于 before 的对话打包进归档并从在线存储删除，返回归档的对话数
+
+    归档还没有字典（或 retrain 为 True）时，先用待归档对话中最多 sample_size 个训练一版。
+    """
+    # open_store() 返回的存储叠加了归档层，只从其中的在线存储挑选和删除
+    store = getattr(store, "live", store)
+    candidates = []
+    offset, page = 0, 500
+    while True:
+        items = store.list_conversations(offset, page)
+        candidates.extend((item["id"], item["timestamp"]) for item in items if item["timestamp"] < before)
+        if len(items) < page:
+            break
+        offset += page
+    if not candidates:
+        return 0
+    candidates.reverse()  # 从最早的开始，段内按时间排列
+
+    dictionary_id = archive.latest_dictionary()
+    if retrain or dictionary_id == 0:
+        step = max(1, len(candidates) // sample_size)
+        sample = [store.load(conversation_id) for conversation_id, _ in candidates[::step][:sample_size]]
+        dictionary_id = archive.add_dictionary(train_dictionary(sample))
+
+    packed = archive.pack(((cid, timestamp, store.load(cid)) for cid, timestamp in candidates), dictionary_id)
+    for conversation_id, _ in candidates:
+        store.delete(conversation_id)
+    return packed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对话归档工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser("pack", help="把较早的对话打包进归档")
+    pack.add_argument("--days", type=float, default=Config.ARCHIVE_AFTER_DAYS, help="归档多少天之前的对话")
+    pack.add_argument("--backend", default=Config.CONVERSATION_STORAGE, help="在线存储后端")
+    pack.add_argument("--retrain", action="store_true", help="用本次待归档的对话训练新一版字典")
+    subparsers.add_parser("stats", help="查看归档大小和压缩率")
+    subparsers.add_parser("rebuild-index", help="扫描段文件重建偏移索引")
+    args = parser.parse_args()
+
+    archive = ConversationArchive(Config.ARCHIVE_DIR)
+    if args.command == "pack":
+        before = time.time() - args.days * 86400
+        packed = archive_conversations(open_store(args.backend), archive, before, args.retrain)
+        print(f"已归档 {packed} 个对话")
+    elif args.command == "stats":
+        stats = archive.stats()
+        print(f"{stats['conversations']} 个对话，{stats['segments']} 个段文件，"
+              f"原始 {stats['raw_bytes'] / 1024:.1f} KB，压缩后 {stats['compressed_bytes'] / 1024:.1f} KB，"
+              f"压缩率 {stats['ratio']:.1f}x，字典版本 {stats['dictionary']}")
+    elif args.command == "rebuild-index":
+        print(f"已索引 {archive.rebuild_index()} 个对话")
@@ -0,0 +1,303 @@
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+from chatbot import CustomerServiceChatbot, deepseek_error, parse_sse_line
+from metrics import note_first_byte, note_usage
+from config import Config
+from context_window import estimate_tokens
+
+
+class AsyncCustomerServiceChatbot(CustomerServiceChatbot):
+    def __init__(self, api_key: str = None, model: str = "gpt-3.5-turbo",
+                 provider: str = "openai", base_url: Optional[str] = None,
+                 session: Optional[aiohttp.ClientSession] = None, **kwargs):
+        """
+        基于 asyncio 的智能客服机器人
+
+        对话历史、保存/加载和系统提示词的行为与 CustomerServiceChatbot 完全一致，
+        只是提供商调用改为非阻塞，单个事件循环即可同时处理大量对话。
+
+        Args:
+            api_key: API密钥（OpenAI或DeepSeek）
+            model: 模型名称
+            provider: API提供商 ("openai" 或 "deepseek")
+            base_url: 自定义API基础URL（可选）
+            session: 共享的 aiohttp.ClientSession（可选，多个机器人共用一个连接池）
+            **kwargs: 其余参数（如 context_window）原样传给 CustomerServiceChatbot
+        """
+        super().__init__(api_key=api_key, model=model, provider=provider, base_url=base_url, **kwargs)
+        self._session = session
+        self._owns_session = session is None
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(
+                connect=Config.HTTP_CONNECT_TIMEOUT,
+                sock_read=Config.HTTP_READ_TIMEOUT
+            ), trace_configs=[self.metrics.aiohttp_trace_config()] if self.metrics is not None else None)
+            self._owns_session = True
+        return self._session
+    
+    async def aclose(self):
+        """关闭自行创建的 HTTP 会话（外部传入的会话由调用方负责关闭）"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+    
+    async def achat(self, user_message: str, use_cache: bool = True) -> str:
+        self.conversation_history.append({
+            "role": "user",
+            "content": user_message
+        })
+        self.last_error = None
+        self.last_call = None
+        
+        cache_key, cached = self._lookup_cache(use_cache)
+        if cached is not None:
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": cached
+            })
+            await self._aautosave_turn()
+            return cached
+        
+        try:
+            assistant_message = await self._acoalesced_call()
+            
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": assistant_message
+            })
+            self._store_cache(cache_key, assistant_message)
+        
+        except Exception as e:
+            self.last_error = e
+            error_message = f"抱歉，发生了错误：{str(e)}"
+            return error_message
+        
+        await self._aautosave_turn()
+        return assistant_message
+    
+    async def achat_stream(self, user_message: str, use_cache: bool = True) -> AsyncIterator[str]:
+        """异步流式对话，语义与 chat_stream 相同"""
+        self.conversation_history.append({
+            "role": "user",
+            "content": user_message
+        })
+        self.last_error = None
+        self.last_call = None
+        
+        cache_key, cached = self._lookup_cache(use_cache)
+        if cached is not None:
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": cached
+            })
+            await self._aautosave_turn()
+            yield cached
+            return
+        
+        chunks = []
+        try:
+            async for delta in self._acoalesced_stream():
+                chunks.append(delta)
+                yield delta
+            
+            assistant_message = "".join(chunks)
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": assistant_message
+            })
+            self._store_cache(cache_key, assistant_message)
+        
+        except Exception as e:
+            self.last_error = e
+            yield f"抱歉，发生了错误：{str(e)}"
+            return
+        
+        await self._aautosave_turn()
+    
+    async def _aautosave_turn(self):
+        """在线程池中等待自动保存落盘，不阻塞事件循环"""
+        if self.autosave:
+            await asyncio.to_thread(self._autosave_turn)
+    
+    async def _acoalesced_call(self) -> str:
+        if self.single_flight is None:
+            return await self._acall_provider()
+        start = time.perf_counter()
+        result = await self.single_flight.ado("call:" + self._request_fingerprint(), self._acall_provider)
+        self._note_coalesced(start)
+        return result
+    
+    def _acoalesced_stream(self) -> AsyncIterator[str]:
+        if self.single_flight is None:
+            return self._astream_provider()
+        return self._anoting_coalesced(
+            self.single_flight.astream("stream:" + self._request_fingerprint(), self._astream_provider)
+        )
+    
+    async def _anoting_coalesced(self, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        first_token = None
+        async for delta in deltas:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            yield delta
+        self._note_coalesced(start, stream=True, first_token=first_token)
+    
+    def _astream_provider(self) -> AsyncIterator[str]:
+        if self.router is not None:
+            messages = self._request_messages()
+            factory = lambda: self._aiter_in_thread(self.router.stream(messages))
+        elif self.provider == "openai":
+            factory = self._astream_openai
+        elif self.provider == "deepseek":
+            factory = self._astream_deepseek
+        else:
+            raise ValueError(f"Unsupported provider: {self.provider}")
+        
+        if self.metrics is not None:
+            factory = self._ainstrumented_stream(factory)
+        if self.scheduler is not None:
+            factory = self._ascheduled_stream(factory)
+        
+        if self.resilience is None:
+            return factory()
+        return self.resilience.acall_stream(factory)
+    
+    @staticmethod
+    async def _aiter_in_thread(iterator) -> AsyncIterator[str]:
+        """逐段在线程池中推进同步迭代器（路由器的流式调用是同步的）"""
+        done = object()
+        while True:
+            delta = await asyncio.to_thread(next, iterator, done)
+            if delta is done:
+                return
+            yield delta
+    
+    async def _acall_provider(self) -> str:
+        if self.router is not None:
+            # 路由器的后端调用是同步的，放到线程池中执行
+            messages = self._request_messages()
+            call = lambda: asyncio.to_thread(self.router.complete, messages)
+        elif self.provider == "openai":
+            call = self._achat_openai
+        elif self.provider == "deepseek":
+            call = self._achat_deepseek
+        else:
+            raise ValueError(f"Unsupported provider: {self.provider}")
+        
+        if self.metrics is not None:
+            call = self._ainstrumented(call)
+        if self.scheduler is not None:
+            call = self._ascheduled(call)
+        
+        if self.resilience is None:
+            return await call()
+        return await self.resilience.acall(call)
+    
+    def _ainstrumented(self, call):
+        """_instrumented 的异步版本"""
+        async def instrumented():
+            span = self.metrics.span(self.provider, self.model)
+            try:
+                with span:
+                    result = await call()
+                    self._fill_usage(span, result)
+                return result
+            finally:
+                self.last_call = span.record()
+        return instrumented
+    
+    def _ainstrumented_stream(self, factory):
+        async def instrumented() -> AsyncIterator[str]:
+            span = self.metrics.span(self.provider, self.model, stream=True)
+            chunks = []
+            try:
+                with span:
+                    async for delta in factory():
+                        span.mark_token()
+                        chunks.append(delta)
+                        yield delta
+                    self._fill_usage(span, "".join(chunks))
+            finally:
+                self.last_call = span.record()
+        return instrumented
+    
+    def _ascheduled(self, call):
+        """异步版本的配额申请包装，阻塞等待放到线程中进行"""
+        async def scheduled():
+            reserved = self._estimate_request_tokens()
+            await asyncio.to_thread(self.scheduler.acquire, reserved, self.priority)
+            try:
+                result = await call()
+            except Exception:
+                self.scheduler.adjust(-reserved)
+                raise
+            self.scheduler.adjust(estimate_tokens(result) - self.max_tokens)
+            return result
+        return scheduled
+    
+    def _ascheduled_stream(self, factory):
+        """_scheduled_stream 的异步版本"""
+        async def scheduled() -> AsyncIterator[str]:
+            reserved = self._estimate_request_tokens()
+            await asyncio.to_thread(self.scheduler.acquire, reserved, self.priority)
+            chunks = []
+            try:
+                async for delta in factory():
+                    chunks.append(delta)
+                    yield delta
+            except Exception:
+                self.scheduler.adjust(self._stream_usage_delta(chunks, reserved))
+                raise
+            self.scheduler.adjust(self._stream_usage_delta(chunks, reserved))
+        return scheduled
+    
+    async def _achat_openai(self) -> str:
+        """使用OpenAI API进行异步对话"""
+        import openai
+        response = await openai.ChatCompletion.acreate(**self._openai_request())
+        note_usage(response.get("usage"))
+        return response.choices[0].message.content
+    
+    async def _astream_openai(self) -> AsyncIterator[str]:
+        """使用OpenAI API进行异步流式对话"""
+        import openai
+        response = await openai.ChatCompletion.acreate(**self._openai_request(stream=True))
+        async for chunk in response:
+            delta = chunk.choices[0].delta.get("content")
+            if delta:
+                yield delta
+    
+    async def _achat_deepseek(self) -> str:
+        """使用DeepSeek API进行异步对话"""
+        url, headers, data = self._deepseek_request()
+        session = await self._get_session()
+        async with session.post(url, headers=headers, json=data) as response:
+            # 外部传入的会话没有挂载追踪回调，在收到响应头时记录首字节时间
+            note_first_byte()
+            if response.status != 200:
+                raise deepseek_error(response.status, await response.text(), response.headers.get("Retry-After"))
+            result = await response.json()
+        note_usage(result.get("usage"))
+        return result["choices"][0]["message"]["content"]
+    
+    async def _astream_deepseek(self) -> AsyncIterator[str]:
+        """使用DeepSeek API进行异步流式对话（SSE）"""
+        url, headers, data = self._deepseek_request(stream=True)
+        session = await self._get_session()
+        async with session.post(url, headers=headers, json=data) as response:
+            note_first_byte()
+            if response.status != 200:
+                raise deepseek_error(response.status, await response.text(), response.headers.get("Retry-After"))
+            
+            async for raw_line in response.content:
+                delta = parse_sse_line(raw_line.decode("utf-8").strip())
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
@@ -0,0 +1,214 @@
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List
+
+from chatbot import CustomerServiceChatbot
+from rate_limiter import PRIORITY_BATCH
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩法计算百分位数，输入需已排序"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        """
+        简单的全局速率限制：所有线程合计每秒最多 rate 次请求
+
+        Args:
+            rate: 每秒请求数（<= 0 表示不限制）
+        """
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def read_conversations(filename: str) -> Iterator[Dict]:
+    """
+    读取批量输入 JSONL，每行一个对话：
+    {"id": "...", "turns": ["问题1", "问题2"], "system_prompt": "...（可选）"}
+    只有一个问题时也可写成 {"id": "...", "question": "..."}
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item.setdefault("id", str(line_no))
+            if "turns" not in item:
+                item["turns"] = [item["question"]]
+            yield item
+
+
+def read_finished_ids(filename: str) -> set:
+    """
+    读取已有输出中成功完成的对话 ID，用于断点续跑（忽略崩溃时写了一半的行）
+
+    带 error 的行不算完成，续跑时会重新执行，避免中途故障导致的失败被永久跳过
+    """
+    finished = set()
+    if not os.path.exists(filename):
+        return finished
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+                if row.get("error") is None:
+                    finished.add(row["id"])
+            except (ValueError, KeyError):
+                continue
+    return finished
+
+
+class BatchRunner:
+    def __init__(self, bot_factory, workers: int = 8, rate: float = 0.0):
+        """
+        批量对话执行器：按有限并发把脚本化对话送入机器人，结果完成即写出
+
+        Args:
+            bot_factory: 无参函数，返回一个新的 CustomerServiceChatbot
+            workers: 并发线程数
+            rate: 全局每秒请求数上限（0 表示不限制）
+        """
+        self.bot_factory = bot_factory
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.latencies: List[float] = []
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+    
+    def run_conversation(self, item: Dict) -> Dict:
+        bot = self.bot_factory()
+        if item.get("system_prompt"):
+            bot.set_system_prompt(item["system_prompt"])
+        
+        turns = []
+        error = None
+        for question in item["turns"]:
+            self.limiter.acquire()
+            start = time.perf_counter()
+            answer = bot.chat(question)
+            latency = time.perf_counter() - start
+            turns.append({"user": question, "assistant": answer, "latency": round(latency, 4)})
+            with self._lock:
+                self.latencies.append(latency)
+            if bot.last_error is not None:
+                error = str(bot.last_error)
+                break
+        
+        return {"id": item["id"], "turns": turns, "error": error}
+    
+    def run(self, input_file: str, output_file: str) -> Dict:
+        """执行批量任务并返回统计信息；输出文件中已成功完成的对话会被跳过，失败的对话重新执行"""
+        finished = read_finished_ids(output_file)
+        pending = [item for item in read_conversations(input_file) if item["id"] not in finished]
+        
+        # 崩溃时最后一行可能没有换行符，续写前补上
+        if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+            with open(output_file, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        else:
+            needs_newline = False
+        
+        start = time.perf_counter()
+        with open(output_file, 'a', encoding='utf-8') as out, ThreadPoolExecutor(self.workers) as pool:
+            if needs_newline:
+                out.write("\n")
+            futures = [pool.submit(self._run_safely, item) for item in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                with self._lock:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    self.completed += 1
+                    if result["error"]:
+                        self.failed += 1
+        elapsed = time.perf_counter() - start
+        
+        return self.stats(elapsed, skipped=len(finished))
+    
+    def _run_safely(self, item: Dict) -> Dict:
+        try:
+            return self.run_conversation(item)
+        except Exception as e:
+            return {"id": item["id"], "turns": [], "error": str(e)}
+    
+    def stats(self, elapsed: float, skipped: int = 0) -> Dict:
+        latencies = sorted(self.latencies)
+        return {
+            "conversations": self.completed,
+            "failed": self.failed,
+            "skipped": skipped,
+            "turns": len(latencies),
+            "elapsed": elapsed,
+            "conversations_per_second": self.completed / elapsed if elapsed else 0.0,
+            "turns_per_second": len(latencies) / elapsed if elapsed else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99)
+        }
+
+
+def print_report(stats: Dict):
+    print("=" * 40)
+    print(f"完成对话: {stats['conversations']}（失败 {stats['failed']}，跳过已完成 {stats['skipped']}）")
+    print(f"总轮数: {stats['turns']}，耗时 {stats['elapsed']:.2f}s")
+    print(f"吞吐: {stats['conversations_per_second']:.2f} 对话/秒，{stats['turns_per_second']:.2f} 轮/秒")
+    print(f"单轮延迟: p50 {stats['p50'] * 1000:.0f}ms  p95 {stats['p95'] * 1000:.0f}ms  p99 {stats['p99'] * 1000:.0f}ms")
+    print("=" * 40)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量运行脚本化对话")
+    parser.add_argument("input", help="输入 JSONL 文件")
+    parser.add_argument("output", help="输出 JSONL 文件（已存在时断点续跑）")
+    parser.add_argument("--provider", default="deepseek", choices=["openai", "deepseek"])
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--base-url", default=None)
+    parser.add_argument("--workers", type=int, default=8, help="并发线程数")
+    parser.add_argument("--rate", type=float, default=0.0, help="每秒请求数上限（0 不限制）")
+    parser.add_argument("--stub", action="store_true", help="使用本地模拟服务代替真实 API")
+    parser.add_argument("--stub-latency", type=float, default=0.2, help="模拟服务的响应延迟（秒）")
+    args = parser.parse_args()
+    
+    server = None
+    api_key, base_url = args.api_key, args.base_url
+    if args.stub:
+        from stub_server import StubServer
+        server = StubServer(latency=args.stub_latency).start()
+        api_key, base_url = "stub-key", server.base_url
+    
+    runner = BatchRunner(
+        lambda: CustomerServiceChatbot(api_key=api_key, model=args.model, provider=args.provider,
+                                       base_url=base_url, priority=PRIORITY_BATCH, autosave=False),
+        workers=args.workers,
+        rate=args.rate
+    )
+    try:
+        print_report(runner.run(args.input, args.output))
+    finally:
+        if server is not None:
+            server.stop()
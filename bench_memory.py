@@ -0,0 +1,90 @@
+"""
+会话内存占用基准
+
+在同一进程中构造大量会话，用 tracemalloc 比较每个会话占用的内存：
+- 原布局：消息为 dict，界面另存一份消息列表，每个会话持有自己的系统提示词副本
+- 紧凑布局：消息为 Message，界面与机器人共用同一份历史，系统提示词按内容共享
+
+    python bench_memory.py --sessions 10000 --turns 0,5,20
+"""
+import argparse
+import gc
+import tracemalloc
+from typing import Callable, Dict, List
+
+from chatbot import CustomerServiceChatbot
+from messages import MessageList
+
+
+SYSTEM_PROMPT = CustomerServiceChatbot(api_key="bench", provider="deepseek", base_url="http://127.0.0.1",
+                                       warm_up=False).system_prompt
+QUESTION = "我的订单 {i} 显示已发货，但是物流三天没有更新，怎么办？"
+ANSWER = ("您好，很抱歉给您带来不便。物流信息可能因中转延迟暂未更新，建议您再等待 24 小时；"
+          "如仍未更新，请提供订单号 {i}，我们会联系快递公司核实并第一时间回复您。")
+
+
+def fresh(text: str) -> str:
+    """生成内容相同但对象独立的字符串，模拟从存储或网络读回的会话数据"""
+    return "".join(list(text))
+
+
+def session_messages(i: int, turns: int) -> List[Dict[str, str]]:
+    messages = [{"role": fresh("system"), "content": fresh(SYSTEM_PROMPT)}]
+    for t in range(turns):
+        messages.append({"role": fresh("user"), "content": QUESTION.format(i=f"{i}-{t}")})
+        messages.append({"role": fresh("assistant"), "content": ANSWER.format(i=f"{i}-{t}")})
+    return messages
+
+
+def legacy_session(i: int, turns: int):
+    """原有布局：dict 历史 + 界面另存的一份 dict 列表 + 每个会话自己的系统提示词"""
+    history = session_messages(i, turns)
+    ui_messages = [{"role": m["role"], "content": m["content"]} for m in history[1:]]
+    return history, ui_messages, history[0]["content"]
+
+
+def compact_session(i: int, turns: int):
+    """紧凑布局：Message 历史、界面直接读取同一份列表、系统提示词按内容共享"""
+    history = MessageList(session_messages(i, turns))
+    return history, history[0].content
+
+
+def measure(build: Callable[[int, int], object], sessions: int, turns: int) -> float:
+    """返回平均每个会话占用的字节数（只统计会话数据本身）"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(i, turns) for i in range(sessions)]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / sessions
+
+
+def run(sessions: int, turns_list: List[int]) -> List[Dict]:
+    results = []
+    for turns in turns_list:
+        legacy = measure(legacy_session, sessions, turns)
+        compact = measure(compact_session, sessions, turns)
+        results.append({
+            "turns": turns,
+            "legacy_bytes": legacy,
+            "compact_bytes": compact,
+            "saving": 1 - compact / legacy
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="会话内存占用基准")
+    parser.add_argument("--sessions", type=int, default=10000, help="同时存在的会话数")
+    parser.add_argument("--turns", default="0,5,20", help="每个会话的对话轮数，逗号分隔")
+    args = parser.parse_args()
+
+    print(f"{args.sessions} 个会话，平均每个会话：")
+    print(f"{'轮数':>6} {'原布局(KB)':>12} {'紧凑(KB)':>10} {'节省':>8} {'原总量(MB)':>12} {'紧凑总量(MB)':>14}")
+    for row in run(args.sessions, [int(x) for x in args.turns.split(",")]):
+        print(f"{row['turns']:>6} {row['legacy_bytes'] / 1024:>12.2f} {row['compact_bytes'] / 1024:>10.2f} "
+              f"{row['saving']:>8.0%} {row['legacy_bytes'] * args.sessions / 2 ** 20:>12.1f} "
+              f"{row['compact_bytes'] * args.sessions / 2 ** 20:>14.1f}")
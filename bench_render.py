@@ -0,0 +1,75 @@
+import argparse
+import time
+from typing import Dict, List
+
+from render_cache import RenderCache, build_message_html
+
+
+SAMPLE_ANSWER = """您好！关于退款问题，请参考以下步骤：
+
+1. 登录账户，进入 **我的订单**
+2. 选择需要退款的订单，点击 *申请退款*
+
+| 支付方式 | 到账时间 |
+|---------|---------|
+| 支付宝   | 1-3 天   |
+| 银行卡   | 3-5 天   |
+
+```python
+def refund(order_id):
+    return api.post(f"/orders/{order_id}/refund")
+```
+"""
+
+
+def make_messages(n: int) -> List[Dict[str, str]]:
+    messages = []
+    for i in range(n):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": f"第 {i} 个问题：怎么申请退款？"})
+        else:
+            messages.append({"role": "assistant", "content": f"{SAMPLE_ANSWER}\n（第 {i} 条回复）"})
+    return messages
+
+
+def run(sizes: List[int]) -> List[Dict]:
+    """
+    模拟对话逐条增长、每新增一条消息就 rerun 一次，统计各规模下单次 rerun 的渲染耗时
+
+    Returns:
+        每个规模一项，包含未缓存与缓存两种方式的单次 rerun 耗时（毫秒）
+    """
+    messages = make_messages(max(sizes))
+    cache = RenderCache(max_entries=max(sizes) * 2)
+    results = []
+    
+    for n in range(1, max(sizes) + 1):
+        visible = messages[:n]
+        if n in sizes:
+            start = time.perf_counter()
+            for m in visible:
+                build_message_html(m["role"], m["content"])
+            uncached = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for m in visible:
+            cache.render(m["role"], m["content"])
+        cached = time.perf_counter() - start
+        
+        if n in sizes:
+            results.append({
+                "messages": n,
+                "uncached_ms": uncached * 1000,
+                "cached_ms": cached * 1000
+            })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="消息渲染缓存微基准")
+    parser.add_argument("--sizes", default="10,50,100,200,400", help="统计的对话消息数，逗号分隔")
+    args = parser.parse_args()
+    
+    print(f"{'消息数':>8} {'未缓存(ms)':>12} {'缓存(ms)':>10}")
+    for row in run([int(x) for x in args.sizes.split(",")]):
+        print(f"{row['messages']:>8} {row['uncached_ms']:>12.2f} {row['cached_ms']:>10.3f}")
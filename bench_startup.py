@@ -0,0 +1,115 @@
+"""
+启动耗时报告
+
+在全新的子进程中导入入口模块，报告：
+- 进程从启动到导入完成的耗时（含解释器启动）
+- python -X importtime 统计的入口模块导入耗时，以及耗时最多的直接依赖
+- 按需加载的重量级依赖（提供商 SDK、Markdown 渲染、numpy）是否在启动时被提前导入
+
+提前导入或超出 --budget-ms 时以非零状态退出，可直接用作回归检查；
+相对基线的比较由 benchmark.py 的 startup/* 项完成。
+
+    python bench_startup.py
+    python bench_startup.py --modules chatbot,api_server --budget-ms 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+# 入口模块导入完成后不应出现的模块：它们只在首次使用对应功能时加载
+DEFERRED_MODULES = {
+    "chatbot": ["openai", "requests", "aiohttp", "asyncio", "numpy", "markdown", "pygments", "http.server"],
+    "async_chatbot": ["openai", "requests", "numpy", "markdown", "pygments"],
+    "api_server": ["openai", "requests", "numpy", "markdown", "pygments", "streamlit"],
+    "app": ["openai", "requests", "aiohttp", "numpy", "markdown", "pygments"],
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, float]]:
+    """解析 -X importtime 输出，返回 (模块名, 嵌套深度, 累计耗时秒) 列表，忽略其他输出行"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((name.strip(), depth, int(cumulative) / 1e6))
+    return rows
+
+
+def profile_once(module: str) -> Dict:
+    """在子进程中导入一次模块，返回导入耗时、各直接依赖耗时和已加载的模块"""
+    code = f"import {module}; import sys, json; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HERE,
+                            capture_output=True, text=True, check=True)
+    rows = parse_importtime(result.stderr)
+    # 输出按导入完成的顺序排列：入口模块是最后一个深度为 0 的条目，它的直接依赖紧挨在前面
+    entry = max(i for i, (name, depth, _) in enumerate(rows) if name == module and depth == 0)
+    start = max((i for i, (_, depth, _) in enumerate(rows[:entry]) if depth == 0), default=-1) + 1
+    children = [(name, seconds) for name, depth, seconds in rows[start:entry] if depth == 1]
+    return {
+        "import": rows[entry][2],
+        "children": children,
+        "loaded": set(json.loads(result.stdout.strip().splitlines()[-1]))
+    }
+
+
+def wall_once(module: str) -> float:
+    """不开启 importtime 时，进程从启动到导入完成并退出的耗时"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=HERE,
+                   capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def run(modules: List[str], repeat: int = 5, top: int = 8) -> List[Dict]:
+    results = []
+    for module in modules:
+        profiles = [profile_once(module) for _ in range(repeat)]
+        walls = [wall_once(module) for _ in range(repeat)]
+        children: Dict[str, List[float]] = {}
+        for profile in profiles:
+            for name, seconds in profile["children"]:
+                children.setdefault(name, []).append(seconds)
+        breakdown = sorted(((name, statistics.median(values) * 1000) for name, values in children.items()),
+                           key=lambda item: item[1], reverse=True)
+        results.append({
+            "module": module,
+            "import_ms": statistics.median(p["import"] for p in profiles) * 1000,
+            "startup_ms": statistics.median(walls) * 1000,
+            "breakdown": breakdown[:top],
+            "premature": [m for m in DEFERRED_MODULES.get(module, []) if m in profiles[0]["loaded"]]
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="入口模块启动耗时报告与按需加载检查")
+    parser.add_argument("--modules", default="chatbot,async_chatbot,api_server,app", help="入口模块，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=5, help="每个模块测量的次数（取中位数）")
+    parser.add_argument("--top", type=int, default=8, help="列出耗时最多的直接依赖个数")
+    parser.add_argument("--budget-ms", type=float, help="导入耗时上限（毫秒），超出时以非零状态退出")
+    args = parser.parse_args()
+
+    failed = False
+    for row in run([m for m in args.modules.split(",") if m], args.repeat, args.top):
+        print(f"{row['module']}: 导入 {row['import_ms']:.1f} ms，进程启动到导入完成 {row['startup_ms']:.1f} ms")
+        for name, ms in row["breakdown"]:
+            print(f"    {name:<28} {ms:>8.1f} ms")
+        if row["premature"]:
+            failed = True
+            print(f"    ✗ 启动时提前导入了按需加载的模块：{', '.join(row['premature'])}")
+        if args.budget_ms is not None and row["import_ms"] > args.budget_ms:
+            failed = True
+            print(f"    ✗ 导入耗时超出预算 {args.budget_ms:.0f} ms")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,400 @@
+"""
+性能基准套件
+
+在本地启动 OpenAI 兼容的桩服务（stub_server），不需要网络和 API Key，测量：
+- CustomerServiceChatbot 在不同并发数、历史长度下的吞吐量与延迟（可选流式、错误注入）
+- 不同对话规模下 JSON 文件存储与 SQLite 存储的保存/加载耗时
+- 对话打包进归档后的磁盘占用，以及从归档冷加载单个对话的耗时
+- 全文检索索引的构建耗时，以及常见词、短语、订单号和带过滤条件查询的耗时
+- 不同消息数下聊天区单次 rerun 的渲染耗时（bench_render）
+- 各入口模块在全新进程中的导入耗时（bench_startup）
+- 长会话在滑动窗口与前缀稳定模式下的前缀缓存命中率和首字耗时（桩服务模拟前缀缓存与预填充耗时）
+
+结果写成 JSON，可以与之前保存的基线比较，超过阈值的退化会被列出。
+
+    python benchmark.py --out results.json
+    python benchmark.py --out results.json --baseline baseline.json --fail-on-regression
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import bench_render
+import bench_startup
+from archive import ConversationArchive, archive_conversations
+from chatbot import CustomerServiceChatbot
+from config import Config
+from context_window import ContextWindowManager
+from metrics import Metrics, percentile
+from search_index import SearchIndex
+from storage import JSONFileStore, SQLiteStore
+from stub_server import StubServer
+
+
+# 比较基线时按名称后缀判断方向：耗时越小越好，吞吐量越大越好
+LOWER_IS_BETTER = ("_ms",)
+HIGHER_IS_BETTER = ("_rps",)
+
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    return {
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+    }
+
+
+def bench_chat(base_url: str, concurrency: int, history_length: int, requests: int,
+               stream: bool = False) -> Dict:
+    """
+    并发发起 requests 次对话，每次使用预先填充了 history_length 条历史的新机器人
+
+    每个问题都带序号，避免被在途请求合并或缓存影响测量。
+    """
+    history = bench_render.make_messages(history_length)
+
+    def one(i: int):
+        bot = CustomerServiceChatbot(api_key="bench", model="stub-model", provider="deepseek", base_url=base_url)
+        bot.conversation_history.extend(dict(m) for m in history)
+        start = time.perf_counter()
+        first_token = None
+        if stream:
+            for _ in bot.chat_stream(f"第 {i} 个基准问题", use_cache=False):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+        else:
+            bot.chat(f"第 {i} 个基准问题", use_cache=False)
+        return time.perf_counter() - start, first_token, bot.last_error is not None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    metrics = summarize_latencies([latency for latency, _, _ in outcomes])
+    metrics["throughput_rps"] = requests / wall
+    metrics["errors"] = sum(1 for _, _, failed in outcomes if failed)
+    if stream:
+        first_tokens = summarize_latencies([t for _, t, _ in outcomes if t is not None])
+        metrics["first_token_p50_ms"] = first_tokens["p50_ms"]
+        metrics["first_token_p95_ms"] = first_tokens["p95_ms"]
+    return metrics
+
+
+def bench_prefix(base_url: str, turns: int, stable: bool, context_tokens: int = 1000) -> Dict:
+    """
+    单个长会话逐轮流式对话，上下文超出预算后按策略裁剪
+
+    返回提供商报告的前缀缓存命中率和首字耗时；第 turns // 4 轮修改一次系统提示词。
+    """
+    metrics = Metrics()
+    bot = CustomerServiceChatbot(api_key="bench", model="stub-model", provider="deepseek", base_url=base_url,
+                                 metrics=metrics, prefix_stable=stable,
+                                 context_window=ContextWindowManager(max_tokens=context_tokens, stable_prefix=stable))
+    first_tokens = []
+    for i in range(turns):
+        if i == turns // 4:
+            bot.set_system_prompt("你是专业的售后客服，请先确认订单号，再简洁地回答问题。")
+        start = time.perf_counter()
+        first_token = None
+        for _ in bot.chat_stream(f"第 {i} 个问题：我的订单已经三天没有物流更新了，请帮我查一下", use_cache=False):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        first_tokens.append(first_token)
+    summary = summarize_latencies(first_tokens)
+    return {
+        "prompt_cache_hit_ratio": metrics.summary()["prompt_cache_hit_ratio"] or 0.0,
+        "first_token_p50_ms": summary["p50_ms"],
+        "first_token_p95_ms": summary["p95_ms"],
+    }
+
+
+def bench_storage(store_factory, sizes: List[int], repeat: int) -> List[Dict]:
+    """测量保存/加载一段对话的中位耗时"""
+    results = []
+    for size in sizes:
+        history = bench_render.make_messages(size)
+        store = store_factory()
+        save_times, load_times = [], []
+        conversation_id = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conversation_id = store.save(conversation_id, history, "deepseek", "stub-model")
+            save_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            store.load(conversation_id)
+            load_times.append(time.perf_counter() - start)
+        results.append({
+            "messages": size,
+            "save_ms": statistics.median(save_times) * 1000,
+            "load_ms": statistics.median(load_times) * 1000,
+        })
+    return results
+
+
+def bench_archive(count: int, repeat: int) -> Dict:
+    """把 count 段对话从 JSON 文件存储打包进归档，比较磁盘占用和单个对话的冷加载耗时"""
+    workdir = tempfile.mkdtemp(prefix="bench_archive_")
+    try:
+        live = JSONFileStore(os.path.join(workdir, "live"))
+        base = time.time() - 365 * 86400
+        ids = []
+        for i in range(count):
+            conversation_id = f"conversation_{time.strftime('%Y%m%d_%H%M%S', time.localtime(base + i * 60))}"
+            history = [{"role": "system", "content": Config.DEFAULT_SYSTEM_PROMPT}] + \
+                bench_render.make_messages(2 + i % 19)
+            live.save(conversation_id, history)
+            ids.append(conversation_id)
+        json_bytes = sum(os.path.getsize(live.path_for(c)) for c in ids)
+        sample = ids[::max(1, count // repeat)][:repeat]
+        
+        json_times = []
+        for conversation_id in sample:
+            start = time.perf_counter()
+            live.load(conversation_id)
+            json_times.append(time.perf_counter() - start)
+        
+        archive_dir = os.path.join(workdir, "archive")
+        archive_conversations(live, ConversationArchive(archive_dir), time.time())
+        archive_times = []
+        for conversation_id in sample:
+            # 每次新建归档对象：包含打开索引和映射段文件的开销
+            archive = ConversationArchive(archive_dir)
+            start = time.perf_counter()
+            archive.load(conversation_id)
+            archive_times.append(time.perf_counter() - start)
+            archive.close()
+        archive_bytes = ConversationArchive(archive_dir).stats()["segment_bytes"]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "json_kb": json_bytes / 1024,
+        "archive_kb": archive_bytes / 1024,
+        "compression_ratio": json_bytes / archive_bytes,
+        "json_load_ms": statistics.median(json_times) * 1000,
+        "archive_load_ms": statistics.median(archive_times) * 1000,
+    }
+
+
+def bench_search(message_count: int, repeat: int) -> Dict:
+    """为约 message_count 条消息构建全文检索索引，测量构建耗时和几类典型查询的耗时"""
+    workdir = tempfile.mkdtemp(prefix="bench_search_")
+    try:
+        index = SearchIndex(os.path.join(workdir, "search.db"))
+        base = time.time() - 365 * 86400
+        conversation_count = message_count // 11
+        
+        def conversations():
+            produced = i = 0
+            while produced < message_count:
+                history = bench_render.make_messages(2 + i % 19)
+                history[0] = {"role": "user", "content": f"订单号 {100000000 + i} 怎么申请退款？"}
+                yield f"conversation_{i}", base + i * 60, history, "", ""
+                produced += len(history)
+                i += 1
+        
+        start = time.perf_counter()
+        indexed = index.rebuild(conversations())
+        build_seconds = time.perf_counter() - start
+        queries = {
+            "common_query_ms": {"query": "退款"},
+            "phrase_query_ms": {"query": "怎么申请退款"},
+            "order_query_ms": {"query": str(100000000 + conversation_count // 2)},
+            # 最新约一成的对话
+            "filtered_query_ms": {"query": "退款", "role": "assistant", "start": base + conversation_count * 54},
+            "grouped_query_ms": {"query": "申请退款", "per_conversation": True},
+        }
+        metrics = {"messages": indexed, "build_ms": build_seconds * 1000,
+                   "index_rps": indexed / build_seconds}
+        for name, kwargs in queries.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                index.search(**kwargs)
+                times.append(time.perf_counter() - start)
+            metrics[name] = statistics.median(times) * 1000
+        metrics["index_kb"] = sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)) / 1024
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return metrics
+
+
+def run(concurrency_levels: List[int], history_lengths: List[int], requests_per_worker: int,
+        storage_sizes: List[int], render_sizes: List[int], startup_modules: List[str], prefix_turns: int,
+        latency: float, chunk_delay: float, prefill_delay: float, error_rate: float, stream: bool,
+        repeat: int, archive_count: int = 0, search_messages: int = 0) -> Dict:
+    results = []
+    with StubServer(latency=latency, chunk_delay=chunk_delay, error_rate=error_rate, seed=0) as server:
+        for history_length in history_lengths:
+            for concurrency in concurrency_levels:
+                modes = [False, True] if stream else [False]
+                for streaming in modes:
+                    requests = max(concurrency * requests_per_worker, 10)
+                    metrics = bench_chat(server.base_url, concurrency, history_length, requests, streaming)
+                    results.append({
+                        "name": f"chat/stream={int(streaming)}/history={history_length}/concurrency={concurrency}",
+                        "metrics": metrics
+                    })
+
+    if prefix_turns:
+        with StubServer(latency=latency, prefill_delay=prefill_delay, seed=0) as server:
+            for stable in (False, True):
+                results.append({
+                    "name": f"prefix/stable={int(stable)}/turns={prefix_turns}",
+                    "metrics": bench_prefix(server.base_url, prefix_turns, stable)
+                })
+
+    workdir = tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        stores = {
+            "json": lambda: JSONFileStore(tempfile.mkdtemp(dir=workdir)),
+            "sqlite": lambda: SQLiteStore(os.path.join(tempfile.mkdtemp(dir=workdir), "bench.db")),
+        }
+        for backend, factory in stores.items():
+            for row in bench_storage(factory, storage_sizes, repeat):
+                results.append({
+                    "name": f"storage/{backend}/messages={row['messages']}",
+                    "metrics": {"save_ms": row["save_ms"], "load_ms": row["load_ms"]}
+                })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if archive_count:
+        results.append({"name": f"archive/conversations={archive_count}",
+                        "metrics": bench_archive(archive_count, repeat)})
+    
+    if search_messages:
+        results.append({"name": f"search/messages={search_messages}",
+                        "metrics": bench_search(search_messages, repeat)})
+
+    for row in bench_render.run(render_sizes):
+        results.append({
+            "name": f"render/messages={row['messages']}",
+            "metrics": {"uncached_ms": row["uncached_ms"], "cached_ms": row["cached_ms"]}
+        })
+
+    for row in bench_startup.run(startup_modules, repeat=min(repeat, 5)):
+        results.append({
+            "name": f"startup/module={row['module']}",
+            "metrics": {"import_ms": row["import_ms"], "startup_ms": row["startup_ms"],
+                        "premature_imports": len(row["premature"])}
+        })
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "stub": {"latency": latency, "chunk_delay": chunk_delay, "prefill_delay": prefill_delay,
+                     "error_rate": error_rate},
+        },
+        "results": results
+    }
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[Dict]:
+    """
+    与基线逐项比较，返回变差超过 threshold（相对比例）的指标
+
+    只比较两边都存在的基准项；耗时类指标以 _ms 结尾，吞吐量以 _rps 结尾。
+    """
+    previous = {row["name"]: row["metrics"] for row in baseline.get("results", [])}
+    regressions = []
+    for row in current["results"]:
+        old_metrics = previous.get(row["name"])
+        if old_metrics is None:
+            continue
+        for key, value in row["metrics"].items():
+            old = old_metrics.get(key)
+            if not old:
+                continue
+            if key.endswith(LOWER_IS_BETTER):
+                change = (value - old) / old
+            elif key.endswith(HIGHER_IS_BETTER):
+                change = (old - value) / old
+            else:
+                continue
+            if change > threshold:
+                regressions.append({"name": row["name"], "metric": key, "baseline": old,
+                                    "current": value, "change": change})
+    return regressions
+
+
+def print_results(report: Dict):
+    for row in report["results"]:
+        metrics = "  ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                            for k, v in row["metrics"].items())
+        print(f"{row['name']:<48} {metrics}")
+
+
+def parse_ints(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="智能客服机器人性能基准（使用本地桩服务）")
+    parser.add_argument("--concurrency", default="1,8,32", help="并发数，逗号分隔")
+    parser.add_argument("--history", default="0,20,100", help="预置的历史消息条数，逗号分隔")
+    parser.add_argument("--requests-per-worker", type=int, default=5, help="每个并发线程发起的请求数")
+    parser.add_argument("--storage-sizes", default="10,100,1000", help="存储基准的对话消息数，逗号分隔")
+    parser.add_argument("--render-sizes", default="10,50,100,200", help="渲染基准的消息数，逗号分隔")
+    parser.add_argument("--prefix-turns", type=int, default=60, help="前缀缓存基准的会话轮数（0 表示不测量）")
+    parser.add_argument("--archive-conversations", type=int, default=2000,
+                        help="归档基准打包的对话数（0 表示不测量）")
+    parser.add_argument("--search-messages", type=int, default=200000,
+                        help="全文检索基准索引的消息数（0 表示不测量）")
+    parser.add_argument("--startup-modules", default="chatbot,api_server,app", help="测量导入耗时的入口模块，逗号分隔")
+    parser.add_argument("--latency", type=float, default=0.05, help="桩服务每次响应的延迟（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.005, help="流式响应每段之间的延迟（秒）")
+    parser.add_argument("--prefill-delay", type=float, default=0.0002,
+                        help="桩服务每个未命中前缀缓存的输入 token 的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="桩服务注入错误的比例")
+    parser.add_argument("--no-stream", action="store_true", help="不测量流式对话")
+    parser.add_argument("--repeat", type=int, default=20, help="存储基准每个规模的重复次数")
+    parser.add_argument("--quick", action="store_true", help="快速模式：缩小规模，用于冒烟检查")
+    parser.add_argument("--out", help="结果 JSON 的输出路径")
+    parser.add_argument("--baseline", help="基线结果 JSON，提供时输出退化项")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定退化的相对变化阈值")
+    parser.add_argument("--fail-on-regression", action="store_true", help="存在退化时以非零状态退出")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.concurrency, args.history, args.requests_per_worker = "1,8", "0,20", 2
+        args.storage_sizes, args.render_sizes, args.repeat = "10,100", "10,50", 5
+        args.startup_modules, args.prefix_turns = "chatbot", 20
+        args.archive_conversations, args.search_messages = 300, 5000
+
+    report = run(parse_ints(args.concurrency), parse_ints(args.history), args.requests_per_worker,
+                 parse_ints(args.storage_sizes), parse_ints(args.render_sizes),
+                 [m for m in args.startup_modules.split(",") if m], args.prefix_turns, args.latency,
+                 args.chunk_delay, args.prefill_delay, args.error_rate, not args.no_stream, args.repeat,
+                 args.archive_conversations, args.search_messages)
+    print_results(report)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项退化（阈值 {args.threshold:.0%}）：")
+            for r in regressions:
+                print(f"  {r['name']} {r['metric']}: {r['baseline']:.2f} -> {r['current']:.2f} (+{r['change']:.0%})")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print("\n与基线相比没有超过阈值的退化")
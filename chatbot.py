@@ -1,14 +1,98 @@
-import openai
-from typing import List, Dict, Optional
+from typing import TYPE_CHECKING, List, Dict, Optional, Iterator
+import hashlib
 import json
 import os
-from datetime import datetime
-import requests
+import time
+
+from config import Config
+from context_window import ContextWindowManager, estimate_tokens
+from messages import MessageList, common_prefix, shared_prompts, to_wire
+from metrics import Metrics, default_metrics, note_first_byte, note_usage
+from rate_limiter import PRIORITY_INTERACTIVE, ProviderScheduler, get_scheduler
+from resilience import ProviderError, ResilientCaller
+from response_cache import ResponseCache
+from router import ProviderRouter, build_router_from_env
+from singleflight import SingleFlight, default_single_flight, request_fingerprint
+from storage import ConversationStore, conversation_id_from, open_store
+
+if TYPE_CHECKING:
+    # 只用于类型标注：semantic_cache 依赖 numpy，真正使用 FAQ 缓存的调用方自己导入
+    from semantic_cache import SemanticFAQCache
+    from transport import HTTPTransport
+
+
+def parse_sse_chunk(line: str) -> Optional[Dict]:
+    """
+    解析一行 OpenAI 兼容的 SSE 数据
+
+    Returns:
+        该行的 chunk 字典（非数据行为空字典），流结束（[DONE]）时返回 None
+    """
+    if not line or not line.startswith("data:"):
+        return {}
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return None
+    return json.loads(payload)
+
+
+def chunk_delta(chunk: Dict) -> str:
+    """取出 chunk 中的增量文本，无内容时为空字符串；顺带记录流末尾的 usage"""
+    if chunk.get("usage"):
+        note_usage(chunk["usage"])
+    choices = chunk.get("choices") or []
+    if not choices:
+        return ""
+    return choices[0].get("delta", {}).get("content") or ""
+
+
+def parse_sse_line(line: str) -> Optional[str]:
+    """
+    解析一行 OpenAI 兼容的 SSE 数据
+
+    Returns:
+        该行携带的增量文本（无内容时为空字符串），流结束（[DONE]）时返回 None
+    """
+    chunk = parse_sse_chunk(line)
+    if chunk is None:
+        return None
+    return chunk_delta(chunk)
+
+
+def deepseek_error(status_code: int, text: str, retry_after: Optional[str] = None) -> ProviderError:
+    """把 DeepSeek 的非 200 响应转换为带状态码的异常"""
+    try:
+        retry_after_seconds = float(retry_after) if retry_after else None
+    except ValueError:
+        retry_after_seconds = None
+    return ProviderError(f"DeepSeek API error: {status_code} - {text}", status_code, retry_after_seconds)
+
+
+def iter_sse_deltas(lines) -> Iterator[str]:
+    """解析 OpenAI 兼容的 SSE 数据行，产出每个 chunk 中的增量文本"""
+    for line in lines:
+        delta = parse_sse_line(line)
+        if delta is None:
+            break
+        if delta:
+            yield delta
 
 
 class CustomerServiceChatbot:
     def __init__(self, api_key: str = None, model: str = "gpt-3.5-turbo", 
-                 provider: str = "openai", base_url: Optional[str] = None):
+                 provider: str = "openai", base_url: Optional[str] = None,
+                 transport: Optional["HTTPTransport"] = None, warm_up: bool = Config.HTTP_WARM_UP,
+                 context_window: Optional[ContextWindowManager] = None,
+                 response_cache: Optional[ResponseCache] = None,
+                 faq_cache: Optional["SemanticFAQCache"] = None,
+                 storage: Optional[ConversationStore] = None,
+                 resilience: Optional[ResilientCaller] = None,
+                 router: Optional[ProviderRouter] = None,
+                 scheduler: Optional[ProviderScheduler] = None,
+                 priority: int = PRIORITY_INTERACTIVE,
+                 single_flight: Optional[SingleFlight] = None,
+                 metrics: Optional[Metrics] = None, prefix_stable: bool = Config.PREFIX_STABLE,
+                 autosave: bool = Config.AUTOSAVE):
         """
         初始化智能客服机器人
         
@@ -17,77 +101,465 @@ class CustomerServiceChatbot:
             model: 模型名称
             provider: API提供商 ("openai" 或 "deepseek")
             base_url: 自定义API基础URL（可选）
+            transport: HTTP传输层（可选，默认使用进程内共享的连接池）
+            warm_up: 是否在初始化时预先建立连接
+            context_window: 上下文窗口管理器（可选，不设置时发送完整历史）
+            response_cache: 回复缓存（可选，不设置时每次都调用模型）
+            faq_cache: 语义 FAQ 缓存（可选，首轮问题足够相似时直接返回已有答案）
+            storage: 对话存储后端（可选，默认按 Config.CONVERSATION_STORAGE 创建）
+            resilience: 容错层（可选，提供重试、对冲和熔断；同一提供商的机器人可共用）
+            router: 多后端路由器（可选，设置后每轮由路由器选择后端，忽略 provider/api_key）
+            scheduler: 配额调度器（可选，默认在 Config 配置了 RATE_LIMIT_RPM/TPM 时按 API Key 共享）
+            priority: 调度优先级，数值越小越优先（在线用户 PRIORITY_INTERACTIVE，批量任务 PRIORITY_BATCH）
+            single_flight: 在途请求合并器（可选，默认在 Config.SINGLE_FLIGHT 开启时使用进程内共享实例）
+            metrics: 调用指标汇总（可选，默认在 Config.METRICS_ENABLED 开启时使用进程内共享实例）
+            prefix_stable: 前缀稳定模式：对话开始后修改系统提示词时追加一条系统消息而不是改写开头，
+                           使请求前缀保持不变以命中提供商的前缀缓存（上下文窗口需同时开启 stable_prefix）
+            autosave: 每轮对话结束后把新增消息追加到对话日志（需要 "log" 存储，默认随之创建）
         """
         self.provider = provider.lower()
+        self.router = router
         
-        if self.provider == "openai":
+        if router is not None:
+            self.provider = "router"
+            self.api_key = None
+        elif self.provider == "openai":
             self.api_key = api_key or os.getenv("OPENAI_API_KEY")
             if not self.api_key:
                 raise ValueError("OpenAI API key is required. Set OPENAI_API_KEY environment variable or pass it directly.")
+            # openai SDK（连同 aiohttp、numpy）导入耗时数百毫秒，只在选用 OpenAI 时加载
+            import openai
             openai.api_key = self.api_key
             if base_url:
                 openai.api_base = base_url
+            self.base_url = base_url
         elif self.provider == "deepseek":
             self.api_key = api_key or os.getenv("DEEPSEEK_API_KEY")
             if not self.api_key:
                 raise ValueError("DeepSeek API key is required. Set DEEPSEEK_API_KEY environment variable or pass it directly.")
-            self.base_url = base_url or "https://api.deepseek.com/v1"
+            self.base_url = base_url or Config.DEEPSEEK_BASE_URL
+            # requests/urllib3 连接池同样按需加载
+            from transport import get_shared_transport
+            self.transport = transport or get_shared_transport()
+            if warm_up:
+                self.transport.warm_up(self.base_url)
         else:
             raise ValueError(f"Unsupported provider: {provider}. Use 'openai' or 'deepseek'.")
         
         self.model = model
-        self.conversation_history: List[Dict[str, str]] = []
-        self.system_prompt = """你是一个专业的智能客服机器人。你的职责是：
+        self.context_window = context_window
+        self.response_cache = response_cache
+        self.faq_cache = faq_cache
+        self.storage = storage or open_store("log" if autosave else Config.CONVERSATION_STORAGE)
+        if autosave and not hasattr(self.storage, "append"):
+            raise ValueError("autosave requires an append-capable storage backend (CONVERSATION_STORAGE='log').")
+        self.autosave = autosave
+        # 自动保存的对话 ID 和已落盘的消息（与历史共享对象，只保存引用）
+        self.conversation_id: Optional[str] = None
+        self._autosaved: List = []
+        self.resilience = resilience
+        self.priority = priority
+        self.prefix_stable = prefix_stable
+        self.single_flight = single_flight
+        self.metrics = metrics
+        if metrics is None and Config.METRICS_ENABLED:
+            self.metrics = default_metrics
+        self.last_call: Optional[Dict] = None
+        if single_flight is None and Config.SINGLE_FLIGHT:
+            self.single_flight = default_single_flight
+        self.scheduler = scheduler
+        if scheduler is None and self.api_key and (Config.RATE_LIMIT_RPM or Config.RATE_LIMIT_TPM):
+            self.scheduler = get_scheduler(self.api_key, Config.RATE_LIMIT_RPM, Config.RATE_LIMIT_TPM,
+                                           Config.RATE_LIMIT_STATE_DIR or None)
+        self.temperature = Config.DEFAULT_TEMPERATURE
+        self.max_tokens = Config.MAX_TOKENS
+        # 最近一次对话调用的异常（成功时为 None），chat() 本身只返回错误提示文本
+        self.last_error: Optional[Exception] = None
+        self.conversation_history = []
+        self.system_prompt = shared_prompts.intern("""你是一个专业的智能客服机器人。你的职责是：
 1. 友好、专业地回答用户的问题
 2. 提供准确、有帮助的信息
 3. 在不确定时，诚实地告知用户
 4. 保持礼貌和耐心
 5. 记住对话上下文，提供连贯的多轮对话体验
 
-请用中文回答用户的问题。"""
+请用中文回答用户的问题。""")
         
         self.conversation_history.append({
             "role": "system",
             "content": self.system_prompt
         })
     
-    def chat(self, user_message: str) -> str:
+    @property
+    def conversation_history(self) -> MessageList:
+        """对话历史（紧凑表示），界面直接读取同一份列表，不再另存副本"""
+        return self._conversation_history
+    
+    @conversation_history.setter
+    def conversation_history(self, history):
+        # 赋值时转换为紧凑表示，并让 system_prompt 与最新的系统消息保持一致
+        # （前缀稳定模式下修改过的提示词追加在历史中间）
+        if not isinstance(history, MessageList):
+            history = MessageList(history)
+        self._conversation_history = history
+        if history and history[0].role == "system":
+            self.system_prompt = next(m.content for m in reversed(history) if m.role == "system")
+    
+    def chat(self, user_message: str, use_cache: bool = True) -> str:
         self.conversation_history.append({
             "role": "user",
             "content": user_message
         })
+        self.last_error = None
+        self.last_call = None
+        
+        cache_key, cached = self._lookup_cache(use_cache)
+        if cached is not None:
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": cached
+            })
+            self._autosave_turn()
+            return cached
         
         try:
-            if self.provider == "openai":
-                assistant_message = self._chat_openai()
-            elif self.provider == "deepseek":
-                assistant_message = self._chat_deepseek()
-            else:
-                raise ValueError(f"Unsupported provider: {self.provider}")
+            assistant_message = self._coalesced_call()
             
             self.conversation_history.append({
                 "role": "assistant",
                 "content": assistant_message
             })
-            
-            return assistant_message
+            self._store_cache(cache_key, assistant_message)
         
         except Exception as e:
+            self.last_error = e
             error_message = f"抱歉，发生了错误：{str(e)}"
             return error_message
+        
+        self._autosave_turn()
+        return assistant_message
     
-    def _chat_openai(self) -> str:
-        """使用OpenAI API进行对话"""
-        response = openai.ChatCompletion.create(
-            model=self.model,
-            messages=self.conversation_history,
-            temperature=0.7,
-            max_tokens=1000
+    def chat_stream(self, user_message: str, use_cache: bool = True) -> Iterator[str]:
+        """
+        流式对话：逐段产出模型回复的增量文本
+
+        完整回复只在流结束后才写入 conversation_history，
+        中途出错时产出错误提示且不记录助手消息。命中缓存时一次性产出完整回复。
+        """
+        self.conversation_history.append({
+            "role": "user",
+            "content": user_message
+        })
+        self.last_error = None
+        self.last_call = None
+        
+        cache_key, cached = self._lookup_cache(use_cache)
+        if cached is not None:
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": cached
+            })
+            self._autosave_turn()
+            yield cached
+            return
+        
+        chunks = []
+        try:
+            for delta in self._coalesced_stream():
+                chunks.append(delta)
+                yield delta
+            
+            assistant_message = "".join(chunks)
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": assistant_message
+            })
+            self._store_cache(cache_key, assistant_message)
+        
+        except Exception as e:
+            self.last_error = e
+            yield f"抱歉，发生了错误：{str(e)}"
+            return
+        
+        self._autosave_turn()
+    
+    def _request_fingerprint(self) -> str:
+        if self.router is not None:
+            endpoint = f"router:{id(self.router)}"
+        else:
+            # 只用 API Key 的哈希，不同账号的配额和权限不同，请求不能合并
+            key_hash = hashlib.sha256(self.api_key.encode("utf-8")).hexdigest()[:16]
+            endpoint = f"{self.base_url or ''}|{key_hash}"
+        return request_fingerprint(self.provider, self.model, self._request_messages(), self._sampling_params(),
+                                   endpoint)
+    
+    def _coalesced_call(self) -> str:
+        """与其他会话中指纹相同的在途请求合并为一次上游调用"""
+        if self.single_flight is None:
+            return self._call_provider()
+        start = time.perf_counter()
+        result = self.single_flight.do("call:" + self._request_fingerprint(), self._call_provider)
+        self._note_coalesced(start)
+        return result
+    
+    def _coalesced_stream(self) -> Iterator[str]:
+        if self.single_flight is None:
+            return self._stream_provider()
+        return self._noting_coalesced(
+            self.single_flight.stream("stream:" + self._request_fingerprint(), self._stream_provider)
         )
+    
+    def _noting_coalesced(self, deltas: Iterator[str]) -> Iterator[str]:
+        start = time.perf_counter()
+        first_token = None
+        for delta in deltas:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            yield delta
+        self._note_coalesced(start, stream=True, first_token=first_token)
+    
+    def _note_coalesced(self, start: float, stream: bool = False, first_token: Optional[float] = None):
+        """
+        跟随其他会话在途请求的调用没有自己的上游调用，last_call 记录等待结果的耗时，
+        并标记 coalesced（不计入 metrics，避免重复统计上游调用）
+        """
+        if self.last_call is not None or self.metrics is None:
+            return
+        span = self.metrics.span(self.provider, self.model, stream=stream)
+        span.first_token = first_token
+        span.latency = time.perf_counter() - start
+        self.last_call = dict(span.record(), coalesced=True)
+    
+    def _call_provider(self) -> str:
+        """调用当前提供商获取完整回复，配置了容错层时经由其重试、对冲和熔断"""
+        if self.router is not None:
+            call = lambda: self.router.complete(self._request_messages())
+        elif self.provider == "openai":
+            call = self._chat_openai
+        elif self.provider == "deepseek":
+            call = self._chat_deepseek
+        else:
+            raise ValueError(f"Unsupported provider: {self.provider}")
+        
+        if self.metrics is not None:
+            call = self._instrumented(call)
+        if self.scheduler is not None:
+            call = self._scheduled(call)
+        
+        if self.resilience is None:
+            return call()
+        return self.resilience.call(call)
+    
+    def _stream_provider(self) -> Iterator[str]:
+        if self.router is not None:
+            factory = lambda: self.router.stream(self._request_messages())
+        elif self.provider == "openai":
+            factory = self._stream_openai
+        elif self.provider == "deepseek":
+            factory = self._stream_deepseek
+        else:
+            raise ValueError(f"Unsupported provider: {self.provider}")
+        
+        if self.metrics is not None:
+            factory = self._instrumented_stream(factory)
+        if self.scheduler is not None:
+            factory = self._scheduled_stream(factory)
+        
+        if self.resilience is None:
+            return factory()
+        return self.resilience.call_stream(factory)
+    
+    def _instrumented(self, call):
+        """为每次提供商调用（含重试）打点，结果汇总到 self.metrics 并保存在 last_call"""
+        def instrumented():
+            span = self.metrics.span(self.provider, self.model)
+            try:
+                with span:
+                    result = call()
+                    self._fill_usage(span, result)
+                return result
+            finally:
+                self.last_call = span.record()
+        return instrumented
+    
+    def _instrumented_stream(self, factory):
+        def instrumented():
+            span = self.metrics.span(self.provider, self.model, stream=True)
+            chunks = []
+            try:
+                with span:
+                    for delta in factory():
+                        span.mark_token()
+                        chunks.append(delta)
+                        yield delta
+                    self._fill_usage(span, "".join(chunks))
+            finally:
+                self.last_call = span.record()
+        return instrumented
+    
+    def _fill_usage(self, span, reply: str):
+        """提供商未返回 usage 时（如 OpenAI 流式接口）按字符估算"""
+        if span.usage is None:
+            span.usage = {
+                "prompt_tokens": sum(estimate_tokens(m["content"]) for m in self._request_messages()),
+                "completion_tokens": estimate_tokens(reply)
+            }
+            span.usage_estimated = True
+    
+    def _estimate_request_tokens(self) -> int:
+        """本次请求预计消耗的 token 数：上下文估算值加上回复上限"""
+        return sum(estimate_tokens(m["content"]) for m in self._request_messages()) + self.max_tokens
+    
+    def _scheduled(self, call):
+        """包装提供商调用：先向调度器申请配额，完成后按回复实际长度退还多预留的 token"""
+        def scheduled():
+            reserved = self._estimate_request_tokens()
+            self.scheduler.acquire(reserved, self.priority)
+            try:
+                result = call()
+            except Exception:
+                # 失败的请求没有产生 token 用量，退还全部预留
+                self.scheduler.adjust(-reserved)
+                raise
+            self.scheduler.adjust(estimate_tokens(result) - self.max_tokens)
+            return result
+        return scheduled
+    
+    def _scheduled_stream(self, factory):
+        """流式版本：流结束或出错后按已产出的文本修正预留，尚未产出任何文本就失败时全部退还"""
+        def scheduled():
+            reserved = self._estimate_request_tokens()
+            self.scheduler.acquire(reserved, self.priority)
+            chunks = []
+            try:
+                for delta in factory():
+                    chunks.append(delta)
+                    yield delta
+            except Exception:
+                self.scheduler.adjust(self._stream_usage_delta(chunks, reserved))
+                raise
+            self.scheduler.adjust(self._stream_usage_delta(chunks, reserved))
+        return scheduled
+    
+    def _stream_usage_delta(self, chunks: List[str], reserved: int) -> int:
+        if not chunks:
+            return -reserved
+        return estimate_tokens("".join(chunks)) - self.max_tokens
+    
+    def _sampling_params(self) -> Dict:
+        return {
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+    
+    def _lookup_cache(self, use_cache: bool):
+        """
+        依次查询回复缓存和语义 FAQ 缓存
+
+        Returns:
+            (回复缓存键, 命中的回复)；未启用缓存或本次跳过缓存时均为 None
+        """
+        if not use_cache:
+            return None, None
+        
+        key = None
+        if self.response_cache is not None:
+            key = self.response_cache.make_key(
+                self.provider, self.model, self.conversation_history, self._sampling_params()
+            )
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                self._record_cache_hit("response")
+                return key, cached
+        
+        # 语义缓存只用于首轮问题，后续问题依赖上下文
+        if self.faq_cache is not None and len(self.get_conversation_history()) == 1:
+            match = self.faq_cache.lookup(self.conversation_history[-1]["content"])
+            if match is not None:
+                self._record_cache_hit("faq")
+                return key, match[0]
+        
+        return key, None
+    
+    def _record_cache_hit(self, tier: str):
+        if self.metrics is not None:
+            self.metrics.inc("chatbot_cache_hits_total", tier=tier)
+    
+    def _store_cache(self, cache_key: Optional[str], assistant_message: str):
+        """把模型的新回复写入已启用的缓存"""
+        if cache_key is not None:
+            self.response_cache.set(cache_key, assistant_message)
+        if self.faq_cache is not None and self.faq_cache.auto_add and len(self.get_conversation_history()) == 2:
+            self.faq_cache.add(self.conversation_history[-2]["content"], assistant_message)
+    
+    def _autosave_turn(self):
+        """
+        自动保存：只把上次落盘之后新增的消息追加到对话日志（历史被改写时从改写处开始）
+
+        回复此时已经生成，保存失败不影响本轮结果：异常记录在 last_error 中，
+        已落盘的位置不变，下一轮会连同这一轮的消息一起重新追加。
+        """
+        if not self.autosave:
+            return
+        history = self.conversation_history
+        try:
+            if self.conversation_id is None:
+                self.conversation_id = self.storage.save(None, history, self.provider, self.model)
+                self._autosaved = list(history)
+                return
+            keep = common_prefix(history, self._autosaved)
+            if keep == len(history) == len(self._autosaved):
+                return
+            self.storage.append(self.conversation_id, keep, history[keep:])
+        except Exception as e:
+            self.last_error = e
+            return
+        del self._autosaved[keep:]
+        self._autosaved.extend(history[keep:])
+    
+    def _request_messages(self) -> List[Dict[str, str]]:
+        """本次请求实际发送的消息（dict 形式）：配置了上下文窗口时按预算裁剪"""
+        if self.context_window is None:
+            return to_wire(self.conversation_history)
+        return to_wire(self.context_window.build(self.conversation_history))
+    
+    def summarize(self, messages: List[Dict[str, str]]) -> str:
+        """调用模型把一段对话压缩成摘要，不影响 conversation_history"""
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages if m["role"] != "system")
+        request = [
+            {"role": "system", "content": "请用简洁的中文总结以下客服对话的要点，保留用户的关键信息和诉求。"},
+            {"role": "user", "content": transcript}
+        ]
+        if self.router is not None:
+            return self.router.complete(request)
+        if self.provider == "openai":
+            return self._chat_openai(request)
+        return self._chat_deepseek(request)
+    
+    def _openai_request(self, stream: bool = False, messages: Optional[List[Dict[str, str]]] = None) -> Dict:
+        """构造 OpenAI ChatCompletion 的调用参数"""
+        params = {
+            "model": self.model,
+            "messages": self._request_messages() if messages is None else messages,
+            **self._sampling_params()
+        }
+        # 按请求传入密钥和地址，多个 OpenAI 兼容后端可以在同一进程内共存
+        params["api_key"] = self.api_key
+        if self.base_url:
+            params["api_base"] = self.base_url
+        if stream:
+            params["stream"] = True
+        return params
+    
+    def _chat_openai(self, messages: Optional[List[Dict[str, str]]] = None) -> str:
+        """使用OpenAI API进行对话"""
+        import openai
+        response = openai.ChatCompletion.create(**self._openai_request(messages=messages))
+        note_usage(response.get("usage"))
         return response.choices[0].message.content
     
-    def _chat_deepseek(self) -> str:
-        """使用DeepSeek API进行对话"""
+    def _deepseek_request(self, stream: bool = False, messages: Optional[List[Dict[str, str]]] = None):
+        """构造 DeepSeek 请求的 URL、请求头和请求体"""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -95,57 +567,94 @@ class CustomerServiceChatbot:
         
         data = {
             "model": self.model,
-            "messages": self.conversation_history,
-            "temperature": 0.7,
-            "max_tokens": 1000
+            "messages": self._request_messages() if messages is None else messages,
+            **self._sampling_params()
         }
+        if stream:
+            data["stream"] = True
+            data["stream_options"] = {"include_usage": True}
         
-        response = requests.post(
-            f"{self.base_url}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=60
-        )
+        return f"{self.base_url}/chat/completions", headers, data
+    
+    def _chat_deepseek(self, messages: Optional[List[Dict[str, str]]] = None) -> str:
+        """使用DeepSeek API进行对话"""
+        url, headers, data = self._deepseek_request(messages=messages)
+        response = self.transport.post(url, headers=headers, json=data)
+        note_first_byte(response.elapsed.total_seconds())
         
         if response.status_code != 200:
-            raise Exception(f"DeepSeek API error: {response.status_code} - {response.text}")
+            raise deepseek_error(response.status_code, response.text, response.headers.get("Retry-After"))
         
         result = response.json()
+        note_usage(result.get("usage"))
         return result["choices"][0]["message"]["content"]
     
+    def _stream_openai(self, messages: Optional[List[Dict[str, str]]] = None) -> Iterator[str]:
+        """使用OpenAI API进行流式对话"""
+        import openai
+        response = openai.ChatCompletion.create(**self._openai_request(stream=True, messages=messages))
+        for chunk in response:
+            delta = chunk.choices[0].delta.get("content")
+            if delta:
+                yield delta
+    
+    def _stream_deepseek(self, messages: Optional[List[Dict[str, str]]] = None) -> Iterator[str]:
+        """使用DeepSeek API进行流式对话（SSE）"""
+        url, headers, data = self._deepseek_request(stream=True, messages=messages)
+        with self.transport.post(url, headers=headers, json=data, stream=True) as response:
+            note_first_byte(response.elapsed.total_seconds())
+            if response.status_code != 200:
+                raise deepseek_error(response.status_code, response.text, response.headers.get("Retry-After"))
+            
+            # SSE 响应可能不声明 charset，requests 会按 ISO-8859-1 解码导致中文乱码
+            if "charset" not in response.headers.get("Content-Type", ""):
+                response.encoding = "utf-8"
+            for delta in iter_sse_deltas(response.iter_lines(decode_unicode=True)):
+                yield delta
+    
     def reset_conversation(self):
         self.conversation_history = [{
             "role": "system",
             "content": self.system_prompt
         }]
+        # 自动保存时重置即开始一段新对话，之前的对话保留在存储中
+        self.conversation_id = None
+        self._autosaved = []
     
     def get_conversation_history(self) -> List[Dict[str, str]]:
         return [msg for msg in self.conversation_history if msg["role"] != "system"]
     
     def save_conversation(self, filename: str = None):
-        conversations_dir = "conversations"
-        if not os.path.exists(conversations_dir):
-            os.makedirs(conversations_dir)
-        
-        if filename is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = os.path.join(conversations_dir, f"conversation_{timestamp}.json")
-        
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(self.conversation_history, f, ensure_ascii=False, indent=2)
-        
-        return filename
+        """保存当前对话，返回文件名或对话 ID（由存储后端决定）"""
+        if self.autosave and filename is None:
+            # 已经在自动保存：只需补上尚未落盘的部分
+            self._autosave_turn()
+            return self.conversation_id
+        return self.storage.save(filename, to_wire(self.conversation_history), self.provider, self.model)
     
     def load_conversation(self, filename: str):
-        with open(filename, 'r', encoding='utf-8') as f:
-            self.conversation_history = json.load(f)
+        self.conversation_history = self.storage.load(filename)
+        if self.autosave:
+            # 之后的对话继续追加到这段对话
+            self.conversation_id = conversation_id_from(filename)
+            self._autosaved = list(self.conversation_history)
     
     def set_system_prompt(self, prompt: str):
-        self.system_prompt = prompt
-        self.conversation_history[0] = {
-            "role": "system",
-            "content": prompt
-        }
+        if self.prefix_stable and len(self.conversation_history) > 1:
+            # 改写开头会让之后每一轮都无法命中前缀缓存，改为在末尾追加，新的提示词从下一轮起生效
+            self.conversation_history.append({
+                "role": "system",
+                "content": prompt
+            })
+            updated = self.conversation_history[-1]
+        else:
+            self.conversation_history[0] = {
+                "role": "system",
+                "content": prompt
+            }
+            updated = self.conversation_history[0]
+        # 使用去重后的共享字符串
+        self.system_prompt = updated.content
 
 
 if __name__ == "__main__":
@@ -157,8 +666,13 @@ if __name__ == "__main__":
     
     openai_key = os.getenv("OPENAI_API_KEY")
     deepseek_key = os.getenv("DEEPSEEK_API_KEY")
+    router = build_router_from_env()
     
-    if openai_key:
+    if router is not None:
+        print("\n检测到多个 API Key，按实测延迟在 OpenAI 与 DeepSeek 之间自动路由")
+        provider = "router"
+        model = "auto"
+    elif openai_key:
         print("\n检测到 OpenAI API Key，使用 OpenAI")
         provider = "openai"
         model = "gpt-3.5-turbo"
@@ -172,7 +686,7 @@ if __name__ == "__main__":
         exit(1)
     
     try:
-        chatbot = CustomerServiceChatbot(provider=provider, model=model)
+        chatbot = CustomerServiceChatbot(provider=provider, model=model, router=router)
         print(f"使用模型: {model}")
         print("=" * 40)
         
@@ -196,8 +710,10 @@ if __name__ == "__main__":
                 print(f"\n对话已保存到: {filename}")
                 continue
             
-            response = chatbot.chat(user_input)
-            print(f"\n客服: {response}")
+            print("\n客服: ", end="", flush=True)
+            for delta in chatbot.chat_stream(user_input):
+                print(delta, end="", flush=True)
+            print()
     
     except ValueError as e:
         print(f"\n错误: {e}")
@@ -30,6 +30,79 @@ class Config:
     
     MAX_TOKENS = 1000
     
+    # HTTP 连接池与超时设置（DeepSeek 等基于 HTTP 的提供商）
+    HTTP_POOL_CONNECTIONS = 10
+    HTTP_POOL_MAXSIZE = 20
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 60
+    HTTP_WARM_UP = False
+    
+    # 容错：重试、对冲请求与熔断
+    RETRY_MAX_ATTEMPTS = 3
+    RETRY_BASE_DELAY = 0.5
+    RETRY_MAX_DELAY = 8
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_WORKERS = 32
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_RECOVERY_TIMEOUT = 30
+    
+    # 客户端配额调度（0 表示不限制），按 API Key 共享
+    RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "0"))
+    RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "0"))
+    RATE_LIMIT_STATE_DIR = os.getenv("RATE_LIMIT_STATE_DIR", "")
+    SCHEDULER_BURST_SECONDS = 5
+    SCHEDULER_MAX_QUEUE = 1000
+    
+    # 系统提示词按内容去重的共享表容量
+    PROMPT_TABLE_MAX_ENTRIES = 1024
+    
+    # 合并指纹相同的在途请求（突发时多个会话发出同一问题只调用一次上游）
+    SINGLE_FLIGHT = True
+    
+    # 调用埋点与指标导出（路径或端口为空时不启用对应输出）
+    METRICS_ENABLED = True
+    METRICS_WINDOW = 1000
+    METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH", "")
+    METRICS_EXPORT_PATH = os.getenv("METRICS_EXPORT_PATH", "")
+    METRICS_EXPORT_INTERVAL = 15
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+    
+    # HTTP 对话服务（api_server.py）
+    API_HOST = os.getenv("API_HOST", "0.0.0.0")
+    API_PORT = int(os.getenv("API_PORT", "8000"))
+    API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+    API_HTTP_POOL_SIZE = 100
+    
+    # 多后端路由
+    ROUTER_EWMA_ALPHA = 0.2
+    ROUTER_ERROR_WEIGHT = 10.0
+    ROUTER_ERROR_HALF_LIFE = 60
+    
+    # 上下文窗口：每次请求发送给模型的 token 预算
+    CONTEXT_MAX_TOKENS = 3000
+    
+    # 前缀稳定模式：连续请求的开头保持逐字节一致，以命中提供商的前缀缓存（DeepSeek / OpenAI 兼容接口）
+    PREFIX_STABLE = os.getenv("PREFIX_STABLE", "false").lower() == "true"
+    # 前缀稳定模式下上下文裁剪每次推进的步长（占 token 预算的比例）
+    CONTEXT_STABLE_BLOCK_RATIO = 0.5
+    
+    # 回复缓存
+    RESPONSE_CACHE_MAX_ENTRIES = 1000
+    RESPONSE_CACHE_MAX_DISK_ENTRIES = 100000
+    RESPONSE_CACHE_TTL = 24 * 3600
+    # 磁盘层每写入多少次清理一次过期和超量的条目
+    RESPONSE_CACHE_EVICT_INTERVAL = 100
+    
+    # 语义 FAQ 缓存
+    # 字符 n-gram 向量分不清只差一个关键字的问题（"退货"与"退款"约 0.78），阈值只放行措辞几乎相同的问法
+    SEMANTIC_CACHE_THRESHOLD = 0.85
+    SEMANTIC_CACHE_HASH_BITS = 20
+    
+    # 消息渲染缓存
+    RENDER_CACHE_MAX_ENTRIES = 5000
+    # 流式输出时刷新助手气泡的最小间隔（秒）：每次刷新都重新渲染整段回复，逐个增量刷新是 O(n²)
+    STREAM_RENDER_INTERVAL = 0.1
+    
     DEFAULT_SYSTEM_PROMPT = """你是一个专业的智能客服机器人。你的职责是：
 1. 友好、专业地回答用户的问题
 2. 提供准确、有帮助的信息
@@ -41,6 +114,40 @@ class Config:
     
     CONVERSATION_SAVE_DIR = "conversations"
     
+    # 对话存储后端："json"（每个对话一个文件）、"sqlite" 或 "log"（追加式日志，支持自动保存）
+    CONVERSATION_STORAGE = "json"
+    CONVERSATION_DB_PATH = os.path.join(CONVERSATION_SAVE_DIR, "conversations.db")
+    
+    # 自动保存：每轮对话结束后只追加新增消息并落盘（使用 "log" 存储），多个会话的写入合并 fsync
+    AUTOSAVE = os.getenv("AUTOSAVE", "false").lower() == "true"
+    AUTOSAVE_DIR = os.path.join(CONVERSATION_SAVE_DIR, "autosave")
+    AUTOSAVE_COMMIT_DELAY = 0.0
+    AUTOSAVE_COMPACT_BYTES = 256 * 1024
+    AUTOSAVE_COMPACT_INTERVAL = 30
+    
+    # 归档层：较早的对话打包进压缩段文件（共享字典 + 偏移索引），加载时通过 mmap 只解压对应的块
+    ARCHIVE_DIR = os.path.join(CONVERSATION_SAVE_DIR, "archive")
+    ARCHIVE_AFTER_DAYS = 30
+    ARCHIVE_SEGMENT_BYTES = 64 * 1024 * 1024
+    ARCHIVE_DICT_SIZE = 32 * 1024
+    ARCHIVE_COMPRESSION_LEVEL = 9
+    
+    # 全文检索：保存对话时增量更新倒排索引（中日韩文字按 bigram 切分）
+    SEARCH_ENABLED = True
+    SEARCH_INDEX_PATH = os.path.join(CONVERSATION_SAVE_DIR, "search.db")
+    SEARCH_CANDIDATE_LIMIT = 1000
+    
+    # 数据分析报表：对话按 ID 分片交给进程池解析（None 表示使用全部 CPU 核）
+    ANALYTICS_WORKERS = None
+    ANALYTICS_SHARD_SIZE = 500
+    ANALYTICS_TOP_QUESTIONS = 20
+    
+    # 进行中会话的存储（"sqlite" 或 "redis"），任何 worker 都可以接着服务同一会话
+    SESSION_STORE = os.getenv("SESSION_STORE", "sqlite")
+    SESSION_DB_PATH = os.path.join(CONVERSATION_SAVE_DIR, "sessions.db")
+    SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+    SESSION_TTL = 7 * 24 * 3600
+    
     @classmethod
     def ensure_save_dir(cls):
         if not os.path.exists(cls.CONVERSATION_SAVE_DIR):
@@ -0,0 +1,155 @@
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import Config
+
+
+# 按每字 1 个 token 估算的码位范围（含两端）：中日韩标点、统一表意文字（含扩展 A）、全角字符
+CJK_RANGES = [(0x3000, 0x303F), (0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xFF00, 0xFFEF)]
+_CJK_PATTERN = re.compile("[" + "".join(f"{chr(low)}-{chr(high)}" for low, high in CJK_RANGES) + "]")
+
+# 每条消息的固定开销（role 字段、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数：中文字符按 1 个计，其余字符按 4 个 1 token 计"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class SlidingWindowPolicy:
+    """滑动窗口策略：直接丢弃超出预算的早期对话"""
+    
+    def compact(self, dropped: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        return []
+
+
+class SummaryPolicy:
+    def __init__(self, summarizer: Callable[[List[Dict[str, str]]], str]):
+        """
+        摘要策略：把超出预算的早期对话压缩成一条摘要消息
+
+        Args:
+            summarizer: 接收待压缩消息列表并返回摘要文本的函数，
+                        通常为 CustomerServiceChatbot.summarize
+        """
+        self.summarizer = summarizer
+        self._cached_key: Optional[Tuple[int, int]] = None
+        self._cached_summary: List[Dict[str, str]] = []
+    
+    def compact(self, dropped: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        if not dropped:
+            return []
+        # 历史只会在末尾追加，被丢弃的前缀不变时复用上次的摘要
+        key = (len(dropped), hash(dropped[-1]["content"]))
+        if key != self._cached_key:
+            summary = self.summarizer(dropped)
+            self._cached_summary = [{
+                "role": "system",
+                "content": f"以下是之前对话的摘要：\n{summary}"
+            }]
+            self._cached_key = key
+        return self._cached_summary
+
+
+class ContextWindowManager:
+    def __init__(self, max_tokens: int = Config.CONTEXT_MAX_TOKENS,
+                 min_recent_messages: int = 2, policy=None,
+                 token_counter: Callable[[str], int] = estimate_tokens,
+                 cache_size: int = 10000, stable_prefix: bool = Config.PREFIX_STABLE,
+                 block_ratio: float = Config.CONTEXT_STABLE_BLOCK_RATIO):
+        """
+        按 token 预算裁剪发送给模型的对话上下文
+
+        Args:
+            max_tokens: 每次请求的上下文 token 预算
+            min_recent_messages: 无论预算如何都保留的最新消息条数
+            policy: 处理超出预算的早期消息的策略（默认 SlidingWindowPolicy）
+            token_counter: 计算文本 token 数的函数
+            cache_size: 每条消息 token 数缓存的最大条目数
+            stable_prefix: 前缀稳定模式：裁剪起点按块跳跃而不是每轮滑动，两次跳跃之间请求前缀保持不变
+            block_ratio: 前缀稳定模式下每次跳跃的步长（占 max_tokens 的比例）
+        """
+        self.max_tokens = max_tokens
+        self.min_recent_messages = min_recent_messages
+        self.policy = policy or SlidingWindowPolicy()
+        self.token_counter = token_counter
+        self.cache_size = cache_size
+        self.stable_prefix = stable_prefix
+        self.block_ratio = block_ratio
+        self._token_cache: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+    
+    def count_message(self, message: Dict[str, str]) -> int:
+        """返回单条消息的 token 数，结果按 (role, content) 缓存"""
+        key = (message["role"], message["content"])
+        count = self._token_cache.get(key)
+        if count is None:
+            count = self.token_counter(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            self._token_cache[key] = count
+            if len(self._token_cache) > self.cache_size:
+                self._token_cache.popitem(last=False)
+        else:
+            self._token_cache.move_to_end(key)
+        return count
+    
+    def count(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count_message(m) for m in messages)
+    
+    def build(self, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        从完整历史中选出本次请求要发送的消息
+
+        始终保留开头的系统提示词和最新的若干条消息，从新到旧累加直到用完预算，
+        更早的消息交给 policy 处理。只会计算被保留的消息，已计算过的消息直接命中缓存。
+        """
+        if history and history[0]["role"] == "system":
+            system, turns = history[:1], history[1:]
+        else:
+            system, turns = [], history
+        
+        budget = self.max_tokens - self.count(system)
+        start = len(turns)
+        used = 0
+        while start > 0:
+            cost = self.count_message(turns[start - 1])
+            if used + cost > budget and len(turns) - start >= self.min_recent_messages:
+                break
+            used += cost
+            start -= 1
+        
+        # 保留部分尽量从用户消息开始，避免以孤立的助手回复开头
+        while start < len(turns) - self.min_recent_messages and turns[start]["role"] != "user":
+            start += 1
+        
+        if self.stable_prefix and start > 0:
+            start = self._stable_start(turns, start)
+        
+        if start == 0:
+            return list(history)
+        
+        dropped = turns[:start]
+        # 中途追加的系统提示词被裁掉后仍然有效：保留其中最新的一条
+        pinned = [m for m in reversed(dropped) if m["role"] == "system"][:1]
+        return system + self.policy.compact(dropped) + pinned + turns[start:]
+    
+    def _stable_start(self, turns: List[Dict[str, str]], start: int) -> int:
+        """
+        前缀稳定模式的裁剪起点
+
+        从对话开头累计 token，每满一个块在下一条用户消息处设检查点，取不早于滑动起点 start 的第一个检查点。
+        历史只在末尾追加，检查点位置不会改变，所以起点只在越过检查点时跳跃一次，
+        之间的各轮请求开头（系统提示词、摘要和保留的历史）逐字节一致。
+        """
+        block = max(1, int(self.max_tokens * self.block_ratio))
+        limit = len(turns) - self.min_recent_messages
+        used = 0
+        mark = block
+        for i, message in enumerate(turns[:limit + 1]):
+            if used >= mark and message["role"] == "user":
+                if i >= start:
+                    return i
+                mark = used + block
+            used += self.count_message(message)
+        return start
@@ -0,0 +1,138 @@
+"""
+紧凑的对话消息表示
+
+每条消息用带 __slots__ 的 Message 保存（约 48 字节，dict 约 184 字节），
+角色字符串全部驻留，系统提示词经 PromptTable 按内容去重后在所有会话之间共享同一个对象。
+Message 支持 message["role"] / message.get("content") 的读取方式，已有代码无需改动；
+需要发送给提供商或写成 JSON 时再用 to_wire() 生成 dict。
+"""
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from config import Config
+
+
+ROLES = {role: sys.intern(role) for role in ("system", "user", "assistant")}
+
+
+class PromptTable:
+    def __init__(self, max_entries: int = Config.PROMPT_TABLE_MAX_ENTRIES):
+        """
+        按内容去重的文本表，用于系统提示词
+
+        相同内容只保留一个字符串对象；超出 max_entries 时淘汰最久未用的条目，
+        被淘汰的提示词仍然可用，只是之后新建的会话不再与它共享。
+        """
+        self.max_entries = max_entries
+        self._texts: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def intern(self, text: str) -> str:
+        with self._lock:
+            shared = self._texts.get(text)
+            if shared is not None:
+                self._texts.move_to_end(text)
+                return shared
+            self._texts[text] = text
+            if len(self._texts) > self.max_entries:
+                self._texts.popitem(last=False)
+            return text
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+
+shared_prompts = PromptTable()
+
+
+class Message:
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = ROLES.get(role) or sys.intern(role)
+        self.content = shared_prompts.intern(content) if self.role == "system" else content
+
+    @classmethod
+    def from_dict(cls, message) -> "Message":
+        if isinstance(message, Message):
+            return message
+        return cls(message["role"], message["content"])
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+    def __eq__(self, other) -> bool:
+        try:
+            return self.role == other["role"] and self.content == other["content"]
+        except (KeyError, TypeError):
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Message(role={self.role!r}, content={self.content!r})"
+
+
+class MessageList(list):
+    """写入时自动转换为 Message 的列表，append({"role": ..., "content": ...}) 等写法保持可用"""
+
+    __slots__ = ()
+
+    def __init__(self, messages: Iterable = ()):
+        super().__init__(Message.from_dict(m) for m in messages)
+
+    def append(self, message):
+        super().append(Message.from_dict(message))
+
+    def insert(self, index, message):
+        super().insert(index, Message.from_dict(message))
+
+    def extend(self, messages):
+        super().extend(Message.from_dict(m) for m in messages)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            super().__setitem__(index, [Message.from_dict(m) for m in value])
+        else:
+            super().__setitem__(index, Message.from_dict(value))
+
+
+def to_wire(messages: Iterable) -> List[Dict[str, str]]:
+    """生成提供商接口与 JSON 使用的 dict 列表"""
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+
+def same_message(a, b) -> bool:
+    return a is b or (a["role"] == b["role"] and a["content"] == b["content"])
+
+
+def common_prefix(history, persisted) -> int:
+    """history 与已持久化的消息列表的公共前缀长度"""
+    keep = len(persisted)
+    # 只追加时前缀是同一批对象，列表比较在 C 层按引用短路，不必逐条比较
+    if len(history) >= keep and history[:keep] == persisted:
+        return keep
+    keep = 0
+    limit = min(len(history), len(persisted))
+    while keep < limit and same_message(history[keep], persisted[keep]):
+        keep += 1
+    return keep
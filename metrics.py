@@ -0,0 +1,350 @@
+"""
+提供商调用的埋点与指标汇总
+
+每次提供商调用（含重试的每一次尝试）对应一个 CallSpan，记录建连耗时、首字节/首 token 时间、
+总耗时、token 用量和错误。传输层和解析代码通过 note_* 函数把数据写入当前 span，
+span 结束时汇总到 Metrics 的直方图和计数器中，可导出为 Prometheus 文本格式、
+写成文件、通过 HTTP 端点暴露，或逐条写入 JSON Lines 结构化日志。
+"""
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
+
+from config import Config
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+
+# 秒级直方图的桶边界，覆盖从本地缓存到长回复的耗时范围
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_span: contextvars.ContextVar[Optional["CallSpan"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def note_connect(seconds: float):
+    """传输层新建连接时调用，复用连接时不会触发"""
+    span = _current_span.get()
+    if span is not None:
+        span.connect = (span.connect or 0.0) + seconds
+
+
+def note_first_byte(seconds: Optional[float] = None):
+    """收到响应头时调用；未给出耗时则按距 span 开始的时间计算"""
+    span = _current_span.get()
+    if span is not None and span.first_byte is None:
+        span.first_byte = seconds if seconds is not None else time.perf_counter() - span.start
+
+
+def note_usage(usage: Optional[Dict]):
+    """记录提供商返回的 usage 块"""
+    span = _current_span.get()
+    if span is not None and usage:
+        span.usage = dict(usage)
+
+
+def cached_prompt_tokens(usage: Optional[Dict]) -> Optional[int]:
+    """
+    usage 中命中提供商前缀缓存的输入 token 数，未报告时返回 None
+
+    DeepSeek 使用 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+    OpenAI 兼容接口使用 prompt_tokens_details.cached_tokens。
+    """
+    if not usage:
+        return None
+    if usage.get("prompt_cache_hit_tokens") is not None:
+        return usage["prompt_cache_hit_tokens"]
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens")
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS, window: int = Config.METRICS_WINDOW):
+        """
+        累计直方图，另保留最近 window 个样本用于计算实时分位数
+
+        Args:
+            buckets: 桶的上界（不含 +Inf）
+            window: 用于分位数的最近样本数
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法分位数，没有样本时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class CallSpan:
+    def __init__(self, metrics: "Metrics", provider: str, model: str, stream: bool = False):
+        """一次提供商调用的计时记录，作为上下文管理器使用"""
+        self.metrics = metrics
+        self.provider = provider
+        self.model = model
+        self.stream = stream
+        self.start = 0.0
+        self.connect: Optional[float] = None
+        self.first_byte: Optional[float] = None
+        self.first_token: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.usage: Optional[Dict] = None
+        self.usage_estimated = False
+        self.error: Optional[str] = None
+        self._previous = None
+
+    def mark_token(self):
+        """流式调用产出增量时调用，只记录第一次"""
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.start
+
+    def __enter__(self) -> "CallSpan":
+        self.start = time.perf_counter()
+        # 流式调用会跨越多次 yield，结束时恢复原值而不是 reset，避免跨上下文报错
+        self._previous = _current_span.get()
+        _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.set(self._previous)
+        self.latency = time.perf_counter() - self.start
+        if exc_type is not None and issubclass(exc_type, Exception):
+            status_code = getattr(exc, "status_code", None)
+            self.error = str(status_code) if status_code else exc_type.__name__
+        self.metrics.record(self)
+        return False
+
+    def record(self) -> Dict:
+        """以字典形式返回本次调用的数据，用于结构化日志和 last_call"""
+        usage = self.usage or {}
+        return {
+            "ts": round(time.time(), 3),
+            "provider": self.provider,
+            "model": self.model,
+            "stream": self.stream,
+            "connect": self.connect,
+            "first_byte": self.first_byte,
+            "first_token": self.first_token,
+            "latency": self.latency,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "cached_prompt_tokens": cached_prompt_tokens(usage),
+            "usage_estimated": self.usage_estimated,
+            "error": self.error,
+        }
+
+
+class Metrics:
+    def __init__(self, log_path: Optional[str] = None, export_path: Optional[str] = None,
+                 export_interval: float = Config.METRICS_EXPORT_INTERVAL):
+        """
+        进程内的指标汇总
+
+        Args:
+            log_path: 结构化日志路径（可选，每次调用追加一行 JSON）
+            export_path: Prometheus 文本文件路径（可选，按 export_interval 节流重写）
+            export_interval: 导出文件的最小间隔（秒）
+        """
+        self.log_path = log_path
+        self.export_path = export_path
+        self.export_interval = export_interval
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._last_export = 0.0
+
+    def span(self, provider: str, model: str, stream: bool = False) -> CallSpan:
+        return CallSpan(self, provider, model, stream)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def record(self, span: CallSpan):
+        labels = {"provider": span.provider, "model": span.model}
+        self.inc("chatbot_provider_calls_total", outcome="error" if span.error else "ok", **labels)
+        if span.error:
+            self.inc("chatbot_provider_errors_total", type=span.error, **labels)
+        self.observe("chatbot_provider_latency_seconds", span.latency, **labels)
+        if span.connect is not None:
+            self.observe("chatbot_provider_connect_seconds", span.connect, **labels)
+        if span.first_byte is not None:
+            self.observe("chatbot_provider_first_byte_seconds", span.first_byte, **labels)
+        if span.first_token is not None:
+            self.observe("chatbot_provider_first_token_seconds", span.first_token, **labels)
+        if span.usage:
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if span.usage.get(kind):
+                    self.inc("chatbot_tokens_total", span.usage[kind], kind=kind[:-len("_tokens")], **labels)
+            cached = cached_prompt_tokens(span.usage)
+            if cached is not None and span.usage.get("prompt_tokens"):
+                self.inc("chatbot_prompt_cache_tokens_total", cached, result="hit", **labels)
+                self.inc("chatbot_prompt_cache_tokens_total", span.usage["prompt_tokens"] - cached,
+                         result="miss", **labels)
+
+        if self.log_path:
+            line = json.dumps(span.record(), ensure_ascii=False)
+            with self._log_lock:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        if self.export_path and time.monotonic() - self._last_export >= self.export_interval:
+            self._last_export = time.monotonic()
+            self.write_prometheus(self.export_path)
+
+    def counter_total(self, name: str, **labels) -> float:
+        """汇总所有标签组合（或指定标签子集）下的计数"""
+        with self._lock:
+            return sum(value for (counter, key), value in self._counters.items()
+                       if counter == name and all(item in key for item in labels.items()))
+
+    def percentile(self, name: str, p: float) -> Optional[float]:
+        """合并所有标签组合的最近样本计算分位数"""
+        with self._lock:
+            samples = [v for (hist, _), h in self._histograms.items() if hist == name for v in h.recent]
+        return percentile(samples, p)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        """侧边栏展示用的实时汇总"""
+        cache_hit = self.counter_total("chatbot_prompt_cache_tokens_total", result="hit")
+        cache_miss = self.counter_total("chatbot_prompt_cache_tokens_total", result="miss")
+        return {
+            "calls": self.counter_total("chatbot_provider_calls_total"),
+            "errors": self.counter_total("chatbot_provider_calls_total", outcome="error"),
+            "latency_p50": self.percentile("chatbot_provider_latency_seconds", 50),
+            "latency_p95": self.percentile("chatbot_provider_latency_seconds", 95),
+            "first_token_p50": self.percentile("chatbot_provider_first_token_seconds", 50),
+            "first_token_p95": self.percentile("chatbot_provider_first_token_seconds", 95),
+            "prompt_tokens": self.counter_total("chatbot_tokens_total", kind="prompt"),
+            "completion_tokens": self.counter_total("chatbot_tokens_total", kind="completion"),
+            "cache_hits": self.counter_total("chatbot_cache_hits_total"),
+            "prompt_cache_hit_tokens": cache_hit,
+            "prompt_cache_miss_tokens": cache_miss,
+            # 只统计报告了缓存字段的调用；都没有报告时为 None
+            "prompt_cache_hit_ratio": cache_hit / (cache_hit + cache_miss) if cache_hit + cache_miss else None,
+        }
+
+    def render_prometheus(self) -> str:
+        """导出为 Prometheus 文本格式（counter 与 histogram）"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in histograms]
+
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), counts, total, count, buckets in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """原子地写出 Prometheus 文本文件，可供 node_exporter textfile collector 采集"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def aiohttp_trace_config(self):
+        """aiohttp 的追踪配置：记录异步调用的建连耗时和首字节时间"""
+        import aiohttp
+
+        async def on_connection_create_start(session, context, params):
+            context.connect_start = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params):
+            note_connect(time.perf_counter() - context.connect_start)
+
+        async def on_request_end(session, context, params):
+            note_first_byte()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+
+def _format_labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    escaped = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + escaped + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def start_metrics_server(metrics: Metrics, port: int, host: str = "0.0.0.0") -> "ThreadingHTTPServer":
+    """在后台线程中提供 /metrics 端点"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+default_metrics = Metrics(log_path=Config.METRICS_LOG_PATH or None,
+                          export_path=Config.METRICS_EXPORT_PATH or None)
@@ -0,0 +1,220 @@
+import hashlib
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+class QueueFullError(Exception):
+    """调度队列已满，请求被拒绝（背压）"""
+
+
+class SchedulerTimeout(Exception):
+    """在超时时间内未能获得配额"""
+
+
+class ProviderScheduler:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 burst_seconds: float = Config.SCHEDULER_BURST_SECONDS,
+                 max_queue: int = Config.SCHEDULER_MAX_QUEUE,
+                 state_file: Optional[str] = None):
+        """
+        提供商配额调度器：按 API Key 的 请求数/分钟 和 token数/分钟 两个令牌桶放行请求
+
+        等待中的请求按优先级排队（数值越小越优先，同优先级先到先得），
+        只有队首请求可以消耗配额；队列满时直接拒绝。
+        设置 state_file 后令牌桶状态保存在 SQLite 文件中，多个进程共享同一份配额
+        （排队顺序仍只在进程内保证）。
+
+        Args:
+            requests_per_minute: 每分钟请求数上限（0 表示不限制）
+            tokens_per_minute: 每分钟 token 数上限（0 表示不限制）
+            burst_seconds: 令牌桶容量，相当于允许突发多少秒的配额
+            max_queue: 排队请求数上限
+            state_file: 跨进程共享的状态文件（可选）
+        """
+        if not requests_per_minute and not tokens_per_minute:
+            raise ValueError("ProviderScheduler requires requests_per_minute or tokens_per_minute.")
+        # 不限制的桶速率为 0，请求不从中扣减
+        self.request_rate = requests_per_minute / 60.0
+        self.token_rate = tokens_per_minute / 60.0
+        self.request_capacity = max(1.0, self.request_rate * burst_seconds)
+        self.token_capacity = max(1.0, self.token_rate * burst_seconds)
+        self.max_queue = max_queue
+        self.state_file = state_file
+        
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._waits = deque(maxlen=1000)
+        
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._state = [self.request_capacity, self.token_capacity, time.time()]
+        self._local = threading.local()
+        
+        if state_file:
+            directory = os.path.dirname(state_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS buckets ("
+                    "id INTEGER PRIMARY KEY CHECK (id = 1), requests REAL, tokens REAL, updated REAL)"
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO buckets (id, requests, tokens, updated) VALUES (1, ?, ?, ?)",
+                    tuple(self._state)
+                )
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.state_file, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+    
+    def _refill(self, requests: float, tokens: float, updated: float, now: float) -> Tuple[float, float]:
+        elapsed = max(0.0, now - updated)
+        return (min(self.request_capacity, requests + elapsed * self.request_rate),
+                min(self.token_capacity, tokens + elapsed * self.token_rate))
+    
+    def _update(self, fn):
+        """
+        对令牌桶做一次原子的 读取-补充-修改-写回
+
+        Args:
+            fn: 接收补充后的 (请求数, token数)，返回 (新请求数, 新token数, 结果)
+
+        Returns:
+            fn 返回的结果
+        """
+        now = time.time()
+        if not self.state_file:
+            requests, tokens, result = fn(*self._refill(*self._state, now))
+            self._state = [requests, tokens, now]
+            return result
+        
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT requests, tokens, updated FROM buckets WHERE id = 1").fetchone()
+            requests, tokens, result = fn(*self._refill(*row, now))
+            conn.execute("UPDATE buckets SET requests = ?, tokens = ?, updated = ? WHERE id = 1",
+                         (requests, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+    
+    def _take(self, tokens: float) -> float:
+        """尝试从两个桶中扣减配额，成功返回 0，否则返回预计还需等待的秒数"""
+        # 超过桶容量的请求按满桶计，否则永远无法放行
+        need_requests = 1.0 if self.request_rate else 0.0
+        need = min(tokens, self.token_capacity) if self.token_rate else 0.0
+        
+        def take(requests: float, available: float):
+            if requests >= need_requests and available >= need:
+                return requests - need_requests, available - need, 0.0
+            wait = max((need_requests - requests) / self.request_rate if requests < need_requests else 0.0,
+                       (need - available) / self.token_rate if available < need else 0.0)
+            return requests, available, wait
+        
+        return self._update(take)
+    
+    def acquire(self, tokens: float, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None):
+        """
+        阻塞直到获得一次请求和 tokens 个 token 的配额
+
+        Raises:
+            QueueFullError: 排队请求数已达上限
+            SchedulerTimeout: 超时仍未获得配额
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            if len(self._heap) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f"请求排队已满（{self.max_queue}），请稍后重试")
+            
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._heap, entry)
+            try:
+                while True:
+                    wait = None
+                    if self._heap[0] == entry:
+                        wait = self._take(tokens)
+                        if wait == 0.0:
+                            break
+                        # 跨进程时其他进程也在消耗配额，不要一次睡太久
+                        if self.state_file:
+                            wait = min(wait, 0.05)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise SchedulerTimeout("等待配额超时")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                if self._heap[0] == entry:
+                    heapq.heappop(self._heap)
+                else:
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                self._cond.notify_all()
+            
+            self.admitted += 1
+            self._waits.append(time.monotonic() - start)
+    
+    def adjust(self, delta_tokens: float):
+        """请求完成后按实际用量修正 token 桶：正数补扣（可扣成负数），负数退还"""
+        if delta_tokens == 0 or not self.token_rate:
+            return
+        with self._cond:
+            self._update(lambda requests, available: (
+                requests, min(self.token_capacity, available - delta_tokens), None
+            ))
+            self._cond.notify_all()
+    
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "queue_depth": len(self._heap),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0
+            }
+
+
+_schedulers: Dict[str, ProviderScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(api_key: str, requests_per_minute: float, tokens_per_minute: float,
+                  state_dir: Optional[str] = None) -> ProviderScheduler:
+    """获取某个 API Key 在进程内共享的调度器；给出 state_dir 时同时跨进程共享"""
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key_hash)
+        if scheduler is None:
+            state_file = os.path.join(state_dir, f"quota_{key_hash}.db") if state_dir else None
+            scheduler = ProviderScheduler(requests_per_minute, tokens_per_minute, state_file=state_file)
+            _schedulers[key_hash] = scheduler
+        return scheduler
@@ -0,0 +1,121 @@
+import hashlib
+import html
+import threading
+from collections import OrderedDict
+
+from config import Config
+
+
+MARKDOWN_EXTENSIONS = ['tables', 'fenced_code', 'codehilite']
+
+_local = threading.local()
+
+
+def markdown_to_html(content: str) -> str:
+    """渲染 Markdown，每个线程复用同一个 Markdown 实例，避免重复加载扩展"""
+    md = getattr(_local, "md", None)
+    if md is None:
+        # markdown 与 codehilite 使用的 pygments 在第一次渲染时才导入，不拖慢进程启动
+        import markdown
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        _local.md = md
+    return md.reset().convert(content)
+
+
+USER_AVATAR = """
+            <svg viewBox="0 0 24 24" width="24" height="24" stroke="currentColor" stroke-width="2" fill="none" stroke-linecap="round" stroke-linejoin="round" class="css-i6hzaj">
+                <path d="M20 21v-2a4 4 0 0 0-4-4H8a4 4 0 0 0-4 4v2"></path>
+                <circle cx="12" cy="7" r="4"></circle>
+            </svg>
+            """
+
+ASSISTANT_AVATAR = """
+            <svg viewBox="0 0 24 24" width="24" height="24" stroke="currentColor" stroke-width="2" fill="none" stroke-linecap="round" stroke-linejoin="round" class="css-i6hzaj">
+                <path d="M12 2a2 2 0 0 1 2 2v2a2 2 0 0 1-2 2 2 2 0 0 1-2-2V4a2 2 0 0 1 2-2z"></path>
+                <path d="M12 16a2 2 0 0 1 2 2v2a2 2 0 0 1-2 2 2 2 0 0 1-2-2v-2a2 2 0 0 1 2-2z"></path>
+                <line x1="12" y1="8" x2="12" y2="16"></line>
+                <path d="M20 12a8 8 0 1 1-16 0"></path>
+            </svg>
+            """
+
+
+def build_message_html(role: str, content: str) -> str:
+    """生成单条消息的气泡 HTML"""
+    if role == "user":
+        # 用户消息：转义HTML
+        escaped_content = html.escape(content).replace('\n', '<br>')
+        
+        return f'''
+            <div class="message-row user">
+                <div class="avatar user">{USER_AVATAR}</div>
+                <div class="message-content">
+                    <div class="message-label">您</div>
+                    <div class="message-bubble user">{escaped_content}</div>
+                </div>
+            </div>
+            '''
+    
+    # AI消息：渲染Markdown
+    md_content = markdown_to_html(content)
+    
+    return f'''
+            <div class="message-row assistant">
+                <div class="avatar assistant">{ASSISTANT_AVATAR}</div>
+                <div class="message-content">
+                    <div class="message-label">AI助手</div>
+                    <div class="message-bubble assistant">{md_content}</div>
+                </div>
+            </div>
+            '''
+
+
+class RenderCache:
+    def __init__(self, max_entries: int = Config.RENDER_CACHE_MAX_ENTRIES):
+        """
+        消息 HTML 渲染缓存，按 内容哈希 + 渲染选项 缓存，进程内所有会话共享
+
+        每次 rerun 只有尚未渲染过的消息会真正经过 Markdown/代码高亮，
+        其余消息直接复用缓存的 HTML。
+
+        Args:
+            max_entries: 最多缓存的消息数（LRU 淘汰）
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._options = "|".join(MARKDOWN_EXTENSIONS)
+    
+    def key(self, role: str, content: str) -> str:
+        raw = f"{self._options}\0{role}\0{content}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+    
+    def render(self, role: str, content: str) -> str:
+        key = self.key(role, content)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        
+        rendered = build_message_html(role, content)
+        with self._lock:
+            self._entries[key] = rendered
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+default_cache = RenderCache()
+
+
+def render_message(role: str, content: str) -> str:
+    """使用进程级共享缓存渲染单条消息"""
+    return default_cache.render(role, content)
@@ -0,0 +1,332 @@
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from config import Config
+
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class ProviderError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        """
+        提供商返回的 HTTP 错误
+
+        Args:
+            message: 错误信息
+            status_code: HTTP 状态码
+            retry_after: 服务端建议的重试等待时间（秒，来自 Retry-After 头）
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """429、5xx、连接错误和超时可以重试，其余错误（如 401、400）直接失败"""
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # asyncio 与 requests 都按需导入；尚未导入的模块不可能抛出它的异常
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is not None and isinstance(error, asyncio.TimeoutError):
+        return True
+    requests = sys.modules.get("requests")
+    if requests is not None and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    # openai 0.28 的连接类错误没有状态码
+    return type(error).__name__ in ("APIConnectionError", "Timeout", "ServiceUnavailableError", "RateLimitError")
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = Config.RETRY_MAX_ATTEMPTS,
+                 base_delay: float = Config.RETRY_BASE_DELAY,
+                 max_delay: float = Config.RETRY_MAX_DELAY):
+        """
+        带抖动的指数退避重试策略
+
+        Args:
+            max_attempts: 最多尝试次数（含第一次）
+            base_delay: 第一次重试前的基础等待时间（秒）
+            max_delay: 单次等待时间上限（秒）
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def delay(self, attempt: int, error: Exception) -> float:
+        """第 attempt 次失败后的等待时间（full jitter），服务端给出 Retry-After 时优先使用"""
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = Config.CIRCUIT_FAILURE_THRESHOLD,
+                 recovery_timeout: float = Config.CIRCUIT_RECOVERY_TIMEOUT):
+        """
+        熔断器：连续失败达到阈值后打开，在恢复期内直接拒绝请求；
+        恢复期过后放行一个探测请求（半开），成功则关闭，失败则重新打开
+
+        Args:
+            failure_threshold: 触发熔断的连续失败次数
+            recovery_timeout: 打开状态持续的时间（秒）
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _available(self) -> bool:
+        if self.state == "closed":
+            return True
+        # 半开状态下 opened_at 记录的是探测请求的发出时间，探测方迟迟不回报结果时允许再次探测
+        return time.monotonic() - self.opened_at >= self.recovery_timeout
+    
+    def is_available(self) -> bool:
+        """只读检查：当前是否会放行请求，不改变熔断器状态（用于筛选候选后端）"""
+        with self._lock:
+            return self._available()
+    
+    def allow(self) -> bool:
+        """在真正发出请求前调用：恢复期已过时占用唯一的半开探测名额"""
+        with self._lock:
+            if not self._available():
+                return False
+            if self.state != "closed":
+                self.state = "half_open"
+                self.opened_at = time.monotonic()
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        """记录最近 window 次成功请求的耗时，用于计算对冲触发阈值"""
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, latency: float):
+        with self._lock:
+            self._samples.append(latency)
+    
+    def percentile(self, p: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+class ResilientCaller:
+    def __init__(self, retry: Optional[RetryPolicy] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 hedge_percentile: Optional[float] = Config.HEDGE_PERCENTILE,
+                 hedge_min_samples: int = 20):
+        """
+        提供商调用的容错层：重试 + 对冲请求 + 熔断
+
+        同一提供商的多个机器人应共用一个实例，这样熔断状态和延迟统计是共享的。
+
+        Args:
+            retry: 重试策略（默认 RetryPolicy()）
+            breaker: 熔断器（默认 CircuitBreaker()）
+            hedge_percentile: 请求耗时超过该延迟百分位仍未返回时，再发一个相同请求；
+                              None 表示关闭对冲
+            hedge_min_samples: 至少积累多少个延迟样本后才开始对冲
+        """
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency = LatencyTracker()
+        self.hedges = 0
+        self.retries = 0
+        self._pool = ThreadPoolExecutor(max_workers=Config.HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+    
+    def _hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile is None:
+            return None
+        return self.latency.percentile(self.hedge_percentile, self.hedge_min_samples)
+    
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError("服务暂时不可用（熔断中），请稍后重试")
+    
+    def _attempt(self, fn: Callable[[], str]) -> str:
+        """执行一次（可能对冲的）调用"""
+        hedge_delay = self._hedge_delay()
+        start = time.perf_counter()
+        if hedge_delay is None:
+            result = fn()
+        else:
+            futures = {self._pool.submit(fn)}
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                self.hedges += 1
+                futures.add(self._pool.submit(fn))
+            result = self._first_success(futures)
+        self.latency.record(time.perf_counter() - start)
+        return result
+    
+    @staticmethod
+    def _first_success(futures):
+        """返回最先成功的结果；全部失败时抛出最后一个异常"""
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+    
+    def call(self, fn: Callable[[], str]) -> str:
+        """按重试、对冲和熔断规则执行 fn"""
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_breaker()
+            try:
+                result = self._attempt(fn)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    # 只有后端不健康（429/5xx/连接/超时）才计入熔断，400/401 等客户端错误不影响其他会话
+                    self.breaker.record_failure()
+                if attempt >= self.retry.max_attempts or not retryable:
+                    raise
+                self.retries += 1
+                time.sleep(self.retry.delay(attempt, e))
+                continue
+            self.breaker.record_success()
+            return result
+    
+    def call_stream(self, factory: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """流式调用：只在产出第一段文本之前失败时重试，流式请求不做对冲"""
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_breaker()
+            started = False
+            try:
+                for delta in factory():
+                    started = True
+                    yield delta
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    self.breaker.record_failure()
+                if started or attempt >= self.retry.max_attempts or not retryable:
+                    raise
+                self.retries += 1
+                time.sleep(self.retry.delay(attempt, e))
+                continue
+            self.breaker.record_success()
+            return
+    
+    async def acall(self, fn) -> str:
+        """call 的异步版本，fn 为返回协程的无参函数"""
+        import asyncio
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_breaker()
+            try:
+                result = await self._aattempt(fn)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    # 只有后端不健康（429/5xx/连接/超时）才计入熔断，400/401 等客户端错误不影响其他会话
+                    self.breaker.record_failure()
+                if attempt >= self.retry.max_attempts or not retryable:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.retry.delay(attempt, e))
+                continue
+            self.breaker.record_success()
+            return result
+    
+    async def acall_stream(self, factory) -> AsyncIterator[str]:
+        """call_stream 的异步版本，factory 为返回异步迭代器的无参函数"""
+        import asyncio
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_breaker()
+            started = False
+            try:
+                async for delta in factory():
+                    started = True
+                    yield delta
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    self.breaker.record_failure()
+                if started or attempt >= self.retry.max_attempts or not retryable:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.retry.delay(attempt, e))
+                continue
+            self.breaker.record_success()
+            return
+    
+    async def _aattempt(self, fn) -> str:
+        import asyncio
+        hedge_delay = self._hedge_delay()
+        start = time.perf_counter()
+        tasks = {asyncio.ensure_future(fn())}
+        try:
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done:
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(fn()))
+            
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latency.record(time.perf_counter() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_delay": self._hedge_delay()
+        }
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = Config.RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl: float = Config.RESPONSE_CACHE_TTL,
+                 context_messages: Optional[int] = None,
+                 disk_path: Optional[str] = None,
+                 max_disk_entries: int = Config.RESPONSE_CACHE_MAX_DISK_ENTRIES,
+                 evict_interval: int = Config.RESPONSE_CACHE_EVICT_INTERVAL):
+        """
+        模型回复缓存：相同的对话在相同的系统提示词和参数下直接返回已有回复
+
+        Args:
+            max_entries: 内存层最多缓存的条目数（LRU 淘汰）
+            ttl: 缓存有效期（秒）
+            context_messages: 参与计算缓存键的末尾消息条数（None 表示完整对话；
+                              1 表示只看当前问题，只适合回答与上文无关的场景）
+            disk_path: 磁盘层 SQLite 文件路径（可选，多个进程可共享同一文件）
+            max_disk_entries: 磁盘层最多缓存的条目数（两次清理之间可能短暂超出）
+            evict_interval: 磁盘层每写入多少次清理一次过期和超量的条目
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.context_messages = context_messages
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self.evict_interval = max(1, evict_interval)
+        
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._writes = 0
+        
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        
+        if disk_path:
+            directory = os.path.dirname(disk_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS response_cache ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache(accessed_at)")
+    
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite 连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.disk_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def make_key(self, provider: str, model: str, messages: List[Dict[str, str]], params: Dict) -> str:
+        """根据提供商、模型、全部系统消息的哈希、对话消息（或末尾若干条）和采样参数计算缓存键"""
+        # 前缀稳定模式下修改过的系统提示词追加在历史中间，全部参与计算
+        system_prompts = [m["content"] for m in messages if m["role"] == "system"]
+        turns = [m for m in messages if m["role"] != "system"]
+        if self.context_messages is not None:
+            turns = turns[-self.context_messages:]
+        payload = {
+            "provider": provider,
+            "model": model,
+            "system": hashlib.sha256(json.dumps(system_prompts, ensure_ascii=False).encode("utf-8")).hexdigest(),
+            "turns": [[m["role"], m["content"]] for m in turns],
+            "params": params
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+        
+        if self.disk_path:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] > now:
+                with conn:
+                    conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                with self._lock:
+                    self._put_memory(key, row[1], row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return row[0]
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def set(self, key: str, value: str):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._put_memory(key, expires_at, value)
+            self._writes += 1
+            evict = self._writes % self.evict_interval == 0
+        
+        if self.disk_path:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now)
+                )
+                # 清理需要扫描整张表，不在每次写入时进行
+                if evict:
+                    self._evict(conn, now)
+    
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+        conn.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+    
+    def _put_memory(self, key: str, expires_at: float, value: str):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.disk_path:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM response_cache")
+    
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": self.hits / total if total else 0.0,
+                "memory_entries": len(self._memory)
+            }
@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from config import Config
+from context_window import estimate_tokens
+from resilience import CircuitBreaker
+
+
+class Backend:
+    def __init__(self, provider: str, model: str, api_key: Optional[str] = None,
+                 base_url: Optional[str] = None, name: Optional[str] = None,
+                 weight: float = 1.0, cost_per_1k_tokens: float = 0.0,
+                 cost_cap: Optional[float] = None):
+        """
+        路由器中的一个 提供商/模型 后端
+
+        Args:
+            provider: API提供商 ("openai" 或 "deepseek")
+            model: 模型名称
+            api_key: API密钥（可选，默认读取对应环境变量）
+            base_url: 自定义API基础URL（可选）
+            name: 后端名称（默认 provider/model）
+            weight: 优先级权重，越大越优先
+            cost_per_1k_tokens: 每千 token 的估算费用
+            cost_cap: 累计估算费用上限，达到后不再选择该后端（None 表示不限）
+        """
+        # 延迟导入，避免 chatbot 与 router 循环依赖
+        from chatbot import CustomerServiceChatbot
+        
+        self.name = name or f"{provider}/{model}"
+        self.provider = provider
+        self.model = model
+        self.weight = weight
+        self.cost_per_1k_tokens = cost_per_1k_tokens
+        self.cost_cap = cost_cap
+        # 仅用作该后端的调用客户端，不使用其对话历史，也不自动保存
+        self.client = CustomerServiceChatbot(api_key=api_key, model=model, provider=provider, base_url=base_url,
+                                             autosave=False)
+        self.breaker = CircuitBreaker()
+        
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.updated_at = time.monotonic()
+        self.requests = 0
+        self.failures = 0
+        self.cost = 0.0
+    
+    def complete(self, messages: List[Dict[str, str]]) -> str:
+        if self.provider == "openai":
+            return self.client._chat_openai(messages)
+        return self.client._chat_deepseek(messages)
+    
+    def stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        if self.provider == "openai":
+            return self.client._stream_openai(messages)
+        return self.client._stream_deepseek(messages)
+    
+    def snapshot(self) -> Dict:
+        return {
+            "name": self.name,
+            "latency_ewma": self.latency_ewma,
+            "error_ewma": self.error_ewma,
+            "requests": self.requests,
+            "failures": self.failures,
+            "cost": self.cost,
+            "state": self.breaker.state
+        }
+
+
+class ProviderRouter:
+    def __init__(self, backends: List[Backend], alpha: float = Config.ROUTER_EWMA_ALPHA,
+                 latency_weight: float = 1.0, error_weight: float = Config.ROUTER_ERROR_WEIGHT,
+                 cost_weight: float = 0.0, error_half_life: float = Config.ROUTER_ERROR_HALF_LIFE):
+        """
+        基于实测延迟的多后端路由：每轮选择得分最优的健康后端，失败时在同一轮内切换到下一个
+
+        得分 = (latency_weight * 延迟EWMA + error_weight * 错误率EWMA + cost_weight * 千token费用) / weight，
+        越低越好；尚无延迟样本的后端得分为 0，会被优先探测。
+
+        Args:
+            backends: 后端列表
+            alpha: EWMA 平滑系数（越大越看重最近的请求）
+            latency_weight: 延迟（秒）在得分中的权重
+            error_weight: 错误率在得分中的权重
+            cost_weight: 费用在得分中的权重
+            error_half_life: 错误率在无请求时衰减一半所需的时间（秒）
+        """
+        if not backends:
+            raise ValueError("ProviderRouter requires at least one backend.")
+        self.backends = backends
+        self.alpha = alpha
+        self.latency_weight = latency_weight
+        self.error_weight = error_weight
+        self.cost_weight = cost_weight
+        self.error_half_life = error_half_life
+        self.last_backend: Optional[Backend] = None
+        self._lock = threading.Lock()
+    
+    def error_rate(self, backend: Backend) -> float:
+        """错误率 EWMA 随时间衰减，长时间未被选中的故障后端会重新得到探测机会"""
+        idle = time.monotonic() - backend.updated_at
+        return backend.error_ewma * 0.5 ** (idle / self.error_half_life)
+    
+    def score(self, backend: Backend) -> float:
+        latency = backend.latency_ewma or 0.0
+        raw = (self.latency_weight * latency
+               + self.error_weight * self.error_rate(backend)
+               + self.cost_weight * backend.cost_per_1k_tokens)
+        return raw / backend.weight
+    
+    def candidates(self) -> List[Backend]:
+        """按得分排序的可用后端（排除熔断中和超出费用上限的后端）"""
+        with self._lock:
+            available = [
+                b for b in self.backends
+                if b.cost_cap is None or b.cost < b.cost_cap
+            ]
+            available.sort(key=self.score)
+        return [b for b in available if b.breaker.is_available()]
+    
+    def _record(self, backend: Backend, latency: Optional[float], tokens: int = 0):
+        with self._lock:
+            backend.requests += 1
+            backend.error_ewma = self.error_rate(backend)
+            backend.updated_at = time.monotonic()
+            if latency is None:
+                backend.failures += 1
+                backend.error_ewma += self.alpha * (1.0 - backend.error_ewma)
+            else:
+                backend.error_ewma *= 1.0 - self.alpha
+                if backend.latency_ewma is None:
+                    backend.latency_ewma = latency
+                else:
+                    backend.latency_ewma += self.alpha * (latency - backend.latency_ewma)
+                backend.cost += tokens / 1000 * backend.cost_per_1k_tokens
+        if latency is None:
+            backend.breaker.record_failure()
+        else:
+            backend.breaker.record_success()
+    
+    @staticmethod
+    def _estimate_tokens(messages: List[Dict[str, str]], reply: str) -> int:
+        return sum(estimate_tokens(m["content"]) for m in messages) + estimate_tokens(reply)
+    
+    def complete(self, messages: List[Dict[str, str]]) -> str:
+        """把本轮请求发送到最优后端，失败时依次切换，全部失败时抛出最后一个异常"""
+        candidates = self.candidates()
+        if not candidates:
+            raise RuntimeError("没有可用的后端（全部熔断或超出费用上限）")
+        
+        error = None
+        for backend in candidates:
+            # 真正调用前才占用半开探测名额，排在后面未被尝试的后端不受影响
+            if not backend.breaker.allow():
+                continue
+            start = time.perf_counter()
+            try:
+                reply = backend.complete(messages)
+            except Exception as e:
+                self._record(backend, None)
+                error = e
+                continue
+            self._record(backend, time.perf_counter() - start, self._estimate_tokens(messages, reply))
+            self.last_backend = backend
+            return reply
+        raise error or RuntimeError("没有可用的后端（全部熔断或超出费用上限）")
+    
+    def stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """流式版本：在产出第一段文本之前失败时切换后端，延迟按首个 token 的时间统计"""
+        candidates = self.candidates()
+        if not candidates:
+            raise RuntimeError("没有可用的后端（全部熔断或超出费用上限）")
+        
+        error = None
+        for backend in candidates:
+            if not backend.breaker.allow():
+                continue
+            start = time.perf_counter()
+            first_token = None
+            chunks = []
+            try:
+                for delta in backend.stream(messages):
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    chunks.append(delta)
+                    yield delta
+            except Exception as e:
+                self._record(backend, None)
+                if first_token is not None:
+                    raise
+                error = e
+                continue
+            self._record(backend, first_token or time.perf_counter() - start,
+                         self._estimate_tokens(messages, "".join(chunks)))
+            self.last_backend = backend
+            return
+        raise error or RuntimeError("没有可用的后端（全部熔断或超出费用上限）")
+    
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [b.snapshot() for b in self.backends]
+
+
+def build_router_from_env() -> Optional[ProviderRouter]:
+    """根据已配置的 API Key 创建路由器；只配置了一个或没有配置时返回 None"""
+    backends = []
+    if os.getenv("OPENAI_API_KEY"):
+        backends.append(Backend("openai", Config.OPENAI_DEFAULT_MODEL))
+    if os.getenv("DEEPSEEK_API_KEY"):
+        backends.append(Backend("deepseek", Config.DEEPSEEK_DEFAULT_MODEL))
+    if len(backends) < 2:
+        return None
+    return ProviderRouter(backends)
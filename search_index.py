@@ -0,0 +1,396 @@
+"""
+对话全文检索
+
+所有保存过的消息建一个倒排索引（SQLite FTS5），分词在 Python 侧完成后以空格分隔写入：
+- 中日韩文字按相邻两字切分（bigram），写入 terms 列；连续文字的最后一个字另外写入 tails 列，
+  单字查询用 terms 列的前缀匹配加上 tails 列即可找到所有出现位置
+- 其他文字按单词切分并转为小写，写入 terms 列
+
+查询词按同样的规则切分后作为短语匹配（订单号这类数字串就是一个词），多个查询词之间为“与”，
+用双引号括起的部分作为一个整体短语。可按日期、角色、提供商和模型过滤。
+
+常见词可能命中数十万条消息，而 FTS5 自带的 bm25() 要先数出每个短语的全部命中才能计算 IDF，耗时随命中数增长。
+查询因此按 rowid 从新到旧取最新的若干条命中（FTS5 可直接按 rowid 倒序输出，取满即停），
+再在 Python 侧按 BM25 的词频与长度归一化公式排序。所有候选都包含全部查询词，IDF 对排序影响很小，这里省略。
+
+索引随保存和自动保存增量更新：只对新增或改动的消息分词写入。
+
+    python search_index.py rebuild              # 从在线存储和归档重建索引
+    python search_index.py query 退款 --role user
+"""
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import Config
+from messages import same_message
+
+# 假名、中日韩统一表意文字（含扩展 A）、谚文、兼容表意文字
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN = re.compile(f"([{_CJK}]+)|[^\\W_{_CJK}]+")
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text: str) -> Tuple[List[str], List[str]]:
+    """切分一条消息，返回 (terms 列的词, tails 列的词)"""
+    terms, tails = [], []
+    for match in _TOKEN.finditer(text.lower()):
+        run = match.group(1)
+        if run is None or len(run) == 1:
+            terms.append(match.group(0))
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tails.append(run[-1])
+    return terms, tails
+
+
+def match_expression(query: str) -> Optional[str]:
+    """把查询串转成 FTS5 查询表达式，没有可检索的词时返回 None"""
+    parts = []
+    for quoted, bare in _QUERY_TERM.findall(query):
+        phrase: List[str] = []
+        for match in _TOKEN.finditer((quoted or bare).lower()):
+            run = match.group(1)
+            if run is not None and len(run) == 1:
+                # 单个汉字：以它开头的 bigram，或者连续文字末尾的这个字
+                parts.append(f'(terms : "{run}" * OR tails : "{run}")')
+            elif run is not None:
+                phrase.extend(run[i:i + 2] for i in range(len(run) - 1))
+            else:
+                phrase.append(match.group(0))
+        if phrase:
+            parts.append(f'terms : "{" ".join(phrase)}"')
+    return " AND ".join(parts) or None
+
+
+def _query_terms(query: str) -> List[str]:
+    """查询串中的各个词（小写，双引号括起的部分作为一个词）"""
+    return [term.lower() for quoted, bare in _QUERY_TERM.findall(query) for term in [quoted or bare] if term]
+
+
+def _score(content: str, terms: List[str], average_length: float, k1: float = 1.2, b: float = 0.75) -> float:
+    """BM25 的词频饱和与长度归一化部分（不含 IDF），越大越相关"""
+    lowered = content.lower()
+    norm = k1 * (1 - b + b * len(lowered) / average_length)
+    score = 0.0
+    for term in terms:
+        # 词之间有空格的短语按原文可能数不到，命中的消息至少出现一次
+        frequency = max(1, lowered.count(term))
+        score += frequency * (k1 + 1) / (frequency + norm)
+    return score
+
+
+def _snippet(content: str, query: str, width: int = 40) -> str:
+    """截取第一个查询词附近的一段文字"""
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in _query_terms(query)]
+    start = min((p for p in positions if p >= 0), default=0)
+    begin = max(0, start - width // 4)
+    text = content[begin:begin + width].replace("\n", " ")
+    return ("…" if begin else "") + text + ("…" if begin + width < len(content) else "")
+
+
+class SearchIndex:
+    def __init__(self, path: str = Config.SEARCH_INDEX_PATH,
+                 candidate_limit: int = Config.SEARCH_CANDIDATE_LIMIT):
+        """
+        保存过的对话消息的倒排索引
+
+        Args:
+            path: 索引数据库文件路径
+            candidate_limit: 每次查询参与相关度排序的最新命中消息数上限
+        """
+        self.path = path
+        self.candidate_limit = candidate_limit
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS search_conversations (
+                    id INTEGER PRIMARY KEY,
+                    conversation_id TEXT NOT NULL UNIQUE,
+                    timestamp REAL NOT NULL,
+                    provider TEXT NOT NULL DEFAULT '',
+                    model TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS idx_search_conversations_timestamp ON search_conversations(timestamp);
+                CREATE TABLE IF NOT EXISTS search_messages (
+                    id INTEGER PRIMARY KEY,
+                    conversation INTEGER NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_search_messages_conversation ON search_messages(conversation, seq);
+                CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+                    terms, tails, content='', tokenize='unicode61 remove_diacritics 0'
+                );
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _conversation_row(self, conn: sqlite3.Connection, conversation_id: str, timestamp: Optional[float],
+                          provider: str, model: str) -> int:
+        """取得对话的行号；时间戳以第一次索引时为准，提供商和模型为空时保留原值"""
+        conn.execute(
+            "INSERT INTO search_conversations (conversation_id, timestamp, provider, model) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(conversation_id) DO UPDATE SET "
+            "provider = CASE WHEN excluded.provider = '' THEN provider ELSE excluded.provider END, "
+            "model = CASE WHEN excluded.model = '' THEN model ELSE excluded.model END",
+            (conversation_id, timestamp or time.time(), provider, model)
+        )
+        return conn.execute("SELECT id FROM search_conversations WHERE conversation_id = ?",
+                            (conversation_id,)).fetchone()[0]
+
+    def _truncate(self, conn: sqlite3.Connection, row: int, keep: int):
+        """删除对话第 keep 条及之后的消息（无内容的 FTS5 表删除时要提供原来的词）"""
+        stale = conn.execute("SELECT id, content FROM search_messages WHERE conversation = ? AND seq >= ?",
+                             (row, keep)).fetchall()
+        conn.executemany(
+            "INSERT INTO search_fts (search_fts, rowid, terms, tails) VALUES ('delete', ?, ?, ?)",
+            [(message_id, *map(" ".join, tokenize(content))) for message_id, content in stale]
+        )
+        conn.execute("DELETE FROM search_messages WHERE conversation = ? AND seq >= ?", (row, keep))
+
+    def _insert(self, conn: sqlite3.Connection, row: int, start: int, messages: List[Dict[str, str]]):
+        for seq, message in enumerate(messages, start):
+            message_id = conn.execute(
+                "INSERT INTO search_messages (conversation, seq, role, content) VALUES (?, ?, ?, ?)",
+                (row, seq, message["role"], message["content"])
+            ).lastrowid
+            terms, tails = tokenize(message["content"])
+            conn.execute("INSERT INTO search_fts (rowid, terms, tails) VALUES (?, ?, ?)",
+                         (message_id, " ".join(terms), " ".join(tails)))
+
+    def update(self, conversation_id: str, keep: int, messages: List[Dict[str, str]],
+               timestamp: Optional[float] = None, provider: str = "", model: str = ""):
+        """保留对话前 keep 条消息的索引，之后的替换为 messages（与自动保存的追加记录一一对应）"""
+        conn = self._connect()
+        with conn:
+            row = self._conversation_row(conn, conversation_id, timestamp, provider, model)
+            self._truncate(conn, row, keep)
+            self._insert(conn, row, keep, messages)
+
+    def index_conversation(self, conversation_id: str, history: List[Dict[str, str]],
+                           timestamp: Optional[float] = None, provider: str = "", model: str = ""):
+        """索引一段完整对话：与已索引的消息比较，只重建第一条不同的消息及之后的部分"""
+        conn = self._connect()
+        with conn:
+            row = self._conversation_row(conn, conversation_id, timestamp, provider, model)
+            indexed = conn.execute("SELECT role, content FROM search_messages WHERE conversation = ? ORDER BY seq",
+                                   (row,)).fetchall()
+            keep = 0
+            limit = min(len(indexed), len(history))
+            while keep < limit and same_message({"role": indexed[keep][0], "content": indexed[keep][1]},
+                                                history[keep]):
+                keep += 1
+            if keep == len(indexed) == len(history):
+                return
+            self._truncate(conn, row, keep)
+            self._insert(conn, row, keep, history[keep:])
+
+    def remove(self, conversation_id: str):
+        conn = self._connect()
+        with conn:
+            found = conn.execute("SELECT id FROM search_conversations WHERE conversation_id = ?",
+                                 (conversation_id,)).fetchone()
+            if found:
+                self._truncate(conn, found[0], 0)
+                conn.execute("DELETE FROM search_conversations WHERE id = ?", found)
+
+    def rebuild(self, conversations: Iterable[Tuple[str, float, List[Dict[str, str]], str, str]],
+                batch: int = 1000) -> int:
+        """清空索引后批量写入 (对话 ID, 时间戳, 历史, 提供商, 模型)，返回索引的消息数"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM search_messages")
+            conn.execute("DELETE FROM search_conversations")
+            conn.execute("INSERT INTO search_fts (search_fts) VALUES ('delete-all')")
+        total = 0
+        pending = 0
+        conn.execute("BEGIN")
+        try:
+            for conversation_id, timestamp, history, provider, model in conversations:
+                row = self._conversation_row(conn, conversation_id, timestamp, provider, model)
+                self._insert(conn, row, 0, history)
+                total += len(history)
+                pending += 1
+                if pending >= batch:
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN")
+                    pending = 0
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with conn:
+            conn.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+        return total
+
+    def search(self, query: str, limit: int = 20, offset: int = 0,
+               start: Optional[float] = None, end: Optional[float] = None, role: Optional[str] = None,
+               provider: Optional[str] = None, model: Optional[str] = None,
+               per_conversation: bool = False) -> List[Dict]:
+        """
+        检索消息，按相关度排序
+
+        Args:
+            query: 查询串；空格分隔的词之间为“与”，双引号括起的部分作为一个短语
+            start, end: 对话时间范围（时间戳，左闭右开）
+            role, provider, model: 只检索指定角色的消息 / 指定提供商、模型的对话
+            per_conversation: 每个对话只返回相关度最高的一条消息
+        排序只在最新的 candidate_limit 条命中消息中进行
+        Returns:
+            命中的消息：对话 ID、序号、角色、时间戳、提供商、模型、摘要和得分（越大越相关）
+        """
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        conn = self._connect()
+        conditions, params = ["search_fts MATCH ?"], [expression]
+        for column, value in (("m.role", role), ("c.provider", provider), ("c.model", model)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if start is not None:
+            conditions.append("c.timestamp >= ?")
+            params.append(start)
+            # 对话内消息的 rowid 随序号递增，时间范围内各对话第一条消息的最小 rowid 就是命中结果的下界，
+            # 交给 FTS5 后时间范围很窄时不必扫描更早的全部命中（CROSS JOIN 固定从时间索引出发）
+            lower = conn.execute(
+                "SELECT MIN(m.id) FROM search_conversations c "
+                "CROSS JOIN search_messages m ON m.conversation = c.id AND m.seq = 0 WHERE c.timestamp >= ?", (start,)
+            ).fetchone()[0]
+            if lower is None:
+                return []
+            conditions.append("search_fts.rowid >= ?")
+            params.append(lower)
+        if end is not None:
+            conditions.append("c.timestamp < ?")
+            params.append(end)
+        rows = conn.execute(
+            "SELECT c.conversation_id, m.seq, m.role, m.content, c.timestamp, c.provider, c.model "
+            "FROM search_fts JOIN search_messages m ON m.id = search_fts.rowid "
+            "JOIN search_conversations c ON c.id = m.conversation "
+            f"WHERE {' AND '.join(conditions)} ORDER BY search_fts.rowid DESC LIMIT ?",
+            (*params, self.candidate_limit)
+        ).fetchall()
+        if not rows:
+            return []
+        terms = _query_terms(query)
+        average_length = max(1.0, sum(len(r[3]) for r in rows) / len(rows))
+        # 候选按从新到旧排列，稳定排序使得分相同时较新的在前
+        ranked = sorted(((_score(r[3], terms, average_length), r) for r in rows), key=lambda item: -item[0])
+        if per_conversation:
+            best: Dict[str, Tuple[float, tuple]] = {}
+            for item in ranked:
+                best.setdefault(item[1][0], item)
+            ranked = list(best.values())
+        return [{
+            "conversation_id": r[0], "seq": r[1], "role": r[2], "snippet": _snippet(r[3], query),
+            "timestamp": r[4], "provider": r[5], "model": r[6], "score": score
+        } for score, r in ranked[offset:offset + limit]]
+
+    def metadata(self, conversation_ids: List[str]) -> Dict[str, Tuple[str, str]]:
+        """批量查询对话的 (提供商, 模型)，未索引的对话不出现在结果中"""
+        conn = self._connect()
+        found = {}
+        for i in range(0, len(conversation_ids), 500):
+            chunk = conversation_ids[i:i + 500]
+            rows = conn.execute(
+                "SELECT conversation_id, provider, model FROM search_conversations "
+                f"WHERE conversation_id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            found.update((row[0], (row[1], row[2])) for row in rows)
+        return found
+
+    def count(self) -> int:
+        """已索引的消息数"""
+        return self._connect().execute("SELECT COUNT(*) FROM search_messages").fetchone()[0]
+
+
+_shared_index: Optional[SearchIndex] = None
+_shared_lock = threading.Lock()
+
+
+def open_search_index() -> SearchIndex:
+    """获取进程内共享的检索索引"""
+    global _shared_index
+    with _shared_lock:
+        if _shared_index is None:
+            _shared_index = SearchIndex(Config.SEARCH_INDEX_PATH)
+        return _shared_index
+
+
+def iter_all_conversations(store) -> Iterable[Tuple[str, float, List[Dict[str, str]], str, str]]:
+    """
+    遍历存储中的全部对话（在线存储与归档），供重建索引使用
+
+    按时间从旧到新输出，使重建后消息的 rowid 顺序与时间顺序一致（查询时按 rowid 倒序取最新的命中结果）。
+    """
+    tiers = [getattr(store, "live", store)]
+    if getattr(store, "archive", None) is not None:
+        tiers.append(store.archive)
+    entries, seen = [], set()
+    for tier in tiers:
+        offset, page = 0, 500
+        while True:
+            items = tier.list_conversations(offset, page)
+            for item in items:
+                # 打包中途崩溃时可能两层都有，以在线存储为准
+                if item["id"] not in seen:
+                    seen.add(item["id"])
+                    entries.append((item["timestamp"], item["id"], tier))
+            if len(items) < page:
+                break
+            offset += page
+    entries.sort(key=lambda entry: entry[:2])
+    for timestamp, conversation_id, tier in entries:
+        yield conversation_id, timestamp, tier.load(conversation_id), "", ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对话全文检索工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="从在线存储和归档重建索引")
+    rebuild.add_argument("--backend", default=Config.CONVERSATION_STORAGE, help="在线存储后端")
+    query = subparsers.add_parser("query", help="检索对话")
+    query.add_argument("text", help="查询串")
+    query.add_argument("--role", choices=["user", "assistant", "system"])
+    query.add_argument("--provider")
+    query.add_argument("--model")
+    query.add_argument("--since", help="起始日期 YYYY-MM-DD")
+    query.add_argument("--until", help="截止日期 YYYY-MM-DD（不含）")
+    query.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    index = SearchIndex(Config.SEARCH_INDEX_PATH)
+    if args.command == "rebuild":
+        from storage import open_store
+        started = time.perf_counter()
+        total = index.rebuild(iter_all_conversations(open_store(args.backend, read_only=True)))
+        print(f"已索引 {total} 条消息，耗时 {time.perf_counter() - started:.1f} 秒")
+    elif args.command == "query":
+        def parse_date(value):
+            return time.mktime(time.strptime(value, "%Y-%m-%d")) if value else None
+        started = time.perf_counter()
+        hits = index.search(args.text, args.limit, role=args.role, provider=args.provider, model=args.model,
+                            start=parse_date(args.since), end=parse_date(args.until))
+        print(f"{len(hits)} 条结果，耗时 {(time.perf_counter() - started) * 1000:.1f} ms")
+        for hit in hits:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(hit["timestamp"]))
+            print(f"{when}  {hit['conversation_id']}#{hit['seq']} [{hit['role']}] {hit['snippet']}")
@@ -0,0 +1,189 @@
+import json
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+
+
+_NORMALIZE_PATTERN = re.compile(r"[\s\u3000-\u303f\uff01-\uff0f\uff1a-\uff20!-/:-@\[-`{-~]+")
+
+
+def embed_text(text: str, bits: int = Config.SEMANTIC_CACHE_HASH_BITS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    用字符 n-gram 哈希把文本映射为 L2 归一化的稀疏向量，无需网络和模型
+
+    去掉空白和标点后取 2-gram 与 3-gram（不足两个字符时取单字），
+    适合不分词的中文文本。
+
+    Returns:
+        (特征下标数组, 对应权重数组)
+    """
+    text = _NORMALIZE_PATTERN.sub("", text.lower())
+    mask = (1 << bits) - 1
+    grams = [text[i:i + n] for n in (2, 3) for i in range(len(text) - n + 1)] or list(text)
+    
+    counts: Dict[int, float] = {}
+    for gram in grams:
+        feature = zlib.crc32(gram.encode("utf-8")) & mask
+        counts[feature] = counts.get(feature, 0.0) + 1.0
+    
+    features = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    weights = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    norm = np.linalg.norm(weights)
+    if norm:
+        weights /= norm
+    return features, weights
+
+
+class SemanticFAQCache:
+    def __init__(self, threshold: float = Config.SEMANTIC_CACHE_THRESHOLD,
+                 bits: int = Config.SEMANTIC_CACHE_HASH_BITS,
+                 merge_every: int = 256, auto_add: bool = False):
+        """
+        本地语义 FAQ 缓存：对首轮问题做近邻检索，足够相似时直接返回已有答案
+
+        向量以稀疏矩阵的形式存放在 NumPy 数组中，并按特征排序（倒排），
+        查询只访问与问题共享 n-gram 的条目，10 万条时单次查询仍在亚毫秒级。
+        新条目先进入一个小的尾段，积累到 merge_every 条后再并入主索引。
+
+        Args:
+            threshold: 余弦相似度阈值，达到该值才视为命中
+            bits: 特征哈希空间的位数
+            merge_every: 尾段积累多少条后合并到主索引
+            auto_add: 是否把模型对首轮问题的回答自动加入缓存
+        """
+        self.threshold = threshold
+        self.bits = bits
+        self.merge_every = merge_every
+        self.auto_add = auto_add
+        
+        self.questions: List[str] = []
+        self.answers: List[str] = []
+        
+        # 主索引：按特征排序的 (特征, 条目, 权重) 三元组
+        self._main = self._empty_segment()
+        # 尾段：尚未合并的新条目，查询前按需排序
+        self._tail: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._tail_sorted: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _empty_segment() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+    
+    @staticmethod
+    def _sort_segment(parts) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        features = np.concatenate([p[0] for p in parts])
+        entries = np.concatenate([p[1] for p in parts])
+        weights = np.concatenate([p[2] for p in parts])
+        order = np.argsort(features, kind="stable")
+        return features[order], entries[order], weights[order]
+    
+    def __len__(self) -> int:
+        return len(self.answers)
+    
+    def add(self, question: str, answer: str):
+        self.add_many([(question, answer)])
+    
+    def add_many(self, pairs):
+        """批量加入 (问题, 答案) 对"""
+        with self._lock:
+            for question, answer in pairs:
+                features, weights = embed_text(question, self.bits)
+                entry = len(self.answers)
+                self.questions.append(question)
+                self.answers.append(answer)
+                self._tail.append((features, np.full(len(features), entry, dtype=np.int32), weights))
+            self._tail_sorted = None
+            if len(self._tail) >= self.merge_every:
+                self._main = self._sort_segment([self._main] + self._tail)
+                self._tail = []
+    
+    def _accumulate(self, scores: np.ndarray, segment, query_features: np.ndarray,
+                    query_weights: np.ndarray, query_ids: np.ndarray):
+        """把一个排序段对一批查询的内积累加到 scores（扁平的 查询数 × 条目数 数组）"""
+        features, entries, weights = segment
+        if len(features) == 0:
+            return
+        lo = np.searchsorted(features, query_features, side="left")
+        hi = np.searchsorted(features, query_features, side="right")
+        lengths = hi - lo
+        total = int(lengths.sum())
+        if total == 0:
+            return
+        
+        # 展开每个查询特征命中的倒排区间
+        positions = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        products = np.repeat(query_weights, lengths) * weights[positions]
+        cells = np.repeat(query_ids, lengths) * len(self.answers) + entries[positions]
+        scores += np.bincount(cells, weights=products, minlength=len(scores))
+    
+    def lookup_batch(self, questions: List[str]) -> List[Optional[Tuple[str, float]]]:
+        """批量查询，返回每个问题命中的 (答案, 相似度)，未命中为 None"""
+        if not questions or not self.answers:
+            return [None] * len(questions)
+        
+        results = []
+        with self._lock:
+            if self._tail and self._tail_sorted is None:
+                self._tail_sorted = self._sort_segment(self._tail)
+            segments = [self._main] + ([self._tail_sorted] if self._tail else [])
+            n_entries = len(self.answers)
+            # 控制分数矩阵大小，单批不超过约 400 万个单元
+            batch_size = max(1, 4_000_000 // n_entries)
+            
+            for start in range(0, len(questions), batch_size):
+                batch = questions[start:start + batch_size]
+                embedded = [embed_text(q, self.bits) for q in batch]
+                query_features = np.concatenate([f for f, _ in embedded])
+                query_weights = np.concatenate([w for _, w in embedded])
+                query_ids = np.repeat(np.arange(len(batch), dtype=np.int64), [len(f) for f, _ in embedded])
+                
+                scores = np.zeros(len(batch) * n_entries)
+                for segment in segments:
+                    self._accumulate(scores, segment, query_features, query_weights, query_ids)
+                scores = scores.reshape(len(batch), n_entries)
+                
+                best = scores.argmax(axis=1)
+                for i, entry in enumerate(best):
+                    score = float(scores[i, entry])
+                    results.append((self.answers[entry], score) if score >= self.threshold else None)
+        return results
+    
+    def lookup(self, question: str) -> Optional[Tuple[str, float]]:
+        return self.lookup_batch([question])[0]
+    
+    def load_faq(self, filename: str):
+        """从 JSONL 文件（每行 {"question": ..., "answer": ...}）导入 FAQ"""
+        with open(filename, 'r', encoding='utf-8') as f:
+            pairs = [(item["question"], item["answer"]) for item in map(json.loads, f) if item]
+        self.add_many(pairs)
+    
+    def save(self, filename: str):
+        with self._lock:
+            if self._tail:
+                self._main = self._sort_segment([self._main] + self._tail)
+                self._tail = []
+            texts = json.dumps({"questions": self.questions, "answers": self.answers}, ensure_ascii=False)
+            np.savez_compressed(
+                filename,
+                features=self._main[0],
+                entries=self._main[1],
+                weights=self._main[2],
+                texts=np.frombuffer(texts.encode("utf-8"), dtype=np.uint8),
+                bits=self.bits
+            )
+    
+    @classmethod
+    def load(cls, filename: str, **kwargs) -> "SemanticFAQCache":
+        with np.load(filename) as data:
+            cache = cls(bits=int(data["bits"]), **kwargs)
+            cache._main = (data["features"], data["entries"], data["weights"])
+            texts = json.loads(data["texts"].tobytes().decode("utf-8"))
+        cache.questions = texts["questions"]
+        cache.answers = texts["answers"]
+        return cache
@@ -0,0 +1,331 @@
+"""
+进行中会话的外部存储
+
+对话历史不再只存在于某个进程的内存里：每轮对话结束后写回会话存储，
+任何 worker（Streamlit 进程或 api_server 的 worker）都可以接着服务同一个会话，重启也不会丢失。
+
+- 写入只追加上次保存之后新增的消息（重置、修改系统提示词时才会截断重写）
+- 每个会话带版本号，写入时比较版本（乐观并发），两个 worker 同时修改同一会话时
+  后提交的一方得到 VersionConflict，而不是悄悄覆盖对方的内容
+- 本地使用 SQLite 后端；多节点部署可以换成 Redis 后端
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from messages import MessageList, common_prefix, to_wire
+from storage import new_conversation_id
+
+
+def new_session_id() -> str:
+    """会话 ID 与对话 ID 使用同一格式（带随机后缀，同一秒内创建也不会冲突）"""
+    return new_conversation_id()
+
+
+class VersionConflict(Exception):
+    """会话在读取之后已被其他 worker 修改"""
+
+    def __init__(self, session_id: str, expected: int, actual: Optional[int] = None):
+        super().__init__(f"会话 {session_id} 已被其他请求修改（期望版本 {expected}，当前版本 {actual}）")
+        self.session_id = session_id
+        self.expected = expected
+        self.actual = actual
+
+
+class SessionStore:
+    """会话存储接口；会话不存在时 fetch/commit 抛出 FileNotFoundError，与对话存储一致"""
+
+    def create(self, session_id: str, messages: List[Dict[str, str]]) -> int:
+        """创建会话并返回初始版本号"""
+        raise NotImplementedError
+
+    def fetch(self, session_id: str) -> Tuple[List[Dict[str, str]], int]:
+        """返回 (消息列表, 版本号)"""
+        raise NotImplementedError
+
+    def commit(self, session_id: str, base_version: int, keep: int, messages: List[Dict[str, str]]) -> int:
+        """
+        保留前 keep 条消息、在其后追加 messages，返回新版本号
+
+        当前版本不等于 base_version 时抛出 VersionConflict，不做任何修改。
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def open(self, session_id: str) -> "Session":
+        """打开会话，消息在首次访问 history 时才读取"""
+        return Session(self, session_id)
+
+
+class Session:
+    def __init__(self, store: SessionStore, session_id: str):
+        """
+        一个会话的本地句柄：惰性加载历史，并记住上次同步到存储的内容与版本
+
+        save() 与已持久化的内容比较出公共前缀，只提交之后变化的消息。
+        """
+        self.store = store
+        self.session_id = session_id
+        self._history: Optional[MessageList] = None
+        # 上次同步到存储的消息对象（与 history 共享，不复制内容）
+        self._persisted: List = []
+        self.version: Optional[int] = None
+
+    @property
+    def history(self) -> MessageList:
+        if self._history is None:
+            self.refresh()
+        return self._history
+
+    def refresh(self) -> MessageList:
+        """丢弃本地内容，重新从存储读取"""
+        messages, version = self.store.fetch(self.session_id)
+        self._history = MessageList(messages)
+        self._persisted = list(self._history)
+        self.version = version
+        return self._history
+
+    def save(self, history: Optional[List[Dict[str, str]]] = None) -> bool:
+        """
+        把 history（默认为本地历史）写回存储，没有变化时不访问存储
+
+        Returns:
+            是否实际写入
+        Raises:
+            VersionConflict: 会话已被其他 worker 修改，调用方应 refresh() 后重试或提示用户
+        """
+        if history is None:
+            history = self.history
+        if self.version is None:
+            self.refresh()
+
+        keep = common_prefix(history, self._persisted)
+        if keep == len(self._persisted) == len(history):
+            return False
+
+        self.version = self.store.commit(self.session_id, self.version, keep, history[keep:])
+        self._persisted = self._persisted[:keep] + list(history[keep:])
+        self._history = history
+        return True
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str = Config.SESSION_DB_PATH):
+        """
+        基于 SQLite 的会话存储，适合单机多进程
+
+        版本检查和消息写入在同一个事务中完成，WAL 模式下读取不会被写入阻塞。
+
+        Args:
+            path: 数据库文件路径
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+
+        conn = self._connect()
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS session_messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at);
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite 连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, session_id: str, messages: List[Dict[str, str]]) -> int:
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO sessions (id, version, message_count, updated_at) VALUES (?, 1, ?, ?)",
+                (session_id, len(messages), time.time())
+            )
+            conn.executemany(
+                "INSERT INTO session_messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, seq, m["role"], m["content"]) for seq, m in enumerate(messages)]
+            )
+        return 1
+
+    def fetch(self, session_id: str) -> Tuple[List[Dict[str, str]], int]:
+        conn = self._connect()
+        # 版本号和消息在同一个读事务中读取，保证二者一致
+        with conn:
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f"Session not found: {session_id}")
+            rows = conn.execute(
+                "SELECT role, content FROM session_messages WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows], row[0]
+
+    def commit(self, session_id: str, base_version: int, keep: int, messages: List[Dict[str, str]]) -> int:
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE sessions SET version = version + 1, message_count = ?, updated_at = ? "
+                "WHERE id = ? AND version = ?",
+                (keep + len(messages), time.time(), session_id, base_version)
+            )
+            if cursor.rowcount == 0:
+                row = conn.execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                if row is None:
+                    raise FileNotFoundError(f"Session not found: {session_id}")
+                raise VersionConflict(session_id, base_version, row[0])
+            conn.execute("DELETE FROM session_messages WHERE session_id = ? AND seq >= ?", (session_id, keep))
+            conn.executemany(
+                "INSERT INTO session_messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, keep + i, m["role"], m["content"]) for i, m in enumerate(messages)]
+            )
+        return base_version + 1
+
+    def delete(self, session_id: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def purge(self, max_age: float = Config.SESSION_TTL) -> int:
+        """删除超过 max_age 秒未更新的会话，返回删除的数量"""
+        cutoff = time.time() - max_age
+        conn = self._connect()
+        with conn:
+            ids = [row[0] for row in conn.execute("SELECT id FROM sessions WHERE updated_at < ?", (cutoff,))]
+            conn.executemany("DELETE FROM session_messages WHERE session_id = ?", [(i,) for i in ids])
+            conn.executemany("DELETE FROM sessions WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+
+# 比较版本后截断并追加，整个过程在 Redis 内原子执行
+_REDIS_COMMIT_SCRIPT = """
+local version = tonumber(redis.call('GET', KEYS[1]) or '-1')
+if version == -1 then return -2 end
+if version ~= tonumber(ARGV[1]) then return -1 end
+local keep = tonumber(ARGV[2])
+if keep == 0 then
+    redis.call('DEL', KEYS[2])
+else
+    redis.call('LTRIM', KEYS[2], 0, keep - 1)
+end
+for i = 4, #ARGV do
+    redis.call('RPUSH', KEYS[2], ARGV[i])
+end
+redis.call('SET', KEYS[1], version + 1)
+local ttl = tonumber(ARGV[3])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+return version + 1
+"""
+
+
+class RedisSessionStore(SessionStore):
+    def __init__(self, client, prefix: str = "chatbot:session:", ttl: int = Config.SESSION_TTL):
+        """
+        基于 Redis 的会话存储，供多节点部署共享
+
+        每个会话对应一个版本键和一个消息列表（每条消息一个 JSON 元素），
+        提交通过 Lua 脚本原子地完成版本比较、截断和追加。
+
+        Args:
+            client: redis.Redis 客户端（decode_responses=True）
+            prefix: 键前缀
+            ttl: 会话过期时间（秒），每次提交后刷新；0 表示不过期
+        """
+        self.client = client
+        self.prefix = prefix
+        self.ttl = int(ttl)
+        self._commit = client.register_script(_REDIS_COMMIT_SCRIPT)
+
+    def _keys(self, session_id: str) -> Tuple[str, str]:
+        return f"{self.prefix}{session_id}:version", f"{self.prefix}{session_id}:messages"
+
+    def create(self, session_id: str, messages: List[Dict[str, str]]) -> int:
+        version_key, messages_key = self._keys(session_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(messages_key)
+        if messages:
+            pipe.rpush(messages_key, *[json.dumps(m, ensure_ascii=False) for m in to_wire(messages)])
+        pipe.set(version_key, 1)
+        if self.ttl:
+            pipe.expire(version_key, self.ttl)
+            pipe.expire(messages_key, self.ttl)
+        pipe.execute()
+        return 1
+
+    def fetch(self, session_id: str) -> Tuple[List[Dict[str, str]], int]:
+        version_key, messages_key = self._keys(session_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(version_key)
+        pipe.lrange(messages_key, 0, -1)
+        version, items = pipe.execute()
+        if version is None:
+            raise FileNotFoundError(f"Session not found: {session_id}")
+        return [json.loads(item) for item in items], int(version)
+
+    def commit(self, session_id: str, base_version: int, keep: int, messages: List[Dict[str, str]]) -> int:
+        version_key, messages_key = self._keys(session_id)
+        result = int(self._commit(
+            keys=[version_key, messages_key],
+            args=[base_version, keep, self.ttl] + [json.dumps(m, ensure_ascii=False) for m in to_wire(messages)]
+        ))
+        if result == -2:
+            raise FileNotFoundError(f"Session not found: {session_id}")
+        if result == -1:
+            raise VersionConflict(session_id, base_version)
+        return result
+
+    def delete(self, session_id: str):
+        self.client.delete(*self._keys(session_id))
+
+
+_shared_stores: Dict[str, SessionStore] = {}
+_shared_lock = threading.Lock()
+
+
+def open_session_store(backend: str = Config.SESSION_STORE) -> SessionStore:
+    """按名称获取进程内共享的会话存储（"sqlite" 或 "redis"）"""
+    with _shared_lock:
+        store = _shared_stores.get(backend)
+        if store is None:
+            if backend == "sqlite":
+                store = SQLiteSessionStore(Config.SESSION_DB_PATH)
+            elif backend == "redis":
+                try:
+                    import redis
+                except ImportError:
+                    raise ImportError("使用 Redis 会话存储需要先安装 redis：pip install redis")
+                store = RedisSessionStore(redis.Redis.from_url(Config.SESSION_REDIS_URL, decode_responses=True))
+            else:
+                raise ValueError(f"Unsupported session store: {backend}. Use 'sqlite' or 'redis'.")
+            _shared_stores[backend] = store
+        return store
@@ -0,0 +1,264 @@
+"""
+在途请求合并（single-flight）
+
+突发时大量会话会在几秒内发出完全相同的首轮问题。指纹相同（提供商、模型、API Key 与服务地址、
+实际发送的消息和采样参数）的并发请求只向上游发起一次调用，其余调用方等待并共享结果；
+流式请求的跟随者先回放已收到的增量，再实时接收后续增量。
+调用结束后立即移除记录，之后的相同请求会重新调用（或命中回复缓存）。
+"""
+import hashlib
+import json
+import threading
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    # 异步接口运行时事件循环必然已加载 asyncio，纯同步进程不必为它付出导入时间
+    import asyncio
+
+
+def request_fingerprint(provider: str, model: str, messages: List[Dict[str, str]], params: Dict,
+                        endpoint: str = "") -> str:
+    """
+    计算请求指纹，只有完全相同的上游请求才会被合并
+
+    Args:
+        endpoint: 调用方的 API Key（哈希）与服务地址，不同账号或端点的请求不合并
+    """
+    payload = json.dumps([provider, model, endpoint, messages, params], ensure_ascii=False,
+                         sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class FlightAbandoned(RuntimeError):
+    """发起方中途放弃了流式请求且没有其他等待者"""
+
+
+class _Flight:
+    """一次在途调用：已产出的增量、最终结果或异常"""
+
+    def __init__(self, cond):
+        self.cond = cond
+        self.chunks: List[str] = []
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        相同 key 的并发调用共享一次执行
+
+        同步接口（do/stream）可跨线程合并；异步接口（ado/astream）只在同一事件循环内合并。
+        """
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._async_flights: Dict[Tuple["asyncio.AbstractEventLoop", str], _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key: str) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = _Flight(threading.Condition())
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def _leave(self, key: str, flight: _Flight) -> bool:
+        """
+        发起方放弃流时调用：没有跟随者则摘除记录并返回 True，
+        否则返回 False，由发起方继续读完上游
+        """
+        with self._lock:
+            if flight.followers > 0:
+                return False
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            return True
+
+    def _finish(self, key: str, flight: _Flight, result: Any = None, error: Optional[BaseException] = None):
+        # 先摘除记录再唤醒等待者，之后到达的相同请求会发起新的调用
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.cond:
+            flight.result = result
+            flight.error = error
+            flight.done = True
+            flight.cond.notify_all()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """执行 fn；若已有相同 key 的调用在途，则等待并返回它的结果（或抛出它的异常）"""
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, flight, error=e)
+                raise
+            self._finish(key, flight, result=result)
+            return result
+
+        with flight.cond:
+            while not flight.done:
+                flight.cond.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stream(self, key: str, factory: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        合并流式调用，返回的迭代器必须被迭代
+
+        发起方读取上游并把增量广播给跟随者；发起方中途停止读取时，
+        若仍有跟随者则继续读完上游，保证跟随者拿到完整回复。
+        """
+        flight, leader = self._join(key)
+        if leader:
+            return self._lead_stream(key, flight, factory)
+        return self._follow_stream(flight)
+
+    def _lead_stream(self, key: str, flight: _Flight, factory: Callable[[], Iterator[str]]) -> Iterator[str]:
+        consuming = True
+        try:
+            for delta in factory():
+                with flight.cond:
+                    flight.chunks.append(delta)
+                    flight.cond.notify_all()
+                if consuming:
+                    try:
+                        yield delta
+                    except GeneratorExit:
+                        if self._leave(key, flight):
+                            raise
+                        consuming = False
+        except GeneratorExit:
+            self._finish(key, flight, error=FlightAbandoned("上游流已被发起方中断"))
+            raise
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+            raise
+        self._finish(key, flight, result="".join(flight.chunks))
+
+    def _follow_stream(self, flight: _Flight) -> Iterator[str]:
+        position = 0
+        try:
+            while True:
+                with flight.cond:
+                    while position >= len(flight.chunks) and not flight.done:
+                        flight.cond.wait()
+                    pending = flight.chunks[position:]
+                    done = flight.done
+                position += len(pending)
+                yield from pending
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with self._lock:
+                flight.followers -= 1
+
+    def _ajoin(self, key: str) -> Tuple[Tuple["asyncio.AbstractEventLoop", str], _Flight, bool]:
+        import asyncio
+        # 异步接口只在事件循环线程内访问字典，无需加锁
+        flight_key = (asyncio.get_running_loop(), key)
+        flight = self._async_flights.get(flight_key)
+        if flight is not None:
+            flight.followers += 1
+            self.coalesced += 1
+            return flight_key, flight, False
+        flight = _Flight(asyncio.Condition())
+        self._async_flights[flight_key] = flight
+        self.leaders += 1
+        return flight_key, flight, True
+
+    async def _afinish(self, flight_key, flight: _Flight, result: Any = None, error: Optional[BaseException] = None):
+        if self._async_flights.get(flight_key) is flight:
+            del self._async_flights[flight_key]
+        async with flight.cond:
+            flight.result = result
+            flight.error = error
+            flight.done = True
+            flight.cond.notify_all()
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """do 的异步版本"""
+        flight_key, flight, leader = self._ajoin(key)
+        if leader:
+            try:
+                result = await fn()
+            except BaseException as e:
+                await self._afinish(flight_key, flight, error=e)
+                raise
+            await self._afinish(flight_key, flight, result=result)
+            return result
+
+        async with flight.cond:
+            await flight.cond.wait_for(lambda: flight.done)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def astream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """stream 的异步版本，返回的异步迭代器必须被迭代"""
+        flight_key, flight, leader = self._ajoin(key)
+        if leader:
+            return self._alead_stream(flight_key, flight, factory)
+        return self._afollow_stream(flight)
+
+    async def _alead_stream(self, flight_key, flight: _Flight, factory) -> AsyncIterator[str]:
+        consuming = True
+        try:
+            async for delta in factory():
+                async with flight.cond:
+                    flight.chunks.append(delta)
+                    flight.cond.notify_all()
+                if consuming:
+                    try:
+                        yield delta
+                    except GeneratorExit:
+                        if flight.followers == 0:
+                            raise
+                        consuming = False
+        except GeneratorExit:
+            await self._afinish(flight_key, flight, error=FlightAbandoned("上游流已被发起方中断"))
+            raise
+        except BaseException as e:
+            await self._afinish(flight_key, flight, error=e)
+            raise
+        await self._afinish(flight_key, flight, result="".join(flight.chunks))
+
+    async def _afollow_stream(self, flight: _Flight) -> AsyncIterator[str]:
+        position = 0
+        try:
+            while True:
+                async with flight.cond:
+                    await flight.cond.wait_for(lambda: position < len(flight.chunks) or flight.done)
+                    pending = flight.chunks[position:]
+                    done = flight.done
+                position += len(pending)
+                for delta in pending:
+                    yield delta
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.followers -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights) + len(self._async_flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+default_single_flight = SingleFlight()
@@ -0,0 +1,436 @@
+import argparse
+import glob
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+
+
+def new_conversation_id() -> str:
+    """时间只精确到秒，加随机后缀避免同一秒内保存的对话互相覆盖"""
+    return f"conversation_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}"
+
+
+def conversation_id_from(filename: str) -> str:
+    """兼容传入文件名或路径的旧用法：取不带扩展名的文件名作为对话 ID"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def timestamp_from_id(conversation_id: str) -> Optional[float]:
+    """从 conversation_YYYYmmdd_HHMMSS[_后缀] 形式的 ID 或文件名中解析时间戳"""
+    name = conversation_id_from(conversation_id)
+    try:
+        return datetime.strptime(name.replace("conversation_", "")[:15], "%Y%m%d_%H%M%S").timestamp()
+    except ValueError:
+        return None
+
+
+def time_range(column: str, start: Optional[float], end: Optional[float]) -> Tuple[str, list]:
+    """生成按时间范围（左闭右开）过滤的 WHERE 子句和参数，两端都不限时返回空子句"""
+    conditions, params = [], []
+    if start is not None:
+        conditions.append(f"{column} >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{column} < ?")
+        params.append(end)
+    return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+
+def summarize_history(history: List[Dict[str, str]], preview_length: int = 50):
+    """返回 (对话轮数, 首条用户消息预览)，供对话列表展示"""
+    user_messages = [m["content"] for m in history if m["role"] == "user"]
+    preview = user_messages[0][:preview_length] if user_messages else ""
+    return len(user_messages), preview
+
+
+class ConversationStore:
+    """对话存储后端的基类"""
+    
+    def save(self, conversation_id: Optional[str], history: List[Dict[str, str]],
+             provider: str = "", model: str = "") -> str:
+        """保存对话，返回对话 ID（conversation_id 为 None 时新建）"""
+        raise NotImplementedError
+    
+    def load(self, conversation_id: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+    
+    def delete(self, conversation_id: str):
+        raise NotImplementedError
+    
+    def list_conversations(self, offset: int = 0, limit: int = 10) -> List[Dict]:
+        """
+        按时间倒序分页返回对话元数据
+
+        Returns:
+            每项包含 id、timestamp、turn_count、preview
+        """
+        raise NotImplementedError
+    
+    def count(self) -> int:
+        raise NotImplementedError
+    
+    def listed_id(self, saved: str) -> Optional[str]:
+        """save() 返回值在列表中对应的对话 ID；不进入列表的保存返回 None"""
+        return saved
+    
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        """
+        逐个产出时间范围内的 (对话 ID, 时间戳)，不保证顺序，供全量统计流式遍历
+
+        后端应当用数据库游标实现，这里的默认实现按页读取列表。
+        """
+        offset, page = 0, 1000
+        while True:
+            items = self.list_conversations(offset, page)
+            for item in items:
+                if (start is None or item["timestamp"] >= start) and (end is None or item["timestamp"] < end):
+                    yield item["id"], item["timestamp"]
+            if len(items) < page:
+                break
+            offset += page
+
+
+class ConversationIndex:
+    def __init__(self, path: str):
+        """
+        对话元数据索引（SQLite），列表和分页不再需要扫描并解析全部对话文件
+
+        Args:
+            path: 索引数据库文件路径
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        
+        conn = self._connect()
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS conversation_index (
+                    id TEXT PRIMARY KEY,
+                    timestamp REAL NOT NULL,
+                    turn_count INTEGER NOT NULL,
+                    preview TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_conversation_index_timestamp ON conversation_index(timestamp);
+            """)
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+    
+    def upsert(self, conversation_id: str, timestamp: float, history: List[Dict[str, str]]):
+        turn_count, preview = summarize_history(history)
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversation_index (id, timestamp, turn_count, preview) VALUES (?, ?, ?, ?)",
+                (conversation_id, timestamp, turn_count, preview)
+            )
+    
+    def upsert_many(self, rows: List[tuple]):
+        """在一个事务内写入多行 (id, timestamp, turn_count, preview)；已有的行只更新轮数和预览"""
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO conversation_index (id, timestamp, turn_count, preview) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET turn_count = excluded.turn_count, preview = excluded.preview",
+                rows
+            )
+    
+    def remove(self, conversation_id: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM conversation_index WHERE id = ?", (conversation_id,))
+    
+    def page(self, offset: int, limit: int) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT id, timestamp, turn_count, preview FROM conversation_index "
+            "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+        return [{"id": r[0], "timestamp": r[1], "turn_count": r[2], "preview": r[3]} for r in rows]
+    
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM conversation_index").fetchone()[0]
+    
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        where, params = time_range("timestamp", start, end)
+        yield from self._connect().execute(f"SELECT id, timestamp FROM conversation_index{where}", params)
+
+
+class JSONFileStore(ConversationStore):
+    def __init__(self, directory: str = Config.CONVERSATION_SAVE_DIR):
+        """
+        每个对话一个 JSON 文件的存储（与早期版本的文件格式兼容）
+
+        目录下维护一个元数据索引（index.db），保存和删除时同步更新；
+        索引为空而目录中已有对话文件时会自动重建一次。
+
+        Args:
+            directory: 保存对话文件的目录
+        """
+        self.directory = directory
+        self.index = ConversationIndex(os.path.join(directory, "index.db"))
+        if self.index.count() == 0:
+            self.rebuild_index()
+    
+    def listed_id(self, filename: str) -> Optional[str]:
+        """目录内的对话文件返回其对话 ID，目录外的文件不进入索引"""
+        if os.path.dirname(os.path.abspath(filename)) != os.path.abspath(self.directory):
+            return None
+        return conversation_id_from(filename)
+    
+    def rebuild_index(self) -> int:
+        """扫描目录重建元数据索引，返回索引的对话数"""
+        count = 0
+        for filename in glob.glob(os.path.join(self.directory, "conversation_*.json")):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+            except (OSError, ValueError):
+                continue
+            conversation_id = self.listed_id(filename)
+            self.index.upsert(conversation_id, timestamp_from_id(filename) or os.path.getmtime(filename), history)
+            count += 1
+        return count
+    
+    def path_for(self, conversation_id: str) -> str:
+        # 兼容直接传入文件路径的旧用法
+        if conversation_id.endswith(".json") or os.path.dirname(conversation_id):
+            return conversation_id
+        return os.path.join(self.directory, f"{conversation_id}.json")
+    
+    def save(self, conversation_id: Optional[str], history: List[Dict[str, str]],
+             provider: str = "", model: str = "") -> str:
+        if conversation_id is None:
+            conversation_id = new_conversation_id()
+        filename = self.path_for(conversation_id)
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        # 先写临时文件再原子替换，避免中途崩溃留下半个文件
+        fd, tmp_path = tempfile.mkstemp(dir=directory or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(history, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        
+        index_id = self.listed_id(filename)
+        if index_id is not None:
+            self.index.upsert(index_id, timestamp_from_id(filename) or time.time(), history)
+        return filename
+    
+    def load(self, conversation_id: str) -> List[Dict[str, str]]:
+        with open(self.path_for(conversation_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def delete(self, conversation_id: str):
+        filename = self.path_for(conversation_id)
+        os.remove(filename)
+        index_id = self.listed_id(filename)
+        if index_id is not None:
+            self.index.remove(index_id)
+    
+    def list_conversations(self, offset: int = 0, limit: int = 10) -> List[Dict]:
+        return self.index.page(offset, limit)
+    
+    def count(self) -> int:
+        return self.index.count()
+    
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        return self.index.iter_ids(start, end)
+
+
+class SQLiteStore(ConversationStore):
+    def __init__(self, path: str = Config.CONVERSATION_DB_PATH):
+        """
+        基于 SQLite 的对话存储：每个对话一行、每条消息一行
+
+        对话表按更新时间和 提供商/模型 建索引，保存和加载只访问单个对话的行，
+        耗时与库中对话总数无关。每次保存在一个事务内完成。
+
+        Args:
+            path: 数据库文件路径
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        
+        conn = self._connect()
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    provider TEXT NOT NULL DEFAULT '',
+                    model TEXT NOT NULL DEFAULT '',
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    turn_count INTEGER NOT NULL DEFAULT 0,
+                    preview TEXT NOT NULL DEFAULT ''
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    conversation_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    PRIMARY KEY (conversation_id, seq)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at);
+                CREATE INDEX IF NOT EXISTS idx_conversations_created ON conversations(created_at);
+                CREATE INDEX IF NOT EXISTS idx_conversations_provider_model ON conversations(provider, model, updated_at);
+            """)
+            # 早期版本创建的库没有列表所需的字段
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+            if "turn_count" not in columns:
+                conn.execute("ALTER TABLE conversations ADD COLUMN turn_count INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE conversations ADD COLUMN preview TEXT NOT NULL DEFAULT ''")
+    
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite 连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def save(self, conversation_id: Optional[str], history: List[Dict[str, str]],
+             provider: str = "", model: str = "", created_at: Optional[float] = None) -> str:
+        if conversation_id is None:
+            conversation_id = new_conversation_id()
+        now = time.time()
+        turn_count, preview = summarize_history(history)
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO conversations (id, created_at, updated_at, provider, model, message_count, turn_count, preview) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at, provider = excluded.provider, "
+                "model = excluded.model, message_count = excluded.message_count, "
+                "turn_count = excluded.turn_count, preview = excluded.preview",
+                (conversation_id, created_at or now, created_at or now, provider, model, len(history),
+                 turn_count, preview)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(conversation_id, seq, m["role"], m["content"]) for seq, m in enumerate(history)]
+            )
+            conn.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND seq >= ?",
+                (conversation_id, len(history))
+            )
+        return conversation_id
+    
+    def load(self, conversation_id: str) -> List[Dict[str, str]]:
+        rows = self._connect().execute(
+            "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY seq",
+            (conversation_id,)
+        ).fetchall()
+        if not rows:
+            raise FileNotFoundError(f"Conversation not found: {conversation_id}")
+        return [{"role": role, "content": content} for role, content in rows]
+    
+    def delete(self, conversation_id: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+    
+    def list_conversations(self, offset: int = 0, limit: int = 10) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT id, created_at, turn_count, preview FROM conversations "
+            "ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+        return [{"id": r[0], "timestamp": r[1], "turn_count": r[2], "preview": r[3]} for r in rows]
+    
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    
+    def iter_ids(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[str, float]]:
+        where, params = time_range("created_at", start, end)
+        yield from self._connect().execute(f"SELECT id, created_at FROM conversations{where}", params)
+
+
+_shared_stores: Dict[Tuple[str, bool], ConversationStore] = {}
+_shared_lock = threading.Lock()
+
+
+def open_store(backend: str = Config.CONVERSATION_STORAGE, read_only: bool = False) -> ConversationStore:
+    """
+    按名称获取进程内共享的存储后端（"json"、"sqlite" 或追加式的 "log"）
+
+    返回的存储叠加了归档层：在线存储中找不到的对话从归档读取，列表同时包含已归档的对话；
+    开启全文检索时保存和删除同步更新检索索引。
+    与在线进程并行读取的工具（如分析报表）应传 read_only=True：
+    "log" 存储此时不会截断写入进程正在追加的日志。
+    """
+    key = (backend, read_only)
+    with _shared_lock:
+        store = _shared_stores.get(key)
+        if store is None:
+            if backend == "json":
+                live = JSONFileStore(Config.CONVERSATION_SAVE_DIR)
+            elif backend == "sqlite":
+                live = SQLiteStore(Config.CONVERSATION_DB_PATH)
+            elif backend == "log":
+                from append_log import AppendLogStore
+                live = AppendLogStore(Config.AUTOSAVE_DIR, read_only=read_only)
+            else:
+                raise ValueError(f"Unsupported storage backend: {backend}. Use 'json', 'sqlite' or 'log'.")
+            from archive import ConversationArchive, TieredStore
+            search = None
+            if Config.SEARCH_ENABLED:
+                from search_index import open_search_index
+                search = open_search_index()
+            store = TieredStore(live, ConversationArchive(Config.ARCHIVE_DIR), search)
+            _shared_stores[key] = store
+        return store
+
+
+def migrate_json_to_sqlite(source_dir: str, store: SQLiteStore) -> int:
+    """把目录下的 conversation_*.json 导入 SQLite 存储，返回导入的对话数"""
+    count = 0
+    for filename in sorted(glob.glob(os.path.join(source_dir, "conversation_*.json"))):
+        with open(filename, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+        conversation_id = conversation_id_from(filename)
+        created_at = timestamp_from_id(conversation_id) or os.path.getmtime(filename)
+        store.save(conversation_id, history, created_at=created_at)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对话存储工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="把 JSON 对话文件迁移到 SQLite")
+    migrate.add_argument("--source", default=Config.CONVERSATION_SAVE_DIR, help="JSON 文件所在目录")
+    migrate.add_argument("--db", default=Config.CONVERSATION_DB_PATH, help="目标 SQLite 数据库")
+    args = parser.parse_args()
+    
+    if args.command == "migrate":
+        migrated = migrate_json_to_sqlite(args.source, SQLiteStore(args.db))
+        print(f"已迁移 {migrated} 个对话到 {args.db}")
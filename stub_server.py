@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Optional
+
+from aiohttp import web
+
+
+class StubServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, chunk_delay: float = 0.0, chunk_size: int = 4,
+                 error_rate: float = 0.0, error_status: int = 503,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0, seed: Optional[int] = None,
+                 prefix_cache: bool = True, prefill_delay: float = 0.0):
+        """
+        本地 OpenAI 兼容的 /chat/completions 模拟服务，用于测试和压测
+
+        Args:
+            host: 监听地址
+            port: 监听端口（0 表示随机分配）
+            latency: 每个请求返回首字节前的延迟（秒）
+            chunk_delay: 流式输出时每个 chunk 之间的延迟（秒）
+            chunk_size: 流式输出时每个 chunk 的字符数
+            error_rate: 故障注入：请求直接返回错误状态码的概率
+            error_status: 故障注入时返回的 HTTP 状态码
+            slow_rate: 故障注入：请求额外变慢的概率（制造长尾延迟）
+            slow_latency: 变慢请求额外增加的延迟（秒）
+            seed: 故障注入随机数种子
+            prefix_cache: 模拟提供商的前缀缓存，并在 usage 中返回命中的 token 数
+            prefill_delay: 每个未命中前缀缓存的输入 token 额外增加的延迟（秒），模拟预填充耗时
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.prefix_cache = prefix_cache
+        self.prefill_delay = prefill_delay
+        self.request_count = 0
+        self.error_count = 0
+        self._random = random.Random(seed)
+        self._prefixes = set()
+        
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+    
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+    
+    def make_reply(self, messages) -> str:
+        """根据最后一条用户消息生成确定性的回复"""
+        last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        return f"收到您的问题：{last_user}"
+    
+    def lookup_prefix(self, messages) -> int:
+        """
+        模拟前缀缓存：返回与之前请求逐字相同的最长前缀（按整条消息计）的 token 数，并记住本次请求的各级前缀
+
+        长前缀被记录时它的所有短前缀也已被记录，因此遇到第一条未命中的消息即可停止。
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        cached = tokens = 0
+        hit = True
+        for m in messages:
+            digest.update(f"{m.get('role')}\0{m.get('content')}\0".encode("utf-8"))
+            tokens += len(m.get("content", ""))
+            key = digest.hexdigest()
+            if hit and key in self._prefixes:
+                cached = tokens
+            else:
+                hit = False
+                self._prefixes.add(key)
+        if len(self._prefixes) > 100000:
+            self._prefixes.clear()
+        return cached
+    
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        self.request_count += 1
+        body = await request.json()
+        reply = self.make_reply(body.get("messages", []))
+        model = body.get("model", "stub-model")
+        created = int(time.time())
+        
+        if self._random.random() < self.error_rate:
+            self.error_count += 1
+            return web.json_response(
+                {"error": {"message": "injected failure", "type": "server_error"}},
+                status=self.error_status
+            )
+        
+        messages = body.get("messages", [])
+        cached = self.lookup_prefix(messages) if self.prefix_cache else None
+        delay = self.latency
+        if self.prefill_delay:
+            delay += self.prefill_delay * (sum(len(m.get("content", "")) for m in messages) - (cached or 0))
+        if self._random.random() < self.slow_rate:
+            delay += self.slow_latency
+        if delay:
+            await asyncio.sleep(delay)
+        
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"chatcmpl-stub-{self.request_count}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop"
+                }],
+                "usage": self.make_usage(messages, reply, cached)
+            })
+        
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream; charset=utf-8"})
+        await response.prepare(request)
+        for i in range(0, len(reply), self.chunk_size):
+            chunk = {
+                "id": f"chatcmpl-stub-{self.request_count}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": reply[i:i + self.chunk_size]}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {
+                "id": f"chatcmpl-stub-{self.request_count}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": self.make_usage(messages, reply, cached)
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+    
+    def make_usage(self, messages, reply: str, cached: Optional[int] = None):
+        prompt_tokens = sum(len(m.get("content", "")) for m in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(reply),
+            "total_tokens": prompt_tokens + len(reply)
+        }
+        if cached is not None:
+            # 同时给出 DeepSeek 与 OpenAI 两种字段
+            usage["prompt_cache_hit_tokens"] = cached
+            usage["prompt_cache_miss_tokens"] = prompt_tokens - cached
+            usage["prompt_tokens_details"] = {"cached_tokens": cached}
+        return usage
+    
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat)
+        app.router.add_post("/chat/completions", self.handle_chat)
+        return app
+    
+    async def _serve(self):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port, backlog=4096)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._started.set()
+    
+    def start(self) -> "StubServer":
+        """在后台线程中启动服务"""
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._serve())
+            self._loop.run_forever()
+        
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+    
+    def stop(self):
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+    
+    def __enter__(self) -> "StubServer":
+        return self.start()
+    
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="首字节延迟（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="流式 chunk 间隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的概率")
+    parser.add_argument("--error-status", type=int, default=503, help="注入错误的状态码")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="请求变慢的概率")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="变慢请求的额外延迟（秒）")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="不模拟前缀缓存")
+    parser.add_argument("--prefill-delay", type=float, default=0.0, help="每个未命中缓存的输入 token 的延迟（秒）")
+    args = parser.parse_args()
+    
+    server = StubServer(args.host, args.port, args.latency, args.chunk_delay,
+                        error_rate=args.error_rate, error_status=args.error_status,
+                        slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                        prefix_cache=not args.no_prefix_cache, prefill_delay=args.prefill_delay)
+    server.start()
+    print(f"模拟服务已启动: {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
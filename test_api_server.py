@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import aiohttp
+import uvicorn
+
+import session_store
+from config import Config
+from stub_server import StubServer
+
+
+class ApiServer:
+    """在后台线程中运行 api_server，提供商指向本地模拟服务，会话存储放在临时目录"""
+
+    def __init__(self, stub: StubServer, directory: str):
+        self.stub = stub
+        self.directory = directory
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self.base_url = f"http://127.0.0.1:{self._sock.getsockname()[1]}"
+
+    def __enter__(self) -> "ApiServer":
+        self._saved = (os.environ.get("DEEPSEEK_API_KEY"), Config.DEEPSEEK_BASE_URL, Config.SESSION_DB_PATH)
+        os.environ["DEEPSEEK_API_KEY"] = "stub-key"
+        Config.DEEPSEEK_BASE_URL = self.stub.base_url
+        Config.SESSION_DB_PATH = os.path.join(self.directory, "sessions.db")
+        session_store._shared_stores.pop("sqlite", None)
+
+        import api_server
+        self.server = uvicorn.Server(uvicorn.Config(api_server.app, log_level="warning", lifespan="on"))
+        self._thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self._sock]}, daemon=True)
+        self._thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self._thread.join()
+        self._sock.close()
+        api_key, Config.DEEPSEEK_BASE_URL, Config.SESSION_DB_PATH = self._saved
+        if api_key is None:
+            os.environ.pop("DEEPSEEK_API_KEY", None)
+        else:
+            os.environ["DEEPSEEK_API_KEY"] = api_key
+        session_store._shared_stores.pop("sqlite", None)
+
+
+def run(scenario):
+    with tempfile.TemporaryDirectory() as directory, StubServer() as stub, ApiServer(stub, directory) as server:
+        async def main():
+            async with aiohttp.ClientSession(server.base_url) as http:
+                await scenario(http, stub)
+        asyncio.run(main())
+
+
+def test_create_chat_and_history():
+    async def scenario(http: aiohttp.ClientSession, stub: StubServer):
+        async with http.post("/sessions", json={"system_prompt": "你是售后客服"}) as response:
+            assert response.status == 201
+            session_id = (await response.json())["session_id"]
+        async with http.post(f"/sessions/{session_id}/messages", json={"message": "怎么退款"}) as response:
+            assert response.status == 200
+            body = await response.json()
+        assert body["reply"] == "收到您的问题：怎么退款"
+        assert body["call"]["provider"] == "deepseek"
+        async with http.get(f"/sessions/{session_id}/messages") as response:
+            view = await response.json()
+        assert view["system_prompt"] == "你是售后客服"
+        assert [m["role"] for m in view["messages"]] == ["user", "assistant"]
+
+        async with http.post(f"/sessions/{session_id}/reset") as response:
+            assert [m["role"] for m in (await response.json())["messages"]] == []
+
+    run(scenario)
+
+
+def test_streaming_reply_as_server_sent_events():
+    async def scenario(http: aiohttp.ClientSession, stub: StubServer):
+        async with http.post("/sessions") as response:
+            session_id = (await response.json())["session_id"]
+        async with http.post(f"/sessions/{session_id}/messages", json={"message": "在吗", "stream": True}) as response:
+            assert response.headers["Content-Type"].startswith("text/event-stream")
+            events = (await response.text()).strip().split("\n\n")
+        deltas = [json.loads(e[len("data: "):])["delta"] for e in events if e.startswith("data: ")]
+        assert events[-1].startswith("event: done")
+        done = json.loads(events[-1].split("data: ", 1)[1])
+        assert "".join(deltas) == done["reply"] == "收到您的问题：在吗"
+        assert done["call"]["stream"] is True
+        async with http.get(f"/sessions/{session_id}/messages") as response:
+            assert len((await response.json())["messages"]) == 2
+
+    run(scenario)
+
+
+def test_client_errors():
+    async def scenario(http: aiohttp.ClientSession, stub: StubServer):
+        async with http.post("/sessions/not-there/messages", json={"message": "你好"}) as response:
+            assert response.status == 404
+        async with http.get("/sessions/bad.id/messages") as response:
+            assert response.status == 400
+        async with http.post("/sessions") as response:
+            session_id = (await response.json())["session_id"]
+        async with http.post(f"/sessions/{session_id}/messages", json={"message": "  "}) as response:
+            assert response.status == 400
+        async with http.post(f"/sessions/{session_id}/messages", data="[1, 2]") as response:
+            assert response.status == 400
+        assert stub.request_count == 0
+
+    run(scenario)
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("HTTP 对话服务测试（本地模拟服务）")
+    print("=" * 50)
+    
+    test_create_chat_and_history()
+    print("✅ 创建会话、对话、查看历史和重置")
+    test_streaming_reply_as_server_sent_events()
+    print("✅ 流式回复（SSE）")
+    test_client_errors()
+    print("✅ 无效请求返回 4xx")
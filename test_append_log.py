@@ -0,0 +1,173 @@
+import os
+import tempfile
+import threading
+
+from append_log import AppendLogStore
+from chatbot import CustomerServiceChatbot
+from stub_server import StubServer
+
+
+SYSTEM = {"role": "system", "content": "你是客服"}
+
+
+def turn(i: int):
+    return [{"role": "user", "content": f"问题{i}"}, {"role": "assistant", "content": f"回答{i}"}]
+
+
+def open_log(directory: str) -> AppendLogStore:
+    return AppendLogStore(directory, compact_bytes=10 ** 9, compact_interval=3600)
+
+
+def test_group_commit_and_replay():
+    with tempfile.TemporaryDirectory() as directory:
+        store = open_log(directory)
+        ids = [store.save(None, [SYSTEM]) for _ in range(20)]
+        fsyncs = store.fsyncs
+        
+        def worker(conversation_id):
+            for i in range(10):
+                store.append(conversation_id, 1 + 2 * i, turn(i))
+        
+        threads = [threading.Thread(target=worker, args=(cid,)) for cid in ids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 并发写入合并成批，fsync 次数少于写入次数
+        assert store.fsyncs - fsyncs < 200
+        assert store.load(ids[0]) == [SYSTEM] + [m for i in range(10) for m in turn(i)]
+        assert store.count() == 20
+        store.close()
+
+
+def test_compaction_preserves_history():
+    with tempfile.TemporaryDirectory() as directory:
+        store = open_log(directory)
+        cid = store.save(None, [SYSTEM])
+        for i in range(5):
+            store.append(cid, 1 + 2 * i, turn(i))
+        before = store.load(cid)
+        assert store.compact() == 1
+        assert store.load(cid) == before
+        assert [n for n in os.listdir(directory) if n.startswith("journal.")] == ["journal.1"]
+        
+        # 折叠之后继续追加，以及截断重写
+        store.append(cid, len(before), [{"role": "user", "content": "追加"}])
+        assert store.load(cid)[-1]["content"] == "追加"
+        store.append(cid, 1, [{"role": "user", "content": "重写"}])
+        assert store.load(cid) == [SYSTEM, {"role": "user", "content": "重写"}]
+        store.close()
+
+
+def test_recovery_truncates_torn_tail_and_keeps_deletes():
+    with tempfile.TemporaryDirectory() as directory:
+        store = open_log(directory)
+        kept, deleted = store.save(None, [SYSTEM]), store.save(None, [SYSTEM])
+        store.append(kept, 1, turn(0))
+        store.delete(deleted)
+        store.close()
+        journal = os.path.join(directory, "journal.0")
+        size = os.path.getsize(journal)
+        with open(journal, "ab") as f:
+            f.write(b'{"id":"x","keep":3,"messages":[{"ro')
+        
+        store = open_log(directory)
+        assert os.path.getsize(journal) == size
+        assert store.load(kept) == [SYSTEM] + turn(0)
+        try:
+            store.load(deleted)
+        except FileNotFoundError:
+            pass
+        else:
+            raise AssertionError("deleted conversation came back after restart")
+        store.close()
+
+
+def test_read_only_reader_leaves_live_journal_alone():
+    with tempfile.TemporaryDirectory() as directory:
+        writer = open_log(directory)
+        cid = writer.save(None, [SYSTEM])
+        writer.append(cid, 1, turn(0))
+        journal = os.path.join(directory, "journal.0")
+        # 模拟写入进程正在追加的一行
+        with open(journal, "ab") as f:
+            f.write(b'{"id":"x","keep":3,"messa')
+        size = os.path.getsize(journal)
+        
+        reader = AppendLogStore(directory, read_only=True)
+        assert os.path.getsize(journal) == size
+        assert reader.load(cid) == [SYSTEM] + turn(0)
+        try:
+            reader.append(cid, 3, turn(1))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("read-only store accepted a write")
+        
+        # 写入进程折叠并删除了读取方记录的日志段，读取方重新扫描后照常读取
+        with open(journal, "r+b") as f:
+            f.truncate(size - len(b'{"id":"x","keep":3,"messa'))
+        writer.append(cid, 3, turn(1))
+        writer.compact()
+        assert not os.path.exists(journal)
+        assert reader.load(cid) == [SYSTEM] + turn(0) + turn(1)
+        writer.close()
+        reader.close()
+
+
+def test_filenames_are_normalised_to_ids():
+    with tempfile.TemporaryDirectory() as directory, StubServer() as server:
+        store = open_log(directory)
+        bot = CustomerServiceChatbot(api_key="stub-key", provider="deepseek", base_url=server.base_url,
+                                     storage=store, autosave=True)
+        bot.chat("你好")
+        assert bot.save_conversation("my_chat.json") == "my_chat"
+        assert store.load("my_chat.json") == store.load("my_chat")
+        
+        # 按路径加载后继续自动保存到同一段对话
+        bot.load_conversation(os.path.join("exports", "my_chat.json"))
+        assert bot.conversation_id == "my_chat"
+        bot.chat("在吗")
+        assert bot.last_error is None
+        assert store.load("my_chat") == [dict(m) for m in bot.conversation_history]
+        store.close()
+
+
+def test_autosave_failure_does_not_lose_reply():
+    with tempfile.TemporaryDirectory() as directory, StubServer() as server:
+        store = open_log(directory)
+        bot = CustomerServiceChatbot(api_key="stub-key", provider="deepseek", base_url=server.base_url,
+                                     storage=store, autosave=True)
+        assert bot.chat("你好") == "收到您的问题：你好"
+        store.close()
+        # 存储已关闭：回复照常返回，错误记录在 last_error 中
+        assert bot.chat("在吗") == "收到您的问题：在吗"
+        assert isinstance(bot.last_error, RuntimeError)
+        assert "".join(bot.chat_stream("还在吗")) == "收到您的问题：还在吗"
+        assert isinstance(bot.last_error, RuntimeError)
+        
+        # 存储恢复后下一轮补写之前未能保存的消息
+        bot.storage = open_log(directory)
+        bot.chat("好的")
+        assert bot.last_error is None
+        assert bot.storage.load(bot.conversation_id) == [dict(m) for m in bot.conversation_history]
+        bot.storage.close()
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("追加式对话存储测试")
+    print("=" * 50)
+    
+    test_group_commit_and_replay()
+    print("✅ 组提交与重放")
+    test_compaction_preserves_history()
+    print("✅ 压缩前后历史一致")
+    test_recovery_truncates_torn_tail_and_keeps_deletes()
+    print("✅ 重启时截掉写了一半的记录，已删除的对话不会恢复")
+    test_read_only_reader_leaves_live_journal_alone()
+    print("✅ 只读打开不截断正在写入的日志")
+    test_filenames_are_normalised_to_ids()
+    print("✅ 文件名和路径按对话 ID 保存和加载")
+    test_autosave_failure_does_not_lose_reply()
+    print("✅ 自动保存失败不影响回复")
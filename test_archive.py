@@ -0,0 +1,76 @@
+import os
+import tempfile
+import time
+
+from archive import ConversationArchive, TieredStore, archive_conversations
+from search_index import SearchIndex
+from storage import JSONFileStore
+
+
+def history(i: int):
+    return [
+        {"role": "system", "content": "你是客服"},
+        {"role": "user", "content": f"订单{i}什么时候发货"},
+        {"role": "assistant", "content": f"订单{i}会在 48 小时内发货，请留意物流通知"},
+    ]
+
+
+def conversation_id(days_ago: int, i: int) -> str:
+    return f"conversation_{time.strftime('%Y%m%d_%H%M%S', time.localtime(time.time() - days_ago * 86400 - i))}"
+
+
+def test_old_conversations_move_to_archive_and_still_load():
+    with tempfile.TemporaryDirectory() as directory:
+        live = JSONFileStore(os.path.join(directory, "live"))
+        old = [conversation_id(100, i) for i in range(30)]
+        recent = [conversation_id(1, i) for i in range(5)]
+        for i, cid in enumerate(old + recent):
+            live.save(cid, history(i))
+        
+        archive = ConversationArchive(os.path.join(directory, "archive"))
+        assert archive_conversations(live, archive, time.time() - 30 * 86400) == 30
+        assert live.count() == 5
+        
+        store = TieredStore(live, ConversationArchive(os.path.join(directory, "archive")))
+        assert store.count() == 35
+        assert store.load(old[7]) == history(7)
+        # 列表按时间倒序合并两层
+        page = store.list_conversations(0, 8)
+        assert [item["id"] for item in page[:5]] == recent
+        assert page[5]["id"] == old[0]
+        assert store.list_conversations(4, 2) == page[4:6]
+        
+        store.delete(old[7])
+        assert store.count() == 34
+        try:
+            store.load(old[7])
+        except FileNotFoundError:
+            pass
+        else:
+            raise AssertionError("deleted conversation still loads from the archive")
+
+
+def test_saves_outside_the_store_are_not_indexed():
+    with tempfile.TemporaryDirectory() as directory:
+        live = JSONFileStore(os.path.join(directory, "live"))
+        search = SearchIndex(os.path.join(directory, "search.db"))
+        store = TieredStore(live, ConversationArchive(os.path.join(directory, "archive")), search)
+        
+        saved = store.save(None, history(1))
+        exported = store.save(os.path.join(directory, "export", "conversation_backup.json"), history(2))
+        assert os.path.exists(exported)
+        # 导出到存储目录外的文件不在列表中，检索结果也不能指向它
+        assert store.count() == 1
+        hits = search.search("发货", per_conversation=True)
+        assert [hit["conversation_id"] for hit in hits] == [os.path.splitext(os.path.basename(saved))[0]]
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("对话归档测试")
+    print("=" * 50)
+    
+    test_old_conversations_move_to_archive_and_still_load()
+    print("✅ 旧对话归档后仍可加载、列出和删除")
+    test_saves_outside_the_store_are_not_indexed()
+    print("✅ 存储目录外的文件不进入检索索引")
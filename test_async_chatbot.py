@@ -0,0 +1,87 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import aiohttp
+
+from async_chatbot import AsyncCustomerServiceChatbot
+from stub_server import StubServer
+
+
+LATENCY = 0.2
+
+
+def make_bot(server: StubServer, session: aiohttp.ClientSession = None) -> AsyncCustomerServiceChatbot:
+    return AsyncCustomerServiceChatbot(
+        api_key="stub-key",
+        provider="deepseek",
+        model="deepseek-chat",
+        base_url=server.base_url,
+        session=session
+    )
+
+
+async def run_concurrent(server: StubServer, n: int) -> float:
+    """同时发起 n 个独立对话，返回总耗时"""
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        bots = [make_bot(server, session) for _ in range(n)]
+        start = time.perf_counter()
+        replies = await asyncio.gather(*(bot.achat(f"问题{i}") for i, bot in enumerate(bots)))
+        elapsed = time.perf_counter() - start
+    
+    for i, reply in enumerate(replies):
+        assert reply == f"收到您的问题：问题{i}", reply
+    return elapsed
+
+
+def test_history_semantics():
+    async def scenario():
+        with StubServer() as server:
+            bot = make_bot(server)
+            reply = await bot.achat("你好")
+            assert reply == "收到您的问题：你好"
+            
+            deltas = [delta async for delta in bot.achat_stream("退款政策")]
+            assert "".join(deltas) == "收到您的问题：退款政策"
+            assert len(deltas) > 1
+            
+            history = bot.get_conversation_history()
+            assert [m["role"] for m in history] == ["user", "assistant", "user", "assistant"]
+            
+            bot.set_system_prompt("你是技术支持")
+            assert bot.conversation_history[0]["content"] == "你是技术支持"
+            
+            filename = os.path.join(tempfile.mkdtemp(), "conversation.json")
+            bot.save_conversation(filename)
+            bot.reset_conversation()
+            assert bot.get_conversation_history() == []
+            bot.load_conversation(filename)
+            assert bot.get_conversation_history() == history
+            
+            await bot.aclose()
+    
+    asyncio.run(scenario())
+
+
+def test_concurrency_scaling():
+    with StubServer(latency=LATENCY) as server:
+        results = {n: asyncio.run(run_concurrent(server, n)) for n in (1, 10, 100, 1000)}
+    
+    for n, elapsed in results.items():
+        print(f"并发 {n:>5}: {elapsed:.3f}s  ({n / elapsed:.1f} 对话/秒)")
+    
+    # 全部等待都在 I/O 上，1000 个并发对话的总耗时应远小于串行的 1000 * LATENCY
+    assert results[1000] < 10 * LATENCY
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("异步客服机器人测试（本地模拟服务）")
+    print("=" * 50)
+    
+    test_history_semantics()
+    print("✅ 对话历史语义一致")
+    
+    test_concurrency_scaling()
+    print("✅ 并发扩展测试通过")
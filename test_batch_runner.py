@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+
+from batch_runner import BatchRunner, read_finished_ids
+from chatbot import CustomerServiceChatbot
+from stub_server import StubServer
+
+
+def write_input(directory: str, count: int) -> str:
+    filename = os.path.join(directory, "input.jsonl")
+    with open(filename, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            f.write(json.dumps({"id": f"c{i}", "turns": [f"问题{i}"]}, ensure_ascii=False) + "\n")
+    return filename
+
+
+def make_runner(server: StubServer) -> BatchRunner:
+    return BatchRunner(
+        lambda: CustomerServiceChatbot(api_key="stub-key", provider="deepseek", base_url=server.base_url,
+                                       autosave=False),
+        workers=4
+    )
+
+
+def test_resume_skips_finished_and_retries_failed():
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = write_input(directory, 6)
+        output_file = os.path.join(directory, "output.jsonl")
+        
+        # 第一次运行时服务全部报错：结果写出但不算完成
+        with StubServer(error_rate=1.0, error_status=400) as server:
+            stats = make_runner(server).run(input_file, output_file)
+        assert stats["failed"] == 6
+        assert read_finished_ids(output_file) == set()
+        
+        # 服务恢复后续跑，之前失败的对话全部重新执行
+        with StubServer() as server:
+            stats = make_runner(server).run(input_file, output_file)
+        assert stats["conversations"] == 6 and stats["failed"] == 0
+        assert read_finished_ids(output_file) == {f"c{i}" for i in range(6)}
+        
+        # 再次续跑时没有待执行的对话
+        with StubServer() as server:
+            stats = make_runner(server).run(input_file, output_file)
+            assert server.request_count == 0
+        assert stats["skipped"] == 6
+
+
+def test_torn_last_line_is_ignored():
+    with tempfile.TemporaryDirectory() as directory:
+        output_file = os.path.join(directory, "output.jsonl")
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write('{"id": "c0", "turns": [], "error": null}\n{"id": "c1", "tu')
+        assert read_finished_ids(output_file) == {"c0"}
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("批量对话执行器测试（本地模拟服务）")
+    print("=" * 50)
+    
+    test_resume_skips_finished_and_retries_failed()
+    print("✅ 断点续跑跳过已完成的对话，重试失败的对话")
+    test_torn_last_line_is_ignored()
+    print("✅ 忽略崩溃时写了一半的行")
@@ -0,0 +1,96 @@
+import threading
+import time
+
+from chatbot import CustomerServiceChatbot
+from config import Config
+from rate_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, ProviderScheduler, QueueFullError, SchedulerTimeout
+from stub_server import StubServer
+
+
+def test_interactive_requests_jump_the_queue():
+    scheduler = ProviderScheduler(requests_per_minute=600, tokens_per_minute=0, burst_seconds=0.1)
+    scheduler.acquire(1)
+    order = []
+    
+    def worker(priority):
+        scheduler.acquire(1, priority)
+        order.append(priority)
+    
+    threads = [threading.Thread(target=worker, args=(PRIORITY_BATCH,)) for _ in range(3)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    interactive = threading.Thread(target=worker, args=(PRIORITY_INTERACTIVE,))
+    interactive.start()
+    for t in threads + [interactive]:
+        t.join()
+    # 第一个批量请求可能已在队首等待，在线请求最晚排在第二位
+    assert PRIORITY_INTERACTIVE in order[:2]
+
+
+def test_queue_full_rejects():
+    scheduler = ProviderScheduler(requests_per_minute=1, tokens_per_minute=0, max_queue=1)
+    scheduler.acquire(1)
+    
+    def waiter_acquire():
+        try:
+            scheduler.acquire(1, timeout=0.2)
+        except SchedulerTimeout:
+            pass
+    
+    waiter = threading.Thread(target=waiter_acquire)
+    waiter.start()
+    time.sleep(0.05)
+    try:
+        scheduler.acquire(1)
+    except QueueFullError:
+        pass
+    else:
+        raise AssertionError("queue should be full")
+    waiter.join()
+    assert scheduler.rejected == 1
+
+
+def test_single_limit_builds_scheduler():
+    rpm, tpm = Config.RATE_LIMIT_RPM, Config.RATE_LIMIT_TPM
+    Config.RATE_LIMIT_RPM, Config.RATE_LIMIT_TPM = 0, 1000
+    try:
+        with StubServer() as server:
+            bot = CustomerServiceChatbot(api_key="stub-key-tpm-only", provider="deepseek",
+                                         base_url=server.base_url, autosave=False)
+            assert bot.scheduler is not None
+            assert bot.scheduler.request_rate == 0
+    finally:
+        Config.RATE_LIMIT_RPM, Config.RATE_LIMIT_TPM = rpm, tpm
+
+
+def test_failed_requests_refund_tokens():
+    with StubServer(error_rate=1.0, error_status=400) as server:
+        scheduler = ProviderScheduler(requests_per_minute=0, tokens_per_minute=600, burst_seconds=60)
+        bot = CustomerServiceChatbot(api_key="stub-key", provider="deepseek", base_url=server.base_url,
+                                     scheduler=scheduler, autosave=False)
+        bot.max_tokens = 20
+        # 每次预留上下文加回复上限（100 多个 token），不退还的话几次请求后就要等待配额
+        start = time.perf_counter()
+        for i in range(6):
+            bot.chat(f"问题{i}")
+            assert bot.last_error.status_code == 400
+            "".join(bot.chat_stream(f"问题{i}"))
+            assert bot.last_error.status_code == 400
+        assert time.perf_counter() - start < 1.0
+        assert server.request_count == 12
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("配额调度器测试")
+    print("=" * 50)
+    
+    test_interactive_requests_jump_the_queue()
+    print("✅ 在线请求优先于批量请求")
+    test_queue_full_rejects()
+    print("✅ 队列满时拒绝请求")
+    test_single_limit_builds_scheduler()
+    print("✅ 只配置一项限额时同样启用调度器")
+    test_failed_requests_refund_tokens()
+    print("✅ 失败的请求退还预留的 token")
@@ -0,0 +1,164 @@
+import asyncio
+import time
+
+import aiohttp
+
+from async_chatbot import AsyncCustomerServiceChatbot
+from batch_runner import percentile
+from chatbot import CustomerServiceChatbot
+from metrics import Metrics
+from rate_limiter import ProviderScheduler
+from resilience import CircuitBreaker, ResilientCaller, RetryPolicy
+from stub_server import StubServer
+
+
+def make_bot(server: StubServer, resilience: ResilientCaller) -> CustomerServiceChatbot:
+    return CustomerServiceChatbot(
+        api_key="stub-key",
+        provider="deepseek",
+        model="deepseek-chat",
+        base_url=server.base_url,
+        resilience=resilience
+    )
+
+
+def test_retry_on_server_errors():
+    with StubServer(error_rate=0.3, seed=1) as server:
+        caller = ResilientCaller(retry=RetryPolicy(max_attempts=5, base_delay=0.01), hedge_percentile=None)
+        bot = make_bot(server, caller)
+        for i in range(30):
+            assert bot.chat(f"问题{i}") == f"收到您的问题：问题{i}", bot.last_error
+        assert server.error_count > 0
+        assert caller.retries == server.error_count
+
+
+def test_no_retry_on_client_errors():
+    with StubServer(error_rate=1.0, error_status=401) as server:
+        caller = ResilientCaller(retry=RetryPolicy(max_attempts=5, base_delay=0.01), hedge_percentile=None)
+        bot = make_bot(server, caller)
+        bot.chat("你好")
+        assert bot.last_error.status_code == 401
+        assert server.request_count == 1
+
+
+def test_circuit_breaker_fails_fast():
+    with StubServer(error_rate=1.0) as server:
+        caller = ResilientCaller(
+            retry=RetryPolicy(max_attempts=1),
+            breaker=CircuitBreaker(failure_threshold=3, recovery_timeout=0.2),
+            hedge_percentile=None
+        )
+        bot = make_bot(server, caller)
+        for _ in range(10):
+            bot.chat("你好")
+        assert server.request_count == 3
+        assert caller.breaker.state == "open"
+        
+        # 恢复期后放行探测请求，成功则关闭熔断
+        server.error_rate = 0.0
+        time.sleep(0.25)
+        assert bot.chat("你好") == "收到您的问题：你好"
+        assert caller.breaker.state == "closed"
+
+
+def test_client_errors_do_not_trip_breaker():
+    with StubServer(error_rate=1.0, error_status=400) as server:
+        caller = ResilientCaller(
+            retry=RetryPolicy(max_attempts=3, base_delay=0.01),
+            breaker=CircuitBreaker(failure_threshold=3, recovery_timeout=60),
+            hedge_percentile=None
+        )
+        bot = make_bot(server, caller)
+        for _ in range(10):
+            bot.chat("你好")
+            assert bot.last_error.status_code == 400
+        assert server.request_count == 10
+        assert caller.breaker.state == "closed" and caller.breaker.failures == 0
+        
+        async def scenario():
+            async def failing():
+                raise bot.last_error
+            for _ in range(5):
+                try:
+                    await caller.acall(failing)
+                except Exception:
+                    pass
+        
+        asyncio.run(scenario())
+        assert caller.breaker.state == "closed" and caller.breaker.failures == 0
+
+
+def test_hedging_cuts_tail_latency():
+    def run(hedge_percentile):
+        with StubServer(latency=0.02, slow_rate=0.05, slow_latency=0.5, seed=7) as server:
+            caller = ResilientCaller(hedge_percentile=hedge_percentile, hedge_min_samples=10)
+            bot = make_bot(server, caller)
+            latencies = []
+            for i in range(100):
+                bot.reset_conversation()
+                start = time.perf_counter()
+                bot.chat(f"问题{i}")
+                latencies.append(time.perf_counter() - start)
+            return percentile(sorted(latencies), 99), caller.hedges
+    
+    p99_plain, _ = run(None)
+    p99_hedged, hedges = run(90)
+    print(f"p99 无对冲 {p99_plain * 1000:.0f}ms，对冲 {p99_hedged * 1000:.0f}ms（对冲 {hedges} 次）")
+    assert hedges > 0
+    assert p99_hedged < p99_plain / 2
+
+
+def test_async_retry():
+    async def scenario():
+        with StubServer(error_rate=0.3, seed=3) as server:
+            caller = ResilientCaller(retry=RetryPolicy(max_attempts=5, base_delay=0.01), hedge_percentile=None)
+            bot = AsyncCustomerServiceChatbot(api_key="stub-key", provider="deepseek",
+                                              base_url=server.base_url, resilience=caller)
+            replies = [await bot.achat(f"问题{i}") for i in range(20)]
+            await bot.aclose()
+            assert replies == [f"收到您的问题：问题{i}" for i in range(20)]
+            assert caller.retries == server.error_count
+    
+    asyncio.run(scenario())
+
+
+def test_async_stream_goes_through_resilience_and_scheduler():
+    async def scenario():
+        with StubServer(error_rate=0.3, seed=5) as server:
+            caller = ResilientCaller(retry=RetryPolicy(max_attempts=5, base_delay=0.01), hedge_percentile=None)
+            scheduler = ProviderScheduler(requests_per_minute=60000, tokens_per_minute=10 ** 9)
+            async with aiohttp.ClientSession() as session:
+                bot = AsyncCustomerServiceChatbot(api_key="stub-key", provider="deepseek",
+                                                  base_url=server.base_url, session=session,
+                                                  resilience=caller, scheduler=scheduler, metrics=Metrics())
+                for i in range(20):
+                    reply = "".join([delta async for delta in bot.achat_stream(f"问题{i}")])
+                    assert reply == f"收到您的问题：问题{i}", bot.last_error
+                    # 外部传入的会话同样记录首字节时间
+                    assert bot.last_call["first_byte"] is not None
+            assert server.error_count > 0
+            assert caller.retries == server.error_count
+            assert scheduler.admitted == server.request_count
+    
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("容错层测试（本地故障注入模拟服务）")
+    print("=" * 50)
+    
+    test_retry_on_server_errors()
+    print("✅ 5xx 错误自动重试")
+    test_no_retry_on_client_errors()
+    print("✅ 4xx 错误不重试")
+    test_circuit_breaker_fails_fast()
+    print("✅ 熔断器快速失败并自动恢复")
+    test_client_errors_do_not_trip_breaker()
+    print("✅ 4xx 错误不触发熔断")
+    test_hedging_cuts_tail_latency()
+    print("✅ 对冲请求降低尾延迟")
+    test_async_retry()
+    print("✅ 异步路径重试")
+    test_async_stream_goes_through_resilience_and_scheduler()
+    print("✅ 异步流式路径经过容错层和调度器")
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import tempfile
+
+from chatbot import CustomerServiceChatbot
+from response_cache import ResponseCache
+from stub_server import StubServer
+
+
+SYSTEM = {"role": "system", "content": "你是客服"}
+PARAMS = {"temperature": 0.7, "max_tokens": 100}
+
+
+def key(cache: ResponseCache, messages):
+    return cache.make_key("deepseek", "deepseek-chat", messages, PARAMS)
+
+
+def test_key_covers_previous_turns_by_default():
+    cache = ResponseCache()
+    about_refund = [SYSTEM, {"role": "user", "content": "怎么退款"}, {"role": "assistant", "content": "在订单页申请"},
+                    {"role": "user", "content": "要多久"}]
+    about_shipping = [SYSTEM, {"role": "user", "content": "什么时候发货"}, {"role": "assistant", "content": "48 小时内"},
+                      {"role": "user", "content": "要多久"}]
+    assert key(cache, about_refund) != key(cache, about_shipping)
+    assert key(cache, about_refund) == key(cache, list(about_refund))
+    # 显式只看当前问题时两者相同
+    last_only = ResponseCache(context_messages=1)
+    assert key(last_only, about_refund) == key(last_only, about_shipping)
+
+
+def test_key_covers_appended_system_prompts():
+    cache = ResponseCache(context_messages=1)
+    base = [SYSTEM, {"role": "user", "content": "你好"}]
+    # 前缀稳定模式下修改提示词会在历史中间追加一条系统消息
+    changed = [SYSTEM, {"role": "system", "content": "请用英文回答"}, {"role": "user", "content": "你好"}]
+    assert key(cache, base) != key(cache, changed)
+
+
+def test_context_dependent_follow_up_is_not_served_from_cache():
+    with StubServer() as server:
+        cache = ResponseCache()
+        
+        def make_bot():
+            return CustomerServiceChatbot(api_key="stub-key", provider="deepseek", base_url=server.base_url,
+                                          response_cache=cache, autosave=False)
+        
+        first, second = make_bot(), make_bot()
+        first.chat("怎么退款")
+        first.chat("要多久")
+        second.chat("什么时候发货")
+        second.chat("要多久")
+        assert server.request_count == 4
+        
+        # 完全相同的对话命中缓存
+        third = make_bot()
+        third.chat("怎么退款")
+        third.chat("要多久")
+        assert server.request_count == 4
+        assert cache.hits == 2
+
+
+def test_disk_eviction_runs_periodically():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cache.db")
+        cache = ResponseCache(disk_path=path, max_disk_entries=5, evict_interval=10)
+        
+        def disk_entries():
+            with sqlite3.connect(path) as conn:
+                return conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        
+        for i in range(9):
+            cache.set(f"k{i}", f"v{i}")
+        assert disk_entries() == 9
+        cache.set("k9", "v9")
+        assert disk_entries() == 5
+        # 保留的是最近访问的条目
+        assert ResponseCache(disk_path=path).get("k9") == "v9"
+        assert ResponseCache(disk_path=path).get("k0") is None
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("回复缓存测试")
+    print("=" * 50)
+    
+    test_key_covers_previous_turns_by_default()
+    print("✅ 缓存键默认包含之前的对话")
+    test_key_covers_appended_system_prompts()
+    print("✅ 缓存键包含追加的系统提示词")
+    test_context_dependent_follow_up_is_not_served_from_cache()
+    print("✅ 依赖上下文的追问不会命中其他对话的缓存")
+    test_disk_eviction_runs_periodically()
+    print("✅ 磁盘层定期清理")
@@ -0,0 +1,75 @@
+import time
+
+from router import Backend, ProviderRouter
+from stub_server import StubServer
+
+
+def make_backend(server: StubServer, name: str) -> Backend:
+    backend = Backend("deepseek", "deepseek-chat", api_key="stub-key", base_url=server.base_url, name=name)
+    backend.breaker.failure_threshold = 1
+    backend.breaker.recovery_timeout = 0.1
+    return backend
+
+
+def test_failover_within_turn():
+    with StubServer(error_rate=1.0, error_status=401) as bad, StubServer() as good:
+        router = ProviderRouter([make_backend(bad, "bad"), make_backend(good, "good")])
+        # 两个后端都没有延迟样本，得分相同，按列表顺序先尝试故障后端
+        assert router.complete([{"role": "user", "content": "你好"}]) == "收到您的问题：你好"
+        assert router.last_backend.name == "good"
+        assert bad.request_count == 1
+        assert router.backends[0].breaker.state == "open"
+        
+        # 熔断期间不再尝试故障后端
+        assert "".join(router.stream([{"role": "user", "content": "再见"}])) == "收到您的问题：再见"
+        assert bad.request_count == 1
+
+
+def test_untried_backend_does_not_stick_half_open():
+    with StubServer() as primary, StubServer() as standby:
+        router = ProviderRouter([make_backend(primary, "primary"), make_backend(standby, "standby")])
+        primary_backend, standby_backend = router.backends
+        router._record(standby_backend, None)
+        time.sleep(0.15)
+        
+        # 恢复期已过，备用后端进入候选列表，但本轮由主后端处理，不应占用它的半开探测名额
+        for _ in range(3):
+            assert router.candidates() == [primary_backend, standby_backend]
+            router.complete([{"role": "user", "content": "你好"}])
+        assert standby.request_count == 0
+        assert standby_backend.breaker.state == "open"
+        
+        # 主后端熔断后，备用后端的探测请求成功并关闭熔断
+        router._record(primary_backend, None)
+        assert router.complete([{"role": "user", "content": "你好"}]) == "收到您的问题：你好"
+        assert router.last_backend is standby_backend
+        assert standby_backend.breaker.state == "closed"
+
+
+def test_half_open_admits_single_probe():
+    with StubServer() as server:
+        breaker = make_backend(server, "probe").breaker
+        breaker.record_failure()
+        assert not breaker.is_available()
+        time.sleep(0.15)
+        assert breaker.is_available()
+        assert breaker.is_available()
+        assert breaker.allow()
+        assert breaker.state == "half_open"
+        assert not breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == "open"
+        assert not breaker.is_available()
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("多后端路由测试（本地模拟服务）")
+    print("=" * 50)
+    
+    test_failover_within_turn()
+    print("✅ 同一轮内故障切换")
+    test_untried_backend_does_not_stick_half_open()
+    print("✅ 未被尝试的后端不会卡在半开状态")
+    test_half_open_admits_single_probe()
+    print("✅ 半开状态只放行一个探测请求")
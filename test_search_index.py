@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+
+from search_index import SearchIndex, tokenize
+
+
+HISTORY = [
+    {"role": "system", "content": "你是客服"},
+    {"role": "user", "content": "我想申请退款，订单号 20240518001"},
+    {"role": "assistant", "content": "好的，已为您提交退款申请。Refund requested."},
+]
+DAY = time.mktime((2024, 5, 18, 10, 0, 0, 0, 0, -1))
+
+
+def make_index(directory: str) -> SearchIndex:
+    index = SearchIndex(os.path.join(directory, "search.db"))
+    index.index_conversation("conversation_a", HISTORY, DAY, "deepseek", "deepseek-chat")
+    return index
+
+
+def test_cjk_text_is_split_into_bigrams():
+    terms, tails = tokenize("申请退款，订单号 Refund")
+    assert terms == ["申请", "请退", "退款", "订单", "单号", "refund"]
+    # 每段中文的最后一个字单独记录，单字查询也能命中
+    assert tails == ["款", "号"]
+
+
+def test_cjk_queries_match_without_word_segmentation():
+    with tempfile.TemporaryDirectory() as directory:
+        index = make_index(directory)
+        assert [hit["seq"] for hit in index.search("退款")] in ([1, 2], [2, 1])
+        assert [hit["seq"] for hit in index.search("退款", role="user")] == [1]
+        assert index.search("20240518001")[0]["seq"] == 1
+        assert index.search("REFUND")[0]["seq"] == 2
+        assert index.search("号") and index.search("退")
+        # 引号内按短语匹配
+        assert index.search('"退款申请"') and not index.search('"申请退货"')
+        assert index.search("，。") == [] and index.search("") == []
+
+
+def test_filters_and_incremental_updates():
+    with tempfile.TemporaryDirectory() as directory:
+        index = make_index(directory)
+        assert index.search("退款", provider="deepseek") and not index.search("退款", provider="openai")
+        assert index.search("退款", start=DAY - 3600, end=DAY + 3600)
+        assert not index.search("退款", start=DAY + 86400)
+        
+        # 改写最后一条回复并追加一条消息
+        index.update("conversation_a", 2, [{"role": "assistant", "content": "抱歉，暂不支持退货"},
+                                            {"role": "user", "content": "那换货呢"}])
+        assert not index.search("refund")
+        assert index.search("换货")[0]["seq"] == 3
+        assert index.count() == 4
+        
+        index.index_conversation("conversation_b", [{"role": "user", "content": "退款多久到账"}], DAY + 60)
+        hits = index.search("退款", per_conversation=True)
+        assert sorted(hit["conversation_id"] for hit in hits) == ["conversation_a", "conversation_b"]
+        index.remove("conversation_b")
+        assert [hit["conversation_id"] for hit in index.search("退款", per_conversation=True)] == ["conversation_a"]
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("全文检索测试")
+    print("=" * 50)
+    
+    test_cjk_text_is_split_into_bigrams()
+    print("✅ 中文按二元组切分")
+    test_cjk_queries_match_without_word_segmentation()
+    print("✅ 中文查询无需分词即可命中")
+    test_filters_and_incremental_updates()
+    print("✅ 过滤条件与增量更新")
@@ -0,0 +1,48 @@
+from semantic_cache import SemanticFAQCache
+
+
+FAQ = [
+    ("怎么申请退款", "在订单详情页点击申请退款，审核通过后原路退回"),
+    ("如何修改收货地址", "发货前可在订单详情页修改收货地址"),
+    ("会员怎么续费", "在会员中心开启自动续费或手动续费"),
+    ("运费怎么算", "满 99 元包邮，不满按地区收取运费"),
+]
+
+
+def make_cache() -> SemanticFAQCache:
+    cache = SemanticFAQCache()
+    cache.add_many(FAQ)
+    return cache
+
+
+def test_rewordings_hit():
+    cache = make_cache()
+    for question, expected in [("怎么申请退款？", FAQ[0][1]), ("如何 修改收货地址!", FAQ[1][1])]:
+        match = cache.lookup(question)
+        assert match is not None and match[0] == expected, question
+
+
+def test_near_misses_with_different_intent_do_not_hit():
+    cache = make_cache()
+    # 只差一两个字但意思不同的问题不能返回已有答案
+    for question in ["怎么申请退货", "会员怎么退费", "运费险怎么算", "如何修改手机号"]:
+        assert cache.lookup(question) is None, (question, cache.lookup_batch([question]))
+
+
+def test_batch_lookup_matches_single_lookup():
+    cache = make_cache()
+    questions = ["怎么申请退款？", "怎么申请退货", "运费怎么算", "今天天气怎么样"]
+    assert cache.lookup_batch(questions) == [cache.lookup(q) for q in questions]
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("语义 FAQ 缓存测试")
+    print("=" * 50)
+    
+    test_rewordings_hit()
+    print("✅ 只有标点和空格不同的问法命中")
+    test_near_misses_with_different_intent_do_not_hit()
+    print("✅ 意图不同的相近问题不命中")
+    test_batch_lookup_matches_single_lookup()
+    print("✅ 批量查询与单条查询一致")
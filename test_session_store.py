@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+
+from session_store import SQLiteSessionStore, VersionConflict
+
+
+SYSTEM = {"role": "system", "content": "你是客服"}
+
+
+def test_concurrent_writer_gets_version_conflict():
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteSessionStore(os.path.join(directory, "sessions.db"))
+        store.create("s", [SYSTEM])
+        first, second = store.open("s"), store.open("s")
+        second.history
+        
+        first.history.extend([{"role": "user", "content": "问题1"}, {"role": "assistant", "content": "回答1"}])
+        assert first.save()
+        assert not first.save()  # 没有变化时不访问存储
+        
+        second.history.append({"role": "user", "content": "另一个问题"})
+        try:
+            second.save()
+        except VersionConflict as e:
+            assert e.expected == 1 and e.actual == 2
+        else:
+            raise AssertionError("stale session overwrote a newer version")
+        assert [m["content"] for m in second.refresh()] == ["你是客服", "问题1", "回答1"]
+        
+        # 改写开头（如重置对话）只保留公共前缀
+        second.save([{"role": "system", "content": "新的提示词"}])
+        assert store.fetch("s") == ([{"role": "system", "content": "新的提示词"}], 3)
+
+
+def test_missing_session_raises_file_not_found():
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteSessionStore(os.path.join(directory, "sessions.db"))
+        try:
+            store.open("missing").history
+        except FileNotFoundError:
+            pass
+        else:
+            raise AssertionError("missing session should raise FileNotFoundError")
+
+
+def test_retry_on_conflict_loses_no_turns():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.db")
+        SQLiteSessionStore(path).create("s", [SYSTEM])
+        def worker(n):
+            store = SQLiteSessionStore(path)
+            for i in range(20):
+                while True:
+                    session = store.open("s")
+                    session.history.append({"role": "user", "content": f"{n}-{i}"})
+                    try:
+                        session.save()
+                        break
+                    except VersionConflict:
+                        continue  # 期间有其他线程写入，重新读取后再追加
+        
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        messages, version = SQLiteSessionStore(path).fetch("s")
+        assert len(messages) == 1 + 4 * 20
+        assert version == 1 + 4 * 20
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("会话存储测试")
+    print("=" * 50)
+    
+    test_concurrent_writer_gets_version_conflict()
+    print("✅ 过期的会话句柄写入时报版本冲突")
+    test_missing_session_raises_file_not_found()
+    print("✅ 会话不存在时抛出 FileNotFoundError")
+    test_retry_on_conflict_loses_no_turns()
+    print("✅ 冲突后重试不丢失消息")
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+from async_chatbot import AsyncCustomerServiceChatbot
+from chatbot import CustomerServiceChatbot
+from metrics import Metrics
+from singleflight import SingleFlight
+from stub_server import StubServer
+
+
+def make_bots(server: StubServer, flight: SingleFlight, api_keys):
+    return [CustomerServiceChatbot(api_key=key, provider="deepseek", base_url=server.base_url,
+                                   single_flight=flight, metrics=Metrics(), autosave=False)
+            for key in api_keys]
+
+
+def run_threads(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_identical_requests_share_one_call():
+    with StubServer(latency=0.2) as server:
+        flight = SingleFlight()
+        bots = make_bots(server, flight, ["stub-key"] * 5)
+        replies = {}
+        run_threads([lambda bot=bot: replies.setdefault(id(bot), bot.chat("怎么退款")) for bot in bots])
+        assert server.request_count == 1
+        assert set(replies.values()) == {"收到您的问题：怎么退款"}
+        # 跟随者的 last_call 是本次等待的记录，而不是上一轮的旧数据
+        coalesced = [bot.last_call.get("coalesced", False) for bot in bots]
+        assert sorted(coalesced) == [False] + [True] * 4
+        assert all(bot.last_call["latency"] > 0.1 for bot in bots)
+
+
+def test_streams_share_one_call():
+    with StubServer(latency=0.2, chunk_delay=0.01) as server:
+        flight = SingleFlight()
+        bots = make_bots(server, flight, ["stub-key"] * 3)
+        replies = []
+        run_threads([lambda bot=bot: replies.append("".join(bot.chat_stream("在吗"))) for bot in bots])
+        assert server.request_count == 1
+        assert replies == ["收到您的问题：在吗"] * 3
+        assert sum(bool(bot.last_call.get("coalesced")) for bot in bots) == 2
+
+
+def test_different_api_keys_are_not_coalesced():
+    with StubServer(latency=0.2) as server:
+        flight = SingleFlight()
+        bots = make_bots(server, flight, ["key-a", "key-b"])
+        run_threads([lambda bot=bot: bot.chat("怎么退款") for bot in bots])
+        assert server.request_count == 2
+        assert flight.coalesced == 0
+
+
+def test_async_requests_share_one_call():
+    async def scenario():
+        with StubServer(latency=0.2) as server:
+            flight = SingleFlight()
+            bots = [AsyncCustomerServiceChatbot(api_key="stub-key", provider="deepseek", base_url=server.base_url,
+                                                single_flight=flight, metrics=Metrics(), autosave=False)
+                    for _ in range(4)]
+            replies = await asyncio.gather(*(bot.achat("怎么退款") for bot in bots))
+            streamed = await asyncio.gather(*(collect(bot.achat_stream("在吗")) for bot in bots))
+            for bot in bots:
+                await bot.aclose()
+            assert replies == ["收到您的问题：怎么退款"] * 4
+            assert streamed == ["收到您的问题：在吗"] * 4
+            assert server.request_count == 2
+            assert sum(bool(bot.last_call.get("coalesced")) for bot in bots) == 3
+    
+    async def collect(stream):
+        return "".join([delta async for delta in stream])
+    
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("在途请求合并测试")
+    print("=" * 50)
+    
+    test_identical_requests_share_one_call()
+    print("✅ 相同请求只调用一次上游")
+    test_streams_share_one_call()
+    print("✅ 流式请求合并")
+    test_different_api_keys_are_not_coalesced()
+    print("✅ 不同 API Key 的请求不合并")
+    test_async_requests_share_one_call()
+    print("✅ 异步请求合并")
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+
+from storage import JSONFileStore, SQLiteStore, new_conversation_id, timestamp_from_id
+
+
+HISTORY = [
+    {"role": "system", "content": "你是客服"},
+    {"role": "user", "content": "怎么申请退款"},
+    {"role": "assistant", "content": "请在订单页点击申请退款"},
+]
+
+
+def test_ids_are_unique_within_a_second():
+    ids = [new_conversation_id() for _ in range(1000)]
+    assert len(set(ids)) == len(ids)
+    # 随机后缀不影响从 ID 解析时间
+    assert abs(timestamp_from_id(ids[0]) - time.time()) < 2
+    assert timestamp_from_id("conversation_20240501_120000") == timestamp_from_id("conversation_20240501_120000_ab12cd34")
+    assert timestamp_from_id("notes.json") is None
+
+
+def test_saves_in_the_same_second_do_not_overwrite():
+    with tempfile.TemporaryDirectory() as directory:
+        for store in (JSONFileStore(os.path.join(directory, "json")), SQLiteStore(os.path.join(directory, "db.sqlite"))):
+            ids = [store.save(None, HISTORY[:1] + [{"role": "user", "content": f"问题{i}"}]) for i in range(20)]
+            assert len(set(ids)) == 20
+            assert store.count() == 20
+            assert store.load(ids[3])[-1]["content"] == "问题3"
+
+
+def test_round_trip_and_listing():
+    with tempfile.TemporaryDirectory() as directory:
+        for store in (JSONFileStore(os.path.join(directory, "json")), SQLiteStore(os.path.join(directory, "db.sqlite"))):
+            saved = store.save(None, HISTORY)
+            conversation_id = os.path.splitext(os.path.basename(saved))[0]
+            assert store.load(saved) == HISTORY
+            item = store.list_conversations(0, 10)[0]
+            assert item["id"] == conversation_id
+            assert item["turn_count"] == 1 and item["preview"] == "怎么申请退款"
+            assert [i for i, _ in store.iter_ids(start=time.time() - 60)] == [conversation_id]
+            store.delete(saved)
+            assert store.count() == 0
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("对话存储测试")
+    print("=" * 50)
+    
+    test_ids_are_unique_within_a_second()
+    print("✅ 同一秒内生成的对话 ID 不重复")
+    test_saves_in_the_same_second_do_not_overwrite()
+    print("✅ 同一秒内保存的对话互不覆盖")
+    test_round_trip_and_listing()
+    print("✅ 保存、加载、列表和删除")
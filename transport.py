@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import Dict, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from config import Config
+from metrics import note_connect
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        note_connect(time.perf_counter() - start)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        note_connect(time.perf_counter() - start)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """新建连接时记录建连耗时（TCP + TLS），复用的长连接不计入"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class HTTPTransport:
+    def __init__(self, pool_connections: int = Config.HTTP_POOL_CONNECTIONS,
+                 pool_maxsize: int = Config.HTTP_POOL_MAXSIZE,
+                 connect_timeout: float = Config.HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = Config.HTTP_READ_TIMEOUT):
+        """
+        基于 requests.Session 的长连接 HTTP 传输层
+
+        Args:
+            pool_connections: 连接池缓存的主机数量
+            pool_maxsize: 每个主机最多保持的连接数
+            connect_timeout: 建立连接的超时时间（秒）
+            read_timeout: 等待响应数据的超时时间（秒）
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+        
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        self._warmed_hosts = set()
+        self._lock = threading.Lock()
+    
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+    
+    def warm_up(self, base_url: str):
+        """预先建立到目标主机的连接（TCP + TLS），失败时静默忽略"""
+        with self._lock:
+            if base_url in self._warmed_hosts:
+                return
+            self._warmed_hosts.add(base_url)
+        
+        try:
+            self.session.head(base_url, timeout=self.timeout)
+        except requests.RequestException:
+            pass
+    
+    def close(self):
+        self.session.close()
+
+
+_shared_transports: Dict[Tuple, HTTPTransport] = {}
+_shared_lock = threading.Lock()
+
+
+def get_shared_transport(pool_connections: int = Config.HTTP_POOL_CONNECTIONS,
+                         pool_maxsize: int = Config.HTTP_POOL_MAXSIZE,
+                         connect_timeout: float = Config.HTTP_CONNECT_TIMEOUT,
+                         read_timeout: float = Config.HTTP_READ_TIMEOUT) -> HTTPTransport:
+    """获取进程内共享的传输层，相同配置的机器人复用同一个连接池"""
+    key = (pool_connections, pool_maxsize, connect_timeout, read_timeout)
+    with _shared_lock:
+        transport = _shared_transports.get(key)
+        if transport is None:
+            transport = HTTPTransport(*key)
+            _shared_transports[key] = transport
+        return transport